@@ -0,0 +1,380 @@
+import os
+import time
+import asyncio
+import logging
+import argparse
+from pathlib import Path
+
+import aiohttp
+
+from final_code import (
+    BASE_URL, HEADERS, CYCLES, MAX_TRIES, LOG_FILE, setup_logging,
+    MAX_AGE_DAYS, ACTIVE_CYCLE, add_crawl_args, crawl_options, prioritise,
+    state_query, district_query, block_query, village_query, nutrient_query,
+    clean_name, nutrient_variables, split_by_village,
+)
+from hierarchy_cache import HierarchyCache, HIERARCHY_CACHE_FILE, HIERARCHY_TTL_DAYS
+from task_ledger import TaskLedger, LEDGER_FILE, in_shard, shard_file, in_scope, is_partial
+from transport import AsyncTransport, build_transport
+from writers import CsvWriter, make_writer
+from flatten import NutrientSchema, NUTRIENT_SCHEMA_FILE, BlockFlattener
+from metrics import METRICS, METRICS_FILE, METRICS_INTERVAL, CrawlProgress, MetricsReporter
+from validate import VillageValidator, ValidationError
+from response_cache import ResponseCache, AsyncCachingTransport
+
+# Global limit on requests in flight and the limit for each level of the crawl
+DEFAULT_CONCURRENCY = 32
+DEFAULT_LEVEL_LIMITS = {
+    "state": 4,
+    "district": 8,
+    "block": 16,
+    "village": 32,
+}
+
+# Which level of the crawl each GraphQL operation belongs to
+OPERATION_LEVELS = {
+    "GetState": "state",
+    "GetdistrictAndSubdistrictBystate": "state",
+    "GetBlocks": "district",
+    "GetVillageBydistrict": "block",
+    "GetNutrientDashboardForPortal": "village",
+}
+
+
+class AsyncCrawler:
+    def __init__(self, data_dir, ledger, concurrency=DEFAULT_CONCURRENCY, level_limits=None, hierarchy_cache=None,
+                 fetch_mode="village", shard=None, transport=None, incremental=False, writer=None, schema=None,
+                 metrics_interval=METRICS_INTERVAL, scope=None):
+        self.data_dir = data_dir
+        self.schema = schema or NutrientSchema(NUTRIENT_SCHEMA_FILE)
+        self.writer = writer or CsvWriter(data_dir)
+        self.incremental = incremental
+        self.transport = transport or build_transport(AsyncTransport, BASE_URL, HEADERS)
+        self.ledger = ledger
+        self.shard = shard
+        self.scope = scope
+        self.fetch_mode = fetch_mode
+        self.hierarchy_cache = hierarchy_cache
+        self.concurrency = concurrency
+        limits = dict(DEFAULT_LEVEL_LIMITS)
+        limits.update(level_limits or {})
+        self.global_limit = asyncio.Semaphore(concurrency)
+        self.level_limits = {level: asyncio.Semaphore(n) for level, n in limits.items()}
+        self.block_workers = limits["block"]
+        self.metrics_interval = metrics_interval
+        self.progress = None
+        self.session = None
+
+    # async version of final_code.run_query, shares one keep-alive connection pool and the rate limit
+    async def run_query(self, operation_name, query, variables):
+        payload = {
+            "operationName": operation_name,
+            "query": query,
+            "variables": variables
+        }
+        level = OPERATION_LEVELS[operation_name]
+        async with self.level_limits[level]:
+            async with self.global_limit:
+                return (await self.transport.post(self.session, payload))["data"]
+
+    # same as run_query but serves the state/district/block/village lookups from the hierarchy cache
+    async def run_hierarchy_query(self, operation_name, query, variables):
+        cache = self.hierarchy_cache
+        data = cache.get(operation_name, variables) if cache else None
+        if data is None:
+            data = await self.run_query(operation_name, query, variables)
+            if cache:
+                cache.put(operation_name, variables, data)
+        return data
+
+    # async version of final_code.scrape_block, returns the blocks that are now saved as (task, records, content_hash)
+    async def crawl_block(self, task):
+        cycle = task["cycle"]
+        state_id, state_name = task["state_id"], task["state_name"]
+        district_id, district_name = task["district_id"], task["district_name"]
+        block_id, block_name = task["block_id"], task["block_name"]
+
+        # If the block already exists, we skip it
+        existing_hash = None if self.incremental else self.writer.existing_hash(task)
+        if existing_hash:
+            logging.info(f"Skipping {cycle}/{state_name}/{district_name}/{block_name} - file already exists.")
+            return [(task, None, existing_hash)]
+
+        print(f"Processing Block: {cycle} / {state_name} / {district_name} / {block_name}")
+        flattener = BlockFlattener(cycle, state_name, district_name, block_name, self.schema)
+        # Rows go to the writer a batch of villages at a time, the block only becomes a finished file once every village is in
+        stream = await asyncio.to_thread(self.writer.open_block, task)
+        try:
+            await self.stream_block(task, flattener, stream)
+        except BaseException:
+            await asyncio.to_thread(stream.abort)
+            raise
+        saved = await asyncio.to_thread(stream.finish)
+        if stream.records == 0:
+            logging.info(f"No data found for {cycle}/{state_name}/{district_name}/{block_name}. Skipping.....")
+        return saved
+
+    # fetches the villages of a block concurrently and streams them, in village order, into the block's stream
+    async def stream_block(self, task, flattener, stream):
+        cycle = task["cycle"]
+        state_id, state_name = task["state_id"], task["state_name"]
+        district_id, district_name = task["district_id"], task["district_name"]
+        block_id, block_name = task["block_id"], task["block_name"]
+
+        villages = (await self.run_hierarchy_query(
+            "GetVillageBydistrict",
+            village_query,
+            {"state": state_id, "district": district_id, "block": block_id}
+        ))["getVillageBydistrict"]
+
+        village_responses, extra = [None] * len(villages), []
+        # In block mode one response answers for the whole block, villages missing from it have no samples.
+        # Only a failed block request falls back to asking the villages one by one
+        if self.fetch_mode == "block":
+            try:
+                block_data = (await self.run_query(
+                    "GetNutrientDashboardForPortal",
+                    nutrient_query,
+                    nutrient_variables(state_id, district_id, block_id, cycle)
+                ))["getNutrientDashboardForPortal"]
+            except Exception as e:
+                logging.warning(f"Block request failed for {cycle}/{state_name}/{district_name}/{block_name}, fetching its {len(villages)} villages one by one: {e}")
+            else:
+                village_responses, extra = split_by_village(block_data, villages)
+                logging.info(f"{village_responses.count(None)} of {len(villages)} villages have no data in the block response for {cycle}/{state_name}/{district_name}/{block_name}.")
+                village_responses = [items or [] for items in village_responses]
+
+        async def fetch_village(village, nutrient_data):
+            if nutrient_data is not None:
+                return nutrient_data
+            try:
+                return (await self.run_query(
+                    "GetNutrientDashboardForPortal",
+                    nutrient_query,
+                    nutrient_variables(state_id, district_id, block_id, cycle, village["_id"])
+                ))["getNutrientDashboardForPortal"]
+            except Exception as e:
+                # saving the block without this village would replace an earlier complete file, the block fails instead
+                logging.error(f"Village loop failed for {village.get('name', 'Unknown')} in {cycle}/{state_name}/{district_name}/{block_name}, failing the block: {e}")
+                raise
+
+        # Responses are flattened in village order so the output matches the sequential crawl. Each one
+        # is dropped once it is flattened, only responses that arrive ahead of their turn wait in memory
+        fetches = [
+            asyncio.ensure_future(fetch_village(village, nutrient_data))
+            for village, nutrient_data in zip(villages, village_responses)
+        ]
+        try:
+            for i in range(len(fetches)):
+                nutrient_data = await fetches[i]
+                fetches[i] = None
+                await self.stream_rows(stream, flattener.add(nutrient_data))
+        finally:
+            for fetch in fetches:
+                if fetch is None:
+                    continue
+                fetch.cancel()
+                # a fetch that already failed is not awaited any more, retrieving its error keeps asyncio quiet
+                if fetch.done() and not fetch.cancelled():
+                    fetch.exception()
+        await self.stream_rows(stream, flattener.add(extra))
+        await self.stream_rows(stream, flattener.flush())
+
+    # appends a flattened batch to the block's stream, off the event loop
+    async def stream_rows(self, stream, df):
+        if df is not None and not df.empty:
+            await asyncio.to_thread(stream.append, df)
+
+    # lists the blocks of a district as ledger tasks, returns None if the listing failed
+    async def list_district(self, cycle, state_id, state_name, district):
+        district_id = district["_id"]
+        district_name = clean_name(district.get("name", "Unknown"))
+        if not in_scope(self.scope, "district", district_id, district_name):
+            return []
+        try:
+            blocks = (await self.run_hierarchy_query(
+                "GetBlocks",
+                block_query,
+                {"state": state_id, "district": district_id}
+            ))["getBlocks"]
+        except Exception as e:
+            logging.error(f"District loop failed for {cycle}/{state_name}/{district_name}: {e}", exc_info=True)
+            return None
+        return [
+            {
+                "cycle": cycle,
+                "state_id": state_id,
+                "state_name": state_name,
+                "district_id": district_id,
+                "district_name": district_name,
+                "block_id": block["_id"],
+                "block_name": clean_name(block.get("name", "Unknown")),
+            }
+            for block in blocks
+            if in_scope(self.scope, "block", block["_id"], clean_name(block.get("name", "Unknown")))
+        ]
+
+    async def list_state(self, cycle, state):
+        state_id = state["_id"]
+        state_name = clean_name(state.get("name", "Unknown"))
+        if not in_scope(self.scope, "state", state_id, state_name):
+            return []
+        try:
+            districts = (await self.run_hierarchy_query(
+                "GetdistrictAndSubdistrictBystate",
+                district_query,
+                {"state": state_id}
+            ))["getdistrictAndSubdistrictBystate"]
+        except Exception as e:
+            logging.error(f"State loop failed for {cycle}/{state_name}: {e}", exc_info=True)
+            return [None]
+        return await asyncio.gather(*(
+            self.list_district(cycle, state_id, state_name, district)
+            for district in districts
+        ))
+
+    # async version of final_code.seed_tasks, lists all states and districts (in the scope) at once
+    async def seed_tasks(self, cycle):
+        print(f"Listing blocks for Cycle: {cycle}")
+        states = (await self.run_hierarchy_query("GetState", state_query, {}))["getState"]
+        listed = await asyncio.gather(*(self.list_state(cycle, state) for state in states))
+        district_tasks = [tasks for state_tasks in listed for tasks in state_tasks]
+        tasks = [task for tasks in district_tasks if tasks for task in tasks if in_shard(task, self.shard)]
+
+        added = self.ledger.add_tasks(tasks)
+        # a cycle whose listing had errors, or only covered part of it, is listed again on the next run to pick up the missing blocks
+        if None not in district_tasks and not is_partial(self.scope):
+            self.ledger.mark_seeded(cycle)
+        logging.info(f"Listed {len(tasks)} blocks for {cycle}, {added} new.")
+
+    # keeps pulling tasks from the ledger until none are left
+    async def block_worker(self, retry_only):
+        while True:
+            task = self.ledger.claim(retry_only=retry_only)
+            if task is None:
+                return
+            block_path = f"{task['cycle']}/{task['state_name']}/{task['district_name']}/{task['block_name']}"
+            start = time.monotonic()
+            try:
+                for done_task, records, content_hash in await self.crawl_block(task):
+                    self.progress.block_finished(done_task, self.ledger.mark_done(done_task, records, content_hash), records)
+                self.progress.block_timed(task, time.monotonic() - start)
+            except Exception as e:
+                # a block with every row rejected by validation would be rejected again, it fails on the first try
+                rejected = isinstance(e, ValidationError)
+                status = self.ledger.mark_failed(task, e, 1 if rejected else MAX_TRIES)
+                self.progress.block_finished(task, status)
+                if rejected:
+                    logging.error(f"Block rejected, skipping {block_path}: {e}")
+                elif status == "failed":
+                    logging.error(f"Block failed {MAX_TRIES} times, skipping {block_path}.")
+                else:
+                    logging.error(f"Block loop failed for {block_path}: {e}", exc_info=True)
+
+    # async version of final_code.probe_villages, the probes run concurrently within the block level limit
+    async def probe_villages(self, retry_only=False):
+        tasks = self.ledger.unprobed_tasks(retry_only)
+        print(f"Probing village counts of {len(tasks)} blocks.")
+
+        async def probe(task):
+            try:
+                villages = (await self.run_hierarchy_query(
+                    "GetVillageBydistrict",
+                    village_query,
+                    {"state": task["state_id"], "district": task["district_id"], "block": task["block_id"]}
+                ))["getVillageBydistrict"]
+                self.ledger.set_villages(task, len(villages))
+            except Exception as e:
+                logging.error(f"Village probe failed for {task['cycle']}/{task['state_name']}/{task['district_name']}/{task['block_name']}: {e}", exc_info=True)
+
+        await asyncio.gather(*(probe(task) for task in tasks))
+
+    async def crawl(self, cycles=CYCLES, refresh_hierarchy=False, retry_failed=False, max_age_days=MAX_AGE_DAYS, active_cycle=ACTIVE_CYCLE,
+                    probe=False, skip_empty_after=0, seed=True):
+        connector = aiohttp.TCPConnector(limit=self.concurrency, keepalive_timeout=60)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            self.session = session
+            for cycle in cycles:
+                try:
+                    # incremental runs always list again (from the cache until it expires) to pick up new blocks
+                    if seed and (refresh_hierarchy or self.incremental or not self.ledger.is_seeded(cycle)):
+                        await self.seed_tasks(cycle)
+                except Exception as e:
+                    logging.error(f"Cycle loop failed for {cycle}: {e}", exc_info=True)
+
+            if self.incremental:
+                logging.info(f"Refetching {self.ledger.requeue_stale(max_age_days, active_cycle)} stale or active-cycle blocks.")
+            if retry_failed:
+                logging.info(f"Retrying {self.ledger.requeue_failed()} failed blocks.")
+            # blocks expected to have the most records are crawled first, known empty ones last
+            if probe:
+                await self.probe_villages(retry_failed)
+            prioritise(self.ledger, skip_empty_after)
+            label = f"Shard {self.shard[0]}/{self.shard[1]} tasks" if self.shard is not None else "Tasks"
+            summary = self.ledger.summary()
+            print(f"{label}: {summary}")
+            if self.scope and not any(summary.values()):
+                print(f"No blocks in the ledger match {self.scope}, check the names (or run a crawl first when resuming).")
+            self.progress = CrawlProgress(METRICS, self.ledger.remaining_by_state(retry_only=retry_failed))
+            reporter = MetricsReporter(shard_file(METRICS_FILE, self.shard), self.metrics_interval, METRICS, self.progress).start()
+
+            # one worker per block that may be in flight at the same time
+            await asyncio.gather(*(self.block_worker(retry_failed) for _ in range(self.block_workers)))
+            for done_task, records, content_hash in await asyncio.to_thread(self.writer.close):
+                self.progress.block_finished(done_task, self.ledger.mark_done(done_task, records, content_hash), records)
+            reporter.stop()
+            print(f"{label}: {self.ledger.summary()}")
+        self.session = None
+
+
+def main(concurrency=DEFAULT_CONCURRENCY, level_limits=None, refresh_hierarchy=False, hierarchy_ttl_days=HIERARCHY_TTL_DAYS, fetch_mode="village", retry_failed=False, shard=None, transport_options=None,
+         incremental=False, max_age_days=MAX_AGE_DAYS, active_cycle=ACTIVE_CYCLE, output_format="csv", metrics_interval=METRICS_INTERVAL,
+         response_cache=None, probe=False, skip_empty_after=0, validation=True, scope=None, seed=True, log_file=LOG_FILE):
+    # a shard works on its own part of the blocks, with its own ledger and log
+    setup_logging(shard_file(log_file, shard))
+    if shard is not None:
+        logging.info(f"Running shard {shard[0]}/{shard[1]}")
+
+    # creates the data directory
+    data_dir = Path.cwd()/"data"/"raw"
+    os.makedirs(data_dir, exist_ok=True)
+    cache = HierarchyCache(HIERARCHY_CACHE_FILE, ttl_days=hierarchy_ttl_days, refresh=refresh_hierarchy)
+    ledger = TaskLedger(shard_file(LEDGER_FILE, shard), scope)
+    ledger.release_dead_workers()
+
+    transport = build_transport(AsyncTransport, BASE_URL, HEADERS, **(transport_options or {}))
+    if response_cache is not None:
+        transport = AsyncCachingTransport(transport, ResponseCache(**response_cache))
+    schema = NutrientSchema(NUTRIENT_SCHEMA_FILE)
+    crawler = AsyncCrawler(
+        data_dir, ledger, concurrency=concurrency, level_limits=level_limits, hierarchy_cache=cache,
+        fetch_mode=fetch_mode, shard=shard, transport=transport, incremental=incremental,
+        writer=make_writer(output_format, data_dir, schema, VillageValidator() if validation else None), schema=schema, metrics_interval=metrics_interval,
+        scope=scope,
+    )
+    asyncio.run(crawler.crawl(
+        refresh_hierarchy=refresh_hierarchy, retry_failed=retry_failed,
+        max_age_days=max_age_days, active_cycle=active_cycle,
+        cycles=(scope or {}).get("cycles") or CYCLES, probe=probe, skip_empty_after=skip_empty_after, seed=seed,
+    ))
+    ledger.close()
+    cache.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Concurrent crawl of the Soil Health GraphQL API")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY, help="maximum requests in flight overall")
+    for level, limit in DEFAULT_LEVEL_LIMITS.items():
+        parser.add_argument(f"--{level}-limit", type=int, default=limit, help=f"maximum {level}-level requests in flight")
+    add_crawl_args(parser)
+    args = parser.parse_args()
+
+    try:
+        main(
+            concurrency=args.concurrency,
+            level_limits={level: getattr(args, f"{level}_limit") for level in DEFAULT_LEVEL_LIMITS},
+            **crawl_options(args),
+        )
+    except Exception as e:
+        logging.error(f"An error occurred: {e}", exc_info=True)
+        print(f"An error occurred: {e}")
@@ -0,0 +1,150 @@
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import resource
+import tempfile
+import multiprocessing
+
+from fake_api import FakeSoilHealthAPI, SyntheticData, SCALES
+
+# high enough that the rate limiter does not decide the result, lower it to benchmark the limiter itself
+BENCH_RATE = 1000.0
+BENCH_TIMEOUT = 3600
+
+# crawl mode: (module, options of its main)
+MODES = {
+    "sync": ("final_code", {"fetch_mode": "village"}),
+    "sync-block": ("final_code", {"fetch_mode": "block"}),
+    "async": ("async_crawler", {"fetch_mode": "village"}),
+    "async-block": ("async_crawler", {"fetch_mode": "block"}),
+    "sharded-block": ("sharding", {"fetch_mode": "block", "workers": 4}),
+    "parquet-async-block": ("async_crawler", {"fetch_mode": "block", "output_format": "parquet"}),
+    # a targeted re-scrape of one district, only its blocks are listed and fetched
+    "district-block": ("final_code", {"fetch_mode": "block", "scope": {"state": "s0", "district": "s0d0"}}),
+}
+
+
+# runs one crawl in a fresh process (spawned, so the crawler modules read SOIL_HEALTH_URL on import)
+# in its own working directory and reports the time, ledger summary and peak RSS
+def run_mode(mode, url, work_dir, rate, verbose, results):
+    os.environ["SOIL_HEALTH_URL"] = url
+    os.chdir(work_dir)
+    if not verbose:
+        sys.stdout = open(os.devnull, "w")
+    module_name, options = MODES[mode]
+    options = dict(options)
+    transport = {"rate": rate, "max_rate": rate}
+
+    start = time.monotonic()
+    if module_name == "sharding":
+        import final_code
+        import sharding
+
+        workers = options.pop("workers")
+        sharding.seed_shards(workers)
+        sharding.run_workers(final_code.main, workers, transport_options=transport, **options)
+        sharding.merge_shards(workers)
+    else:
+        module = __import__(module_name)
+        module.main(transport_options=transport, **options)
+    elapsed = time.monotonic() - start
+
+    from task_ledger import TaskLedger, LEDGER_FILE
+    ledger = TaskLedger(LEDGER_FILE)
+    summary = ledger.summary()
+    ledger.close()
+    # ru_maxrss is in KiB on Linux, shard workers are children
+    peak_kib = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    results.put({"elapsed": elapsed, "summary": summary, "peak_rss_mb": peak_kib / 1024})
+
+
+def bench_mode(api, url, mode, rate=BENCH_RATE, verbose=False, keep=False):
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    work_dir = tempfile.mkdtemp(prefix=f"bench_{mode}_")
+    api.reset_stats()
+    process = context.Process(target=run_mode, args=(mode, url, work_dir, rate, verbose, results))
+    process.start()
+    try:
+        result = results.get(timeout=BENCH_TIMEOUT)
+    finally:
+        process.join(timeout=60)
+        if not keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    stats = api.stats()
+    summary = result["summary"]
+    blocks = summary["done"] + summary["empty"]
+    return {
+        "mode": mode,
+        "blocks": blocks,
+        "failed": summary["failed"],
+        "seconds": round(result["elapsed"], 2),
+        "blocks_per_min": round(blocks / result["elapsed"] * 60, 1) if result["elapsed"] else None,
+        "peak_rss_mb": round(result["peak_rss_mb"], 1),
+        "requests": sum(stats["requests"].values()),
+        "requests_by_operation": stats["requests"],
+        "bytes": sum(stats["bytes"].values()),
+        "injected_errors": stats["errors"],
+        "work_dir": work_dir if keep else None,
+    }
+
+
+def print_report(rows):
+    print(f"{'mode':<22}{'blocks':>8}{'failed':>8}{'seconds':>10}{'blocks/min':>12}{'peak MB':>10}{'requests':>10}{'MB sent':>10}")
+    for row in rows:
+        print(f"{row['mode']:<22}{row['blocks']:>8}{row['failed']:>8}{row['seconds']:>10}{row['blocks_per_min']:>12}"
+              f"{row['peak_rss_mb']:>10}{row['requests']:>10}{row['bytes'] / 1e6:>10.1f}")
+    for row in rows:
+        print(f"{row['mode']} requests: {row['requests_by_operation']}")
+
+
+# command line options, shared with cli.py
+def add_bench_args(parser):
+    parser.add_argument("--modes", nargs="+", choices=list(MODES), default=["sync", "sync-block", "async", "async-block"])
+    parser.add_argument("--scale", choices=list(SCALES), default="small", help="size of the synthetic hierarchy")
+    parser.add_argument("--sampled-every", type=int, default=1, help="only every n-th village of a block has data")
+    parser.add_argument("--recordings", help="jsonl file with recorded responses to serve first")
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds added to every response")
+    parser.add_argument("--jitter", type=float, default=0.01, help="random +/- seconds on top of the latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with 429/503")
+    parser.add_argument("--rate", type=float, default=BENCH_RATE, help="request rate given to the crawlers")
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--keep", action="store_true", help="keep the working directories with the crawled data")
+    parser.add_argument("--verbose", action="store_true", help="show the crawlers' own output")
+
+
+# starts the fake API, runs every mode against it and prints (and optionally saves) the report
+def run_bench(args):
+    api = FakeSoilHealthAPI(SyntheticData(args.scale, sampled_every=args.sampled_every), args.recordings, args.latency, args.jitter, args.error_rate)
+    url = api.start()
+    # also set here, a spawned child that re-imports a main module importing final_code (cli.py) reads it before run_mode
+    os.environ["SOIL_HEALTH_URL"] = url
+    print(f"Fake API on {url}: {api.data.total_blocks()} blocks per cycle, latency {args.latency}s, error rate {args.error_rate}")
+
+    rows = []
+    try:
+        for mode in args.modes:
+            print(f"Running {mode}...")
+            rows.append(bench_mode(api, url, mode, rate=args.rate, verbose=args.verbose, keep=args.keep))
+    finally:
+        api.stop()
+
+    print_report(rows)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(rows, f, indent=2)
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the crawlers against a local fake Soil Health API")
+    add_bench_args(parser)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    run_bench(args)
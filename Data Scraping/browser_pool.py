@@ -0,0 +1,170 @@
+import os
+import queue
+import shutil
+import logging
+import argparse
+import multiprocessing
+from collections import deque
+
+from practice import SoilHealthScraper, CYCLES, setup_logging
+from task_ledger import in_scope, add_scope_args, scope_options
+
+DEFAULT_WORKERS = 4
+MAX_TRIES = 3
+# every worker downloads into its own sub folder, so exports of different workers never mix
+POOL_DOWNLOAD_DIR = os.path.abspath("downloads_pool")
+
+# Tasks are tuples: ("cycle", cycle), ("state", cycle, state), ("district", cycle, state, district)
+# list the next level and produce new tasks, ("block", cycle, state, district, block) exports a block
+
+
+def worker_download_dir(worker_id):
+    return os.path.join(POOL_DOWNLOAD_DIR, f"worker{worker_id}")
+
+
+# True if a listed task is inside the scope, the dashboard only shows names so they stand in for the ids
+def task_in_scope(scope, task):
+    kind, cycle, *names = task
+    levels = ["state", "district", "block"][:len(names)]
+    return all(in_scope(scope, level, name, name) for level, name in zip(levels, names))
+
+
+# runs one task, returns (ok, new tasks)
+def run_task(scraper, task):
+    kind, cycle, *names = task
+    if kind == "cycle":
+        return True, [("state", cycle, state) for state in scraper.list_states(cycle)]
+    if kind == "state":
+        return True, [("district", cycle, *names, district) for district in scraper.list_districts(cycle, *names)]
+    if kind == "district":
+        return True, [("block", cycle, *names, block) for block in scraper.list_blocks(cycle, *names)]
+    return scraper.download_block(cycle, *names), []
+
+
+# worker process: one headless Chrome that runs the tasks sent to its inbox until it gets None.
+# A crashed browser is replaced before the next task, any other failure reloads the dashboard
+def browser_worker(worker_id, inbox, results):
+    download_dir = worker_download_dir(worker_id)
+    os.makedirs(download_dir, exist_ok=True)
+    scraper = None
+    while (task := inbox.get()) is not None:
+        try:
+            if scraper is None:
+                scraper = SoilHealthScraper(download_dir, headless=True)
+                scraper.open_dashboard()
+            ok, new_tasks = run_task(scraper, task)
+        except Exception as e:
+            logging.error(f"Worker {worker_id} failed on {task}: {e}", exc_info=True)
+            ok, new_tasks = False, []
+        if not ok and scraper is not None:
+            try:
+                if not scraper.is_alive():
+                    raise RuntimeError("browser not responding")
+                scraper.open_dashboard()
+            except Exception as e:
+                logging.warning(f"Restarting the browser of worker {worker_id}: {e}")
+                scraper.quit()
+                scraper = None
+        results.put((worker_id, task, ok, new_tasks))
+
+    if scraper is not None:
+        scraper.waiter.log_summary()
+        scraper.quit()
+    shutil.rmtree(download_dir, ignore_errors=True)
+
+
+# Hands tasks to idle workers one at a time, so it always knows which task each worker holds.
+# A worker process that dies is restarted and its task retried (up to max_tries like any failed task).
+# With a scope, listed states, districts and blocks outside it are dropped before they are queued
+def run_pool(workers=DEFAULT_WORKERS, cycles=CYCLES, max_tries=MAX_TRIES, scope=None):
+    results = multiprocessing.Queue()
+    inboxes = {}
+    processes = {}
+
+    def start_worker(worker_id):
+        inboxes[worker_id] = multiprocessing.Queue()
+        processes[worker_id] = multiprocessing.Process(target=browser_worker, args=(worker_id, inboxes[worker_id], results), daemon=True)
+        processes[worker_id].start()
+
+    pending = deque(("cycle", cycle) for cycle in (scope or {}).get("cycles") or cycles)
+    attempts = {}
+    assigned = {}
+    idle = set(range(workers))
+    counts = {"blocks": 0, "listed": 0, "failed": 0}
+    failed = []
+
+    def task_failed(task):
+        attempts[task] = attempts.get(task, 0) + 1
+        if attempts[task] < max_tries:
+            pending.append(task)
+        else:
+            counts["failed"] += 1
+            failed.append(task)
+            logging.error(f"Giving up on {task} after {attempts[task]} attempts.")
+
+    for worker_id in range(workers):
+        start_worker(worker_id)
+    try:
+        while pending or assigned:
+            while pending and idle:
+                worker_id = idle.pop()
+                assigned[worker_id] = pending.popleft()
+                inboxes[worker_id].put(assigned[worker_id])
+
+            try:
+                worker_id, task, ok, new_tasks = results.get(timeout=1)
+            except queue.Empty:
+                for worker_id, process in processes.items():
+                    if not process.is_alive():
+                        logging.warning(f"Worker {worker_id} died (exit code {process.exitcode}), starting a new one.")
+                        start_worker(worker_id)
+                        if worker_id in assigned:
+                            task_failed(assigned.pop(worker_id))
+                        idle.add(worker_id)
+                continue
+
+            # a result of a worker that was already given up as dead
+            if assigned.get(worker_id) != task:
+                continue
+            del assigned[worker_id]
+            idle.add(worker_id)
+            if not ok:
+                task_failed(task)
+                continue
+            new_tasks = [t for t in new_tasks if task_in_scope(scope, t)]
+            # blocks go first, so exports start while other workers are still listing
+            pending.extendleft(reversed([t for t in new_tasks if t[0] == "block"]))
+            pending.extend(t for t in new_tasks if t[0] != "block")
+            if task[0] == "block":
+                counts["blocks"] += 1
+                print(f"Exported {counts['blocks']} blocks, {len(pending)} tasks queued, {counts['failed']} failed.")
+            else:
+                counts["listed"] += 1
+    finally:
+        for worker_id, process in processes.items():
+            if process.is_alive():
+                inboxes[worker_id].put(None)
+        for process in processes.values():
+            process.join(timeout=60)
+            if process.is_alive():
+                process.terminate()
+
+    print(f"Browser pool finished: {counts['blocks']} blocks exported, {counts['listed']} lists read, {counts['failed']} tasks failed.")
+    for task in failed:
+        logging.error(f"Failed task: {task}")
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the dashboard csvs with a pool of headless browsers")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="number of headless Chrome workers")
+    parser.add_argument("--max-tries", type=int, default=MAX_TRIES, help="attempts per task before giving up")
+    add_scope_args(parser)
+    args = parser.parse_args()
+
+    setup_logging()
+    try:
+        run_pool(workers=args.workers, max_tries=args.max_tries, scope=scope_options(args))
+    except Exception as e:
+        logging.error(f"An error occurred: {e}", exc_info=True)
+        print(f"An error occurred: {e}")
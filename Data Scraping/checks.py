@@ -0,0 +1,229 @@
+import os
+import sys
+import glob
+import shutil
+import sqlite3
+import logging
+import argparse
+import tempfile
+import multiprocessing
+
+from fake_api import FakeSoilHealthAPI, SyntheticData
+
+# Scenario checks of whole crawls against the local fake API (see bench.py), each in its own working directory.
+# Every check returns a list of problems, empty when it passes. Only every other village has samples, like the real API
+CHECK_TIMEOUT = 600
+# one district of one cycle keeps the checks to a few seconds
+CHECK_SCOPE = {"cycles": ["2024-25"], "state": "s0", "district": "s0d0"}
+CRAWLERS = ["final_code", "async_crawler"]
+
+
+# runs one crawl in a fresh process (spawned, so the crawler reads SOIL_HEALTH_URL on import)
+def run_crawl(crawler, url, work_dir, options):
+    os.environ["SOIL_HEALTH_URL"] = url
+    os.chdir(work_dir)
+    sys.stdout = open(os.devnull, "w")
+    options.setdefault("scope", CHECK_SCOPE)
+    options["transport_options"] = {"rate": 1000.0, "max_rate": 1000.0, **options.get("transport_options", {})}
+    __import__(crawler).main(**options)
+
+
+def crawl(crawler, url, work_dir, **options):
+    context = multiprocessing.get_context("spawn")
+    process = context.Process(target=run_crawl, args=(crawler, url, work_dir, options))
+    process.start()
+    process.join(timeout=CHECK_TIMEOUT)
+    if process.exitcode != 0:
+        raise RuntimeError(f"{crawler} exited with {process.exitcode}")
+
+
+def csv_rows(path):
+    with open(path) as f:
+        return sum(1 for _ in f) - 1
+
+
+# --replay-only with part of the nutrient responses missing from the cache: the blocks missing a village
+# must fail and keep their earlier file, not be saved again without that village
+def check_replay_miss(crawler, api, url, work_dir):
+    from task_ledger import TaskLedger, LEDGER_FILE
+    from response_cache import RESPONSE_CACHE_FILE
+
+    crawl(crawler, url, work_dir, response_cache={})
+    files = sorted(glob.glob(os.path.join(work_dir, "data", "raw", "**", "*.csv"), recursive=True))
+    rows_before = {path: csv_rows(path) for path in files}
+
+    conn = sqlite3.connect(os.path.join(work_dir, RESPONSE_CACHE_FILE))
+    removed = conn.execute("""
+        SELECT key, json_extract(variables, '$.block') FROM responses
+        WHERE operation = 'GetNutrientDashboardForPortal' AND json_extract(variables, '$.village') IS NOT NULL LIMIT 2
+    """).fetchall()
+    conn.executemany("DELETE FROM responses WHERE key = ?", [(key,) for key, _ in removed])
+    conn.commit()
+    conn.close()
+    missing_blocks = {block for _, block in removed}
+
+    crawl(crawler, url, work_dir, response_cache={"replay_only": True}, incremental=True, max_age_days=0)
+    problems = []
+    ledger = TaskLedger(os.path.join(work_dir, LEDGER_FILE))
+    for task in ledger.all_tasks():
+        expected = "failed" if task["block_id"] in missing_blocks else "done"
+        if task["status"] != expected:
+            problems.append(f"{task['block_name']} is {task['status']} with {task['records']} records, expected {expected}")
+    ledger.close()
+    for path, rows in rows_before.items():
+        if not os.path.exists(path) or csv_rows(path) != rows:
+            problems.append(f"{os.path.relpath(path, work_dir)} changed, it had {rows} rows")
+    if glob.glob(os.path.join(work_dir, "data", "raw", "**", "*.part"), recursive=True):
+        problems.append("part files were left behind")
+    if not files or not missing_blocks:
+        problems.append("the first crawl saved nothing to check against")
+    return problems
+
+
+# a village that keeps failing on an incremental run fails its block, the complete file from before stays
+def check_failed_village(crawler, api, url, work_dir):
+    from task_ledger import TaskLedger, LEDGER_FILE
+
+    crawl(crawler, url, work_dir)
+    files = sorted(glob.glob(os.path.join(work_dir, "data", "raw", "**", "*.csv"), recursive=True))
+    before = {path: open(path, "rb").read() for path in files}
+    api.failing_villages = {"s0d0b1v2"}
+    try:
+        crawl(crawler, url, work_dir, incremental=True, max_age_days=0, transport_options={"max_retries": 1})
+    finally:
+        api.failing_villages = set()
+    problems = []
+    ledger = TaskLedger(os.path.join(work_dir, LEDGER_FILE))
+    for task in ledger.all_tasks():
+        expected = "failed" if task["block_id"] == "s0d0b1" else "done"
+        if task["status"] != expected:
+            problems.append(f"{task['block_name']} is {task['status']} with {task['records']} records, expected {expected}")
+    ledger.close()
+    for path, content in before.items():
+        if not os.path.exists(path) or open(path, "rb").read() != content:
+            problems.append(f"{os.path.relpath(path, work_dir)} changed")
+    if not files:
+        problems.append("the first crawl saved nothing to check against")
+    return problems
+
+
+# a block whose rows are all rejected by validation fails on its first try, its rows go to the rejects file once
+def check_rejected_block(crawler, api, url, work_dir):
+    from task_ledger import TaskLedger, LEDGER_FILE
+    from validate import REJECTS_FILE
+
+    api.data.invalid_blocks = {"s0d0b1"}
+    try:
+        crawl(crawler, url, work_dir, fetch_mode="block")
+    finally:
+        api.data.invalid_blocks = set()
+    problems = []
+    ledger = TaskLedger(os.path.join(work_dir, LEDGER_FILE))
+    for task in ledger.all_tasks():
+        expected = "failed" if task["block_id"] == "s0d0b1" else "done"
+        if task["status"] != expected:
+            problems.append(f"{task['block_name']} is {task['status']}, expected {expected}")
+    ledger.close()
+    rejects_path = os.path.join(work_dir, REJECTS_FILE)
+    rejected = csv_rows(rejects_path) if os.path.exists(rejects_path) else 0
+    sampled = len(api.data.villages_of("s0d0b1")[::api.data.sampled_every])
+    if rejected != sampled:
+        problems.append(f"{rejected} rows in the rejects file, the block has {sampled} villages with samples")
+    return problems
+
+
+# a scope written in another case than the API's ids must claim the same blocks it listed
+def check_scope_case(crawler, api, url, work_dir):
+    from task_ledger import TaskLedger, LEDGER_FILE
+
+    scope = {key: value.upper() if isinstance(value, str) else value for key, value in CHECK_SCOPE.items()}
+    crawl(crawler, url, work_dir, scope=scope)
+    ledger = TaskLedger(os.path.join(work_dir, LEDGER_FILE))
+    tasks = ledger.all_tasks()
+    ledger.close()
+    problems = [f"{task['block_name']} is {task['status']}" for task in tasks if task["status"] != "done"]
+    if not tasks:
+        problems.append(f"no blocks were listed for {scope}")
+    return problems
+
+
+# block mode asks once per block, villages without samples are not asked for again one by one
+def check_block_requests(crawler, api, url, work_dir):
+    from task_ledger import TaskLedger, LEDGER_FILE
+
+    api.reset_stats()
+    crawl(crawler, url, work_dir, fetch_mode="block")
+    requests = api.stats()["requests"].get("GetNutrientDashboardForPortal", 0)
+    ledger = TaskLedger(os.path.join(work_dir, LEDGER_FILE))
+    blocks = len(ledger.all_tasks())
+    ledger.close()
+    problems = [] if requests == blocks else [f"{requests} nutrient requests for {blocks} blocks"]
+    if not blocks:
+        problems.append("no blocks were listed")
+    return problems
+
+
+# parquet: re-fetched blocks whose data changed replace their rows, no village is in the dataset twice
+def check_parquet_refetch(crawler, api, url, work_dir):
+    import pandas as pd
+
+    dataset = os.path.join(work_dir, "data", "parquet")
+    crawl(crawler, url, work_dir, output_format="parquet")
+    rows_before = len(pd.read_parquet(dataset, columns=["village_id"])) if os.path.isdir(dataset) else 0
+    api.data.seed += 1
+    try:
+        crawl(crawler, url, work_dir, output_format="parquet", incremental=True, max_age_days=0)
+    finally:
+        api.data.seed -= 1
+    df = pd.read_parquet(dataset, columns=["block", "village_id"])
+    problems = []
+    if len(df) != rows_before:
+        problems.append(f"{len(df)} rows after the re-fetch, {rows_before} before")
+    duplicated = df.duplicated(["block", "village_id"]).sum()
+    if duplicated:
+        problems.append(f"{duplicated} villages are in the dataset more than once")
+    if not rows_before:
+        problems.append("the first crawl saved nothing to check against")
+    return problems
+
+
+CHECKS = {
+    "replay-miss": check_replay_miss,
+    "failed-village": check_failed_village,
+    "rejected-block": check_rejected_block,
+    "scope-case": check_scope_case,
+    "block-requests": check_block_requests,
+    "parquet-refetch": check_parquet_refetch,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run scenario checks of the crawlers against a local fake Soil Health API")
+    parser.add_argument("--checks", nargs="+", choices=list(CHECKS), default=list(CHECKS))
+    parser.add_argument("--crawlers", nargs="+", choices=CRAWLERS, default=CRAWLERS)
+    parser.add_argument("--keep", action="store_true", help="keep the working directories")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    api = FakeSoilHealthAPI(SyntheticData("small", sampled_every=2))
+    url = api.start()
+    failed = 0
+    try:
+        for name in args.checks:
+            for crawler in args.crawlers:
+                work_dir = tempfile.mkdtemp(prefix=f"check_{name}_")
+                try:
+                    problems = CHECKS[name](crawler, api, url, work_dir)
+                except Exception as e:
+                    logging.error(f"Check {name} with {crawler} crashed: {e}", exc_info=True)
+                    problems = [f"crashed: {e}"]
+                finally:
+                    if not args.keep:
+                        shutil.rmtree(work_dir, ignore_errors=True)
+                failed += bool(problems)
+                print(f"{'FAIL' if problems else 'ok'}  {name} ({crawler})")
+                for problem in problems:
+                    print(f"      {problem}")
+    finally:
+        api.stop()
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,87 @@
+import logging
+import argparse
+
+from final_code import add_crawl_args, crawl_options
+from consolidate import add_consolidate_args
+from bench import add_bench_args
+
+# One entry point for the crawlers, consolidation and the benchmark:
+#   python cli.py crawl --state "Karnataka" --district "Mysuru"
+#   python cli.py resume --async
+#   python cli.py consolidate
+#   python cli.py bench --modes sync district-block
+# Building the parser only loads the small option helpers. The crawler, aiohttp, pandas and selenium are
+# imported by the subcommand that needs them, so a scoped re-scrape starts without paying for the rest
+
+
+# options of crawl and resume: which crawler to run, then the crawl options every crawler takes (final_code.add_crawl_args)
+def add_crawl_command_args(parser):
+    parser.add_argument("--async", dest="use_async", action="store_true", help="use the async crawler (async_crawler.py)")
+    parser.add_argument("--concurrency", type=int, help="with --async, maximum requests in flight overall")
+    parser.add_argument("--hybrid", action="store_true", help="first get a session from the dashboard in Chrome (hybrid.py)")
+    parser.add_argument("--show-browser", action="store_true", help="with --hybrid, run Chrome with a window instead of headless")
+    add_crawl_args(parser)
+
+
+# crawl lists the blocks in scope into the ledger first, resume (seed=False) only works through what is already there
+def run_crawl(args, seed=True):
+    options = crawl_options(args)
+    options["seed"] = seed
+    if args.hybrid:
+        import hybrid
+        hybrid.main(headless=not args.show_browser, **options)
+    elif args.use_async:
+        import async_crawler
+        if args.concurrency:
+            options["concurrency"] = args.concurrency
+        async_crawler.main(**options)
+    else:
+        import final_code
+        final_code.main(**options)
+
+
+def run_consolidate(args):
+    import consolidate
+    consolidate.setup_logging()
+    consolidate.consolidate(data_dir=args.data_dir, output=args.output, workers=args.workers, full=args.full)
+
+
+def run_bench(args):
+    import bench
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    bench.run_bench(args)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Crawl, consolidate and benchmark the Soil Health data")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    crawl = commands.add_parser("crawl", help="list the blocks in scope and crawl them")
+    add_crawl_command_args(crawl)
+    crawl.set_defaults(handler=run_crawl)
+
+    resume = commands.add_parser("resume", help="crawl the pending blocks already in the ledger, without listing again")
+    add_crawl_command_args(resume)
+    resume.set_defaults(handler=lambda args: run_crawl(args, seed=False))
+
+    consolidate = commands.add_parser("consolidate", help="merge the raw block files into one SQLite dataset")
+    add_consolidate_args(consolidate)
+    consolidate.set_defaults(handler=run_consolidate)
+
+    bench = commands.add_parser("bench", help="benchmark the crawlers against a local fake API")
+    add_bench_args(bench)
+    bench.set_defaults(handler=run_bench)
+    return parser
+
+
+if __name__ == "__main__":
+    parser = build_parser()
+    args = parser.parse_args()
+    if args.command in ("crawl", "resume") and args.hybrid and args.use_async:
+        parser.error("--hybrid crawls with final_code.py, it cannot be combined with --async")
+
+    try:
+        args.handler(args)
+    except Exception as e:
+        logging.error(f"An error occurred: {e}", exc_info=True)
+        print(f"An error occurred: {e}")
@@ -0,0 +1,302 @@
+import os
+import re
+import time
+import sqlite3
+import logging
+import argparse
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+DATA_DIR = os.path.join("data", "raw")
+CONSOLIDATED_FILE = os.path.join("data", "consolidated.db")
+LOG_FILE = "consolidate.log"
+DEFAULT_WORKERS = os.cpu_count() or 4
+# blocks read but not yet written per worker, keeps memory bounded however many files there are
+BLOCKS_PER_WORKER = 4
+
+# a village is keyed on its id from the API, dashboard exports have no ids and use the normalised name instead
+KEY_COLUMNS = ["cycle", "state", "district", "block", "village_id"]
+# columns of a consolidated row that are not nutrient values
+ROW_COLUMNS = ["cycle", "state", "district", "block", "village", "village_id"]
+# dashboard exports from practice.py come as {block}_macro.csv and {block}_micro.csv
+PART_SUFFIXES = ("_macro", "_micro")
+VILLAGE_COLUMNS = ("village", "village_name")
+# columns of the raw files that are neither a key nor a nutrient value
+SKIP_COLUMNS = {"cycle", "state", "state_name", "district", "district_name", "block", "block_name",
+                "sub_district", "s_no", "sl_no", "sr_no", "village_id"}
+
+
+# the same place can be written differently by the API and the dashboard ("Block 1" vs "BLOCK  1")
+def normalise_name(name):
+    return re.sub(r"\s+", " ", str(name)).strip().upper()
+
+
+# "N High (%)" -> "n_high", "Zn (ppm)" -> "zn": lower case, units dropped, one underscore between words
+def normalise_column(column):
+    column = re.sub(r"\((%|ppm|[^)]*/[^)]*)\)|%", "", str(column))
+    return re.sub(r"[^0-9a-z]+", "_", column.lower()).strip("_")
+
+
+# values such as "1,234" or "45 %" become 1234.0 and 45.0, anything else that is not a number becomes NaN
+def to_number(series):
+    import pandas as pd
+
+    if not pd.api.types.is_numeric_dtype(series):
+        series = series.str.replace(r"[,%\s]", "", regex=True)
+    return pd.to_numeric(series, errors="coerce").astype("float64")
+
+
+# groups the raw csvs by block: {block}.csv from the API crawlers, {block}_macro/_micro.csv from practice.py.
+# yields ((cycle, state, district, block), [paths])
+def block_groups(data_dir):
+    for cycle in sorted(os.listdir(data_dir)):
+        cycle_dir = os.path.join(data_dir, cycle)
+        if not os.path.isdir(cycle_dir):
+            continue
+        for state in sorted(os.listdir(cycle_dir)):
+            state_dir = os.path.join(cycle_dir, state)
+            if not os.path.isdir(state_dir):
+                continue
+            for district in sorted(os.listdir(state_dir)):
+                district_dir = os.path.join(state_dir, district)
+                if not os.path.isdir(district_dir):
+                    continue
+                groups = {}
+                for filename in sorted(os.listdir(district_dir)):
+                    stem, ext = os.path.splitext(filename)
+                    if ext.lower() != ".csv":
+                        continue
+                    for suffix in PART_SUFFIXES:
+                        if stem.endswith(suffix):
+                            stem = stem[:-len(suffix)]
+                    # the API crawlers write spaces in block names as underscores
+                    block = normalise_name(stem.replace("_", " "))
+                    groups.setdefault(block, []).append(os.path.join(district_dir, filename))
+                for block, paths in groups.items():
+                    yield (cycle.strip(), normalise_name(state), normalise_name(district), block), paths
+
+
+def file_stat(path):
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+# reads one raw csv into a frame indexed by village_id (the name when the file has no ids) with the village
+# name and numeric nutrient columns
+def read_raw_file(path):
+    # pandas is loaded by the worker processes that read the files, not by the command line
+    import pandas as pd
+
+    df = pd.read_csv(path, dtype=str)
+    df.columns = [normalise_column(col) for col in df.columns]
+    df = df.loc[:, ~df.columns.duplicated()]
+    village_column = next((col for col in VILLAGE_COLUMNS if col in df.columns), None)
+    if village_column is None:
+        logging.warning(f"No village column in {path}, file skipped.")
+        return None
+
+    villages = df[village_column].map(normalise_name, na_action="ignore")
+    village_ids = df["village_id"].str.strip() if "village_id" in df.columns else pd.Series(None, index=df.index, dtype=object)
+    village_ids = village_ids.where(village_ids.notna() & (village_ids != ""), villages)
+    values = {}
+    for col in df.columns:
+        if col in SKIP_COLUMNS or col in VILLAGE_COLUMNS:
+            continue
+        numbers = to_number(df[col])
+        if numbers.isna().all() and df[col].notna().any():
+            logging.info(f"Column {col} of {path} is not numeric, dropped.")
+            continue
+        values[col] = numbers
+    df = pd.DataFrame(values, index=df.index)
+    df["village"] = villages
+    df["village_id"] = village_ids
+    # a re-downloaded file may list a village twice, the last row wins. Villages that only share a name are kept
+    return df.dropna(subset=["village"]).drop_duplicates("village_id", keep="last").set_index("village_id")
+
+
+# runs in a worker process: joins the files of a block (macro and micro) on the village id. Rows of a
+# dashboard export (keyed on the name) join the API rows of the same block when exactly one of them has that name
+def read_block(key, paths):
+    frames = [df for df in (read_raw_file(path) for path in paths) if df is not None]
+    if not frames:
+        return key, paths, None
+    ids_by_name = {}
+    for df in frames:
+        for village_id, name in df["village"].items():
+            if village_id != name:
+                ids_by_name.setdefault(name, set()).add(village_id)
+    merged = None
+    for df in frames:
+        df = df.rename(index=lambda village_id: next(iter(ids_by_name[village_id])) if len(ids_by_name.get(village_id, ())) == 1 else village_id)
+        merged = df if merged is None else merged.combine_first(df)
+    merged = merged.reset_index()
+    for position, (col, value) in enumerate(zip(KEY_COLUMNS[:4], key)):
+        merged.insert(position, col, value)
+    return key, paths, merged
+
+
+# One SQLite table with a row per (cycle, state, district, block, village_id) and a REAL column per nutrient,
+# plus the list of raw files already consolidated so that later runs only read new or changed files
+class ConsolidatedStore:
+    def __init__(self, path=CONSOLIDATED_FILE):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        # files consolidated before villages were keyed on their id are all read again
+        existing = {row[1] for row in self.conn.execute("PRAGMA table_info(soil_health)")}
+        if existing and "village_id" not in existing:
+            logging.warning(f"{path} keys villages on their name, rebuilding it keyed on village_id.")
+            self.conn.execute("DROP TABLE soil_health")
+            self.conn.execute("DROP TABLE IF EXISTS consolidated_files")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS soil_health (
+                cycle TEXT NOT NULL,
+                state TEXT NOT NULL,
+                district TEXT NOT NULL,
+                block TEXT NOT NULL,
+                village TEXT NOT NULL,
+                village_id TEXT NOT NULL,
+                consolidated_at REAL NOT NULL,
+                PRIMARY KEY (cycle, state, district, block, village_id)
+            )
+        """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS soil_health_location ON soil_health (state, district, block)")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS consolidated_files (
+                path TEXT PRIMARY KEY,
+                mtime_ns INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                rows INTEGER,
+                consolidated_at REAL NOT NULL
+            )
+        """)
+        self.files = {row[0]: (row[1], row[2]) for row in self.conn.execute("SELECT path, mtime_ns, size FROM consolidated_files")}
+        self.columns = {row[1] for row in self.conn.execute("PRAGMA table_info(soil_health)")}
+
+    # True if the file was consolidated before and has not changed since
+    def is_current(self, path):
+        return self.files.get(os.path.abspath(path)) == file_stat(path)
+
+    def add_columns(self, columns):
+        for col in columns:
+            if col not in self.columns:
+                self.conn.execute(f'ALTER TABLE soil_health ADD COLUMN "{col}" REAL')
+                self.columns.add(col)
+
+    # upserts the rows of a block and records its files in one transaction, so a crash never leaves
+    # rows without their file entry (or the other way round). Columns missing from df keep their value
+    def write_block(self, df, paths):
+        nutrient_columns = [col for col in df.columns if col not in ROW_COLUMNS]
+        df = df.assign(consolidated_at=time.time())
+        columns = list(df.columns)
+        quoted = ", ".join(f'"{col}"' for col in columns)
+        updates = ", ".join(f'"{col}" = excluded."{col}"' for col in nutrient_columns + ["village", "consolidated_at"])
+        rows = df.astype(object).where(df.notna(), None).itertuples(index=False, name=None)
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            self.add_columns(nutrient_columns)
+            self.conn.executemany(
+                f"INSERT INTO soil_health ({quoted}) VALUES ({', '.join('?' * len(columns))}) "
+                f"ON CONFLICT ({', '.join(KEY_COLUMNS)}) DO UPDATE SET {updates}",
+                rows
+            )
+            self.record_files(paths, len(df))
+
+    def record_files(self, paths, rows):
+        now = time.time()
+        for path in paths:
+            path = os.path.abspath(path)
+            stat = file_stat(path)
+            self.conn.execute(
+                "INSERT OR REPLACE INTO consolidated_files (path, mtime_ns, size, rows, consolidated_at) VALUES (?, ?, ?, ?, ?)",
+                (path, stat[0], stat[1], rows, now)
+            )
+            self.files[path] = stat
+
+    def row_count(self):
+        return self.conn.execute("SELECT COUNT(*) FROM soil_health").fetchone()[0]
+
+    def close(self):
+        self.conn.close()
+
+
+# reads the blocks with new or changed files in worker processes and writes them from this one.
+# With full=True every file is read again
+def consolidate(data_dir=DATA_DIR, output=CONSOLIDATED_FILE, workers=DEFAULT_WORKERS, full=False):
+    if not os.path.isdir(data_dir):
+        raise FileNotFoundError(f"No raw data found in {data_dir}")
+    store = ConsolidatedStore(output)
+    start = time.time()
+    blocks = skipped = failed = rows = 0
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            in_flight = set()
+
+            # writes the blocks that have been read, waiting for at least one if wait_for_one is set
+            def write_finished(wait_for_one):
+                nonlocal blocks, failed, rows
+                if wait_for_one:
+                    done = wait(in_flight, return_when=FIRST_COMPLETED).done
+                else:
+                    done = {future for future in in_flight if future.done()}
+                for future in done:
+                    in_flight.discard(future)
+                    try:
+                        key, paths, df = future.result()
+                    except Exception as e:
+                        failed += 1
+                        logging.error(f"Could not read block: {e}", exc_info=True)
+                        continue
+                    if df is None:
+                        store.record_files(paths, 0)
+                        continue
+                    store.write_block(df, paths)
+                    blocks += 1
+                    rows += len(df)
+                    if blocks % 500 == 0:
+                        print(f"Consolidated {blocks} blocks ({rows} rows)...")
+
+            for key, paths in block_groups(data_dir):
+                # a block is read again when any of its files (e.g. only the micro csv) is new or changed
+                if not full and all(store.is_current(path) for path in paths):
+                    skipped += 1
+                    continue
+                while len(in_flight) >= workers * BLOCKS_PER_WORKER:
+                    write_finished(wait_for_one=True)
+                in_flight.add(pool.submit(read_block, key, paths))
+                write_finished(wait_for_one=False)
+            while in_flight:
+                write_finished(wait_for_one=True)
+
+        print(f"Consolidated {blocks} blocks ({rows} rows) in {time.time() - start:.1f}s, "
+              f"{skipped} unchanged blocks skipped, {failed} failed. {store.row_count()} rows in {output}")
+    finally:
+        store.close()
+    return blocks
+
+
+# command line options, shared with cli.py
+def add_consolidate_args(parser):
+    parser.add_argument("--data-dir", default=DATA_DIR, help="folder with the raw {cycle}/{state}/{district}/*.csv files")
+    parser.add_argument("--output", default=CONSOLIDATED_FILE, help="SQLite file to write")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="processes reading csv files")
+    parser.add_argument("--full", action="store_true", help="read every file again, not only new or changed ones")
+
+
+# logging of a consolidation run, configured by the command line rather than on import
+def setup_logging(log_file=LOG_FILE):
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S', filename=log_file, filemode='a')
+
+
+if __name__ == "__main__":
+    setup_logging()
+
+    parser = argparse.ArgumentParser(description="Merge the raw block csvs into one SQLite dataset")
+    add_consolidate_args(parser)
+    args = parser.parse_args()
+
+    try:
+        consolidate(data_dir=args.data_dir, output=args.output, workers=args.workers, full=args.full)
+    except Exception as e:
+        logging.error(f"An error occurred: {e}", exc_info=True)
+        print(f"An error occurred: {e}")
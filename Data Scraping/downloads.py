@@ -0,0 +1,115 @@
+import os
+import re
+import csv
+import json
+import shutil
+import logging
+
+from selenium.webdriver.common.by import By
+
+DOWNLOAD_TIMEOUT = 60
+# "1–25 of 1,234" under the MUI table
+ROW_COUNT_XPATH = "//*[contains(@class, 'MuiTablePagination-displayedRows')]"
+
+
+class DownloadError(Exception):
+    pass
+
+
+# number of data rows in a csv (quoted newlines inside a value count as one row)
+def count_csv_rows(path):
+    with open(path, newline='', encoding='utf-8', errors='replace') as f:
+        return max(0, sum(1 for _ in csv.reader(f)) - 1)
+
+
+# total row count shown by the table's pagination, None if there is no pagination
+def displayed_row_count(driver):
+    elements = driver.find_elements(By.XPATH, ROW_COUNT_XPATH)
+    match = re.search(r"of\s+([\d,]+)", elements[0].text) if elements else None
+    return int(match.group(1).replace(",", "")) if match else None
+
+
+# moves src to dst so that dst is either missing or complete, even across file systems
+def atomic_move(src, dst):
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    tmp = dst + ".part"
+    shutil.move(src, tmp)
+    os.replace(tmp, dst)
+
+
+# Tracks downloads through Chrome's DevTools events instead of watching the folder: Chrome saves each
+# download under its guid (Browser.setDownloadBehavior allowAndName), downloadWillBegin tells which guid
+# an export got and downloadProgress when it is complete. The events are read from the performance log,
+# so the driver must be started with goog:loggingPrefs {"performance": "ALL"}.
+# Without DevTools (another browser) it falls back to waiting for a new, complete csv in the folder
+class DownloadManager:
+    def __init__(self, driver, download_dir, waiter, timeout=DOWNLOAD_TIMEOUT):
+        self.driver = driver
+        self.download_dir = download_dir
+        self.waiter = waiter
+        self.timeout = timeout
+        self.seen = set()
+        self.progress = {}
+        try:
+            driver.execute_cdp_cmd("Browser.setDownloadBehavior", {
+                "behavior": "allowAndName",
+                "downloadPath": download_dir,
+                "eventsEnabled": True,
+            })
+            driver.get_log("performance")
+            self.use_events = True
+        except Exception as e:
+            logging.warning(f"Download events not available, watching {download_dir} instead: {e}")
+            self.use_events = False
+
+    # reads new download events from the performance log
+    def poll_events(self):
+        for entry in self.driver.get_log("performance"):
+            message = json.loads(entry["message"])["message"]
+            method, params = message.get("method", ""), message.get("params", {})
+            if method.endswith(".downloadWillBegin"):
+                self.progress.setdefault(params["guid"], {"state": "begun", "filename": params.get("suggestedFilename")})
+            elif method.endswith(".downloadProgress") and params.get("guid") in self.progress:
+                self.progress[params["guid"]]["state"] = params.get("state")
+
+    # call right before the click that starts a download, returns what wait() needs to find it
+    def expect(self):
+        if self.use_events:
+            self.poll_events()
+            self.seen.update(self.progress)
+            return None
+        return set(os.listdir(self.download_dir))
+
+    # waits for the download started after expect() and returns its path
+    def wait(self, expected):
+        if not self.use_events:
+            return self.waiter.download_finished(self.download_dir, expected)
+
+        def started(driver):
+            self.poll_events()
+            new = [guid for guid in self.progress if guid not in self.seen]
+            return new[0] if new else False
+        guid = self.waiter.until("download started", started, timeout=self.timeout)
+        self.seen.add(guid)
+
+        def finished(driver):
+            self.poll_events()
+            return self.progress[guid]["state"] in ("completed", "canceled")
+        self.waiter.until("download finished", finished, timeout=self.timeout)
+        if self.progress[guid]["state"] == "canceled":
+            raise DownloadError(f"Download of {self.progress[guid]['filename']} was canceled")
+        return os.path.join(self.download_dir, guid)
+
+    # waits for the download, checks it has rows (and as many as the table shows) and moves it to path
+    def save(self, expected, path, expected_rows=None):
+        downloaded = self.wait(expected)
+        if not os.path.exists(downloaded):
+            raise DownloadError(f"Download finished but {downloaded} is missing")
+        rows = count_csv_rows(downloaded)
+        if rows == 0:
+            os.remove(downloaded)
+            raise DownloadError(f"Export for {path} has no rows")
+        if expected_rows is not None and rows != expected_rows:
+            logging.warning(f"Export for {path} has {rows} rows, the table shows {expected_rows}")
+        atomic_move(downloaded, path)
+        return rows
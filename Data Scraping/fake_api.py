@@ -0,0 +1,240 @@
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# hierarchy sizes: states, districts per state, blocks per district, villages per block
+SCALES = {
+    "small": (2, 3, 5, 20),
+    "medium": (10, 10, 10, 50),
+    "national": (36, 20, 10, 100),
+}
+NUTRIENTS = {
+    "N": ["High", "Medium", "Low"],
+    "P": ["High", "Medium", "Low"],
+    "K": ["High", "Medium", "Low"],
+    "OC": ["High", "Medium", "Low"],
+    "Zn": ["Sufficient", "Deficient"],
+    "Fe": ["Sufficient", "Deficient"],
+}
+
+
+# same canonical form as the hierarchy cache, so a recording matches whatever order the client sends
+def recording_key(operation_name, variables):
+    return operation_name, json.dumps(variables or {}, sort_keys=True)
+
+
+# Synthetic Soil Health hierarchy with deterministic ids, names and nutrient counts.
+# empty_every=n leaves every n-th block without data, like blocks that had no samples.
+# sampled_every=n only gives every n-th village of a block data, the others are listed but have no samples
+class SyntheticData:
+    def __init__(self, scale="small", seed=0, empty_every=7, sampled_every=1):
+        self.states, self.districts, self.blocks, self.villages = SCALES[scale] if isinstance(scale, str) else scale
+        self.seed = seed
+        self.empty_every = empty_every
+        self.sampled_every = sampled_every
+        # blocks whose nutrient values are all negative, which validation rejects
+        self.invalid_blocks = set()
+
+    def total_blocks(self):
+        return self.states * self.districts * self.blocks
+
+    def nutrient_results(self, village_id, cycle):
+        rng = random.Random(f"{self.seed}|{village_id}|{cycle}")
+        return {name: {level: rng.randint(0, 500) for level in levels} for name, levels in NUTRIENTS.items()}
+
+    def invalid_results(self):
+        return {name: {level: -1 for level in levels} for name, levels in NUTRIENTS.items()}
+
+    def villages_of(self, block_id):
+        if self.empty_every and int(block_id.rsplit("b", 1)[1]) % self.empty_every == self.empty_every - 1:
+            return []
+        return [{"_id": f"{block_id}v{i}", "name": f"VILLAGE {block_id.upper()}V{i}"} for i in range(self.villages)]
+
+    # the "data" of a response for one operation
+    def respond(self, operation_name, variables):
+        if operation_name == "GetState":
+            return {"getState": [{"_id": f"s{i}", "name": f"STATE {i}"} for i in range(self.states)]}
+        if operation_name == "GetdistrictAndSubdistrictBystate":
+            state = variables["state"]
+            return {"getdistrictAndSubdistrictBystate": [{"_id": f"{state}d{i}", "name": f"DISTRICT {state.upper()}D{i}"} for i in range(self.districts)]}
+        if operation_name == "GetBlocks":
+            district = variables["district"]
+            return {"getBlocks": [{"_id": f"{district}b{i}", "name": f"BLOCK {district.upper()}B{i} - {i}"} for i in range(self.blocks)]}
+        if operation_name == "GetVillageBydistrict":
+            return {"getVillageBydistrict": self.villages_of(variables["block"])}
+        if operation_name == "GetNutrientDashboardForPortal":
+            villages = [v for i, v in enumerate(self.villages_of(variables["block"])) if i % self.sampled_every == 0]
+            if variables.get("village"):
+                villages = [v for v in villages if v["_id"] == variables["village"]]
+            return {"getNutrientDashboardForPortal": [
+                {"village": village, "results": self.invalid_results() if variables["block"] in self.invalid_blocks else self.nutrient_results(village["_id"], variables.get("cycle"))}
+                for village in villages
+            ]}
+        return None
+
+
+# clients closing keep-alive connections are not worth a traceback
+class QuietServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+# Local stand-in for the Soil Health GraphQL API. Answers from recorded responses (jsonl lines with
+# operationName, variables and response) and falls back to the synthetic hierarchy. Adds latency
+# and injects 429/503 errors at the given rate. Counts requests and bytes per operation.
+# With an upstream url, requests that have no recording are forwarded there and recorded instead.
+# Nutrient requests for the village ids in failing_villages always get a 503
+class FakeSoilHealthAPI:
+    def __init__(self, data=None, recordings=None, latency=0.0, jitter=0.0, error_rate=0.0, seed=0, upstream=None, headers=None):
+        self.data = data or SyntheticData()
+        self.recordings = recordings
+        self.upstream = upstream
+        self.upstream_headers = headers or {}
+        self.recorded = {}
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.bytes = {}
+        self.errors = 0
+        self.failing_villages = set()
+        self.server = None
+        if recordings and os.path.exists(recordings):
+            self.load_recordings(recordings)
+
+    def load_recordings(self, path):
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    self.recorded[recording_key(entry["operationName"], entry.get("variables"))] = entry["response"]
+        logging.info(f"Loaded {len(self.recorded)} recorded responses from {path}")
+
+    def forward(self, payload):
+        import requests
+
+        r = requests.post(self.upstream, headers=self.upstream_headers, json=payload, timeout=60)
+        r.raise_for_status()
+        response = r.json()
+        with self.lock:
+            self.recorded[recording_key(payload.get("operationName"), payload.get("variables"))] = response
+            with open(self.recordings, "a") as f:
+                f.write(json.dumps({"operationName": payload.get("operationName"), "variables": payload.get("variables") or {}, "response": response}) + "\n")
+        return response
+
+    # returns (status, body)
+    def handle(self, payload):
+        operation_name = payload.get("operationName")
+        variables = payload.get("variables") or {}
+        delay = self.latency + (self.rng.uniform(-self.jitter, self.jitter) if self.jitter else 0)
+        if delay > 0:
+            time.sleep(delay)
+        with self.lock:
+            self.requests[operation_name] = self.requests.get(operation_name, 0) + 1
+            inject_error = self.error_rate and self.rng.random() < self.error_rate
+            if inject_error:
+                self.errors += 1
+        if inject_error:
+            return 429 if self.rng.random() < 0.5 else 503, b'{"errors": [{"message": "injected error"}]}'
+        if variables.get("village") in self.failing_villages:
+            return 503, b'{"errors": [{"message": "village unavailable"}]}'
+
+        response = self.recorded.get(recording_key(operation_name, variables))
+        if response is None and self.upstream:
+            response = self.forward(payload)
+        if response is None:
+            data = self.data.respond(operation_name, variables)
+            if data is None:
+                return 400, json.dumps({"errors": [{"message": f"unknown operation {operation_name}"}]}).encode()
+            response = {"data": data}
+        body = json.dumps(response).encode()
+        with self.lock:
+            self.bytes[operation_name] = self.bytes.get(operation_name, 0) + len(body)
+        return 200, body
+
+    def stats(self):
+        with self.lock:
+            return {"requests": dict(self.requests), "bytes": dict(self.bytes), "errors": self.errors}
+
+    def reset_stats(self):
+        with self.lock:
+            self.requests, self.bytes, self.errors = {}, {}, 0
+
+    # serves in a background thread, port 0 picks a free port. Returns the url
+    def start(self, host="127.0.0.1", port=0):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # headers and body go out in separate writes, with Nagle on a keep-alive client waits ~40ms
+            # for the delayed ACK on every request and the bench would measure that instead of the crawler
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                try:
+                    payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                    status, body = api.handle(payload)
+                except ValueError:
+                    status, body = 400, b'{"errors": [{"message": "invalid json"}]}'
+                except Exception as e:
+                    logging.error(f"Fake API failed: {e}", exc_info=True)
+                    status, body = 502, json.dumps({"errors": [{"message": str(e)}]}).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                if status == 429:
+                    self.send_header("Retry-After", "0")
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = QuietServer((host, port), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return f"http://{host}:{self.server.server_address[1]}/"
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a local fake Soil Health GraphQL API")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--scale", choices=list(SCALES), default="small", help="size of the synthetic hierarchy")
+    parser.add_argument("--sampled-every", type=int, default=1, help="only every n-th village of a block has data")
+    parser.add_argument("--recordings", help="jsonl file with recorded responses to serve first")
+    parser.add_argument("--upstream", help="forward requests without a recording to this API and append them to --recordings")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every response")
+    parser.add_argument("--jitter", type=float, default=0.0, help="random +/- seconds on top of the latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with 429/503")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    if args.upstream and not args.recordings:
+        parser.error("--upstream needs --recordings to write to")
+    headers = None
+    if args.upstream:
+        from final_code import HEADERS as headers
+    api = FakeSoilHealthAPI(SyntheticData(args.scale, sampled_every=args.sampled_every), args.recordings, args.latency, args.jitter, args.error_rate,
+                            upstream=args.upstream, headers=headers)
+    url = api.start(port=args.port)
+    print(f"Fake Soil Health API on {url} ({api.data.total_blocks()} blocks per cycle), Ctrl+C to stop.")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        api.stop()
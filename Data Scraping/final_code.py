@@ -1,64 +1,66 @@
 import os
-import pandas as pd
-import requests
+import time
 import logging
+import argparse
 from pathlib import Path
-import json
-
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S', filename='data_scraping.log', filemode='w')
-
-BASE_URL = "https://soilhealth4.dac.gov.in/"
+from hierarchy_cache import HierarchyCache, HIERARCHY_CACHE_FILE, HIERARCHY_TTL_DAYS, add_hierarchy_args
+from task_ledger import TaskLedger, LEDGER_FILE, parse_shard, in_shard, shard_file, in_scope, is_partial, add_scope_args, scope_options
+from transport import Transport, build_transport, add_transport_args, transport_options
+from writers import make_writer, add_output_args
+from flatten import NutrientSchema, NUTRIENT_SCHEMA_FILE, BlockFlattener
+from metrics import METRICS, METRICS_FILE, METRICS_INTERVAL, CrawlProgress, MetricsReporter, add_metrics_args
+from validate import VillageValidator, ValidationError, add_validation_args
+from response_cache import ResponseCache, CachingTransport, add_cache_args, cache_options
+
+LOG_FILE = 'data_scraping.log'
+
+# (re)configures logging, called by main (shards log to their own file) rather than on import
+def setup_logging(log_file=LOG_FILE):
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S', filename=log_file, filemode='a', force=True)
+
+# SOIL_HEALTH_URL points the crawlers at another server, e.g. a local fake one for testing
+BASE_URL = os.environ.get("SOIL_HEALTH_URL", "https://soilhealth4.dac.gov.in/")
 HEADERS = {
     "Content-Type": "application/json",
     "Origin": "https://www.soilhealth.dac.gov.in",
     "Referer": "https://www.soilhealth.dac.gov.in/",
 }
 CYCLES = ["2023-24", "2024-25"]
-CHECKPOINT_FILE = "checkpoint.json"
 MAX_TRIES = 3
+# In incremental mode blocks older than this, and every block of the active cycle, are fetched again
+MAX_AGE_DAYS = 30
+ACTIVE_CYCLE = CYCLES[-1]
+# "village" asks for the nutrient data one village at a time, "block" asks once per block
+FETCH_MODES = ["village", "block"]
 
-# Initialize the checkpoint file if not there already
-def init_checkpoint():
-    if not os.path.exists(CHECKPOINT_FILE):
-        checkpoint = {
-            "last_cycle": None,
-            "last_state": None,
-            "last_district": None,
-            "last_block": None,
-            "fail_count": 0
-        }
-        with open(CHECKPOINT_FILE, 'w') as f:
-            json.dump(checkpoint, f)
-
-# Saves the current processing block
-def save_checkpoint(cycle, state_id, state_name, district_id, district_name, block_id, block_name, fail_count=0):
-    checkpoint = {
-        "last_cycle": cycle,
-        "last_state": {'id': state_id, 'name': state_name},
-        "last_district": {'id': district_id, 'name': district_name},
-        "last_block": {'id': block_id, 'name': block_name},
-        "fail_count": fail_count
-    }
-    with open(CHECKPOINT_FILE, 'w') as f:
-        json.dump(checkpoint, f, indent=2)
+# rate limited, retrying connection to the API shared by all queries, built by the first query (or main)
+transport = None
 
-# loads the checkpoint (where we left off)
-def load_checkpoint():
-    if os.path.exists(CHECKPOINT_FILE):
-        with open(CHECKPOINT_FILE, 'r') as f:
-            return json.load(f)
-    return {"last_cycle": None, "last_state": None, "last_district": None, "last_block": None, "fail_count": 0}
+# replaces the transport, e.g. with the rate and timeout given on the command line.
+# headers are added to HEADERS, e.g. the session headers captured from the dashboard by hybrid.py
+def set_transport(options, headers=None, url=None):
+    global transport
+    transport = build_transport(Transport, url or BASE_URL, {**HEADERS, **(headers or {})}, **options)
 
 # sends request to url and gets back response
 def run_query(operation_name, query, variables):
+    if transport is None:
+        set_transport({})
     payload = {
         "operationName": operation_name,
         "query": query,
         "variables": variables
     }
-    r = requests.post(BASE_URL, headers=HEADERS, json=payload)
-    r.raise_for_status()
-    return r.json()["data"]
+    return transport.post(payload)["data"]
+
+# same as run_query but serves the state/district/block/village lookups from the hierarchy cache
+def run_hierarchy_query(cache, operation_name, query, variables):
+    data = cache.get(operation_name, variables) if cache else None
+    if data is None:
+        data = run_query(operation_name, query, variables)
+        if cache:
+            cache.put(operation_name, variables, data)
+    return data
 
 # State query
 state_query = """
@@ -125,168 +127,347 @@ query GetNutrientDashboardForPortal(
 }
 """
 
-def main():
-    init_checkpoint()
-    checkpoint = load_checkpoint()
-    skip_until = checkpoint['last_cycle'] is not None   # Returns boolean
+# cleans up a name so that it can be used as a folder or file name
+def clean_name(name):
+    return name.strip().replace("/", "_")
+
+# variables for the nutrient query, leaving out the village asks for the whole block
+def nutrient_variables(state_id, district_id, block_id, cycle, village_id=None):
+    variables = {
+        "state": state_id,
+        "district": district_id,
+        "block": block_id,
+        "cycle": cycle
+    }
+    if village_id is not None:
+        variables["village"] = village_id
+    return variables
+
+# splits a block level nutrient response back into one response per village (in the order of villages).
+# villages missing from the response get None, items that match no listed village are returned separately
+def split_by_village(nutrient_data, villages):
+    grouped = {}
+    for item in nutrient_data:
+        village = item.get('village') or {}
+        grouped.setdefault(village.get('_id') or village.get('name'), []).append(item)
+
+    village_responses = []
+    for village in villages:
+        items = grouped.pop(village["_id"], None)
+        if items is None:
+            items = grouped.pop(village.get("name"), None)
+        village_responses.append(items)
+
+    extra = [item for items in grouped.values() for item in items]
+    return village_responses, extra
+
+# lists every block of a cycle (from the hierarchy cache when possible) as ledger tasks.
+# complete is False when part of the listing failed. States and districts outside the scope are not listed further
+def list_tasks(cache, cycle, scope=None):
+    tasks = []
+    complete = True
+    states = run_hierarchy_query(cache, "GetState", state_query, {})["getState"]
+
+    for state in states:
+        try:
+            state_id = state["_id"]
+            state_name = clean_name(state.get("name", "Unknown"))
+            if not in_scope(scope, "state", state_id, state_name):
+                continue
+
+            districts = run_hierarchy_query(
+                cache,
+                "GetdistrictAndSubdistrictBystate",
+                district_query,
+                {"state": state_id}
+            )["getdistrictAndSubdistrictBystate"]
+
+            for district in districts:
+                try:
+                    district_id = district["_id"]
+                    district_name = clean_name(district.get("name", "Unknown"))
+                    if not in_scope(scope, "district", district_id, district_name):
+                        continue
+
+                    blocks = run_hierarchy_query(
+                        cache,
+                        "GetBlocks",
+                        block_query,
+                        {"state": state_id, "district": district_id}
+                    )["getBlocks"]
+
+                    for block in blocks:
+                        if not in_scope(scope, "block", block["_id"], clean_name(block.get("name", "Unknown"))):
+                            continue
+                        tasks.append({
+                            "cycle": cycle,
+                            "state_id": state_id,
+                            "state_name": state_name,
+                            "district_id": district_id,
+                            "district_name": district_name,
+                            "block_id": block["_id"],
+                            "block_name": clean_name(block.get("name", "Unknown")),
+                        })
+                except Exception as e:
+                    complete = False
+                    logging.error(f"District loop failed for {cycle}/{state_name}/{district_name}: {e}", exc_info=True)
+        except Exception as e:
+            complete = False
+            logging.error(f"State loop failed for {cycle}/{state_name}: {e}", exc_info=True)
+    return tasks, complete
+
+# adds the blocks of a cycle (only those of the shard and scope, if any) to the ledger
+def seed_tasks(cache, ledger, cycle, shard=None, scope=None):
+    print(f"Listing blocks for Cycle: {cycle}")
+    tasks, complete = list_tasks(cache, cycle, scope)
+    tasks = [task for task in tasks if in_shard(task, shard)]
+
+    added = ledger.add_tasks(tasks)
+    # a cycle whose listing had errors, or only covered part of it, is listed again on the next run to pick up the missing blocks
+    if complete and not is_partial(scope):
+        ledger.mark_seeded(cycle)
+    logging.info(f"Listed {len(tasks)} blocks for {cycle}, {added} new.")
+
+# appends a flattened batch to the block's stream, if there is one yet
+def stream_rows(stream, df):
+    if df is not None and not df.empty:
+        stream.append(df)
+
+# scrapes one block and hands its rows to the writer. Returns the blocks that are now saved as
+# (task, records, content_hash), records is None if the block was already saved before.
+# In incremental mode saved blocks are fetched again and only rewritten if they changed
+def scrape_block(cache, writer, schema, task, fetch_mode="village", incremental=False):
+    cycle = task["cycle"]
+    state_id, state_name = task["state_id"], task["state_name"]
+    district_id, district_name = task["district_id"], task["district_name"]
+    block_id, block_name = task["block_id"], task["block_name"]
+
+    # If the block already exists, we skip and continue to next one
+    existing_hash = None if incremental else writer.existing_hash(task)
+    if existing_hash:
+        logging.info(f"Skipping {cycle}/{state_name}/{district_name}/{block_name} - file already exists.")
+        print(f"skipping {cycle}/{state_name}/{district_name}/{block_name} (already saved).")
+        return [(task, None, existing_hash)]
+
+    print(f"Processing Block: {cycle} / {state_name} / {district_name} / {block_name}")
+    flattener = BlockFlattener(cycle, state_name, district_name, block_name, schema)
+
+    # Rows go to the writer a batch of villages at a time while the block is fetched, the block only
+    # becomes a finished file once every village is in
+    stream = writer.open_block(task)
+    try:
+        villages = run_hierarchy_query(
+            cache,
+            "GetVillageBydistrict",
+            village_query,
+            {"state": state_id, "district": district_id, "block": block_id}
+        )["getVillageBydistrict"]
+
+        village_responses, extra = [None] * len(villages), []
+        # In block mode one response answers for the whole block, villages missing from it have no samples.
+        # Only a failed block request falls back to asking the villages one by one
+        if fetch_mode == "block":
+            try:
+                block_data = run_query(
+                    "GetNutrientDashboardForPortal",
+                    nutrient_query,
+                    nutrient_variables(state_id, district_id, block_id, cycle)
+                )["getNutrientDashboardForPortal"]
+            except Exception as e:
+                logging.warning(f"Block request failed for {cycle}/{state_name}/{district_name}/{block_name}, fetching its {len(villages)} villages one by one: {e}")
+            else:
+                village_responses, extra = split_by_village(block_data, villages)
+                logging.info(f"{village_responses.count(None)} of {len(villages)} villages have no data in the block response for {cycle}/{state_name}/{district_name}/{block_name}.")
+                village_responses = [items or [] for items in village_responses]
+
+        for village, nutrient_data in zip(villages, village_responses):
+            try:
+                village_id = village["_id"]
+                village_name = village.get("name", "Unknown")
+
+                if nutrient_data is None:
+                    nutrient_data = run_query(
+                        "GetNutrientDashboardForPortal",
+                        nutrient_query,
+                        nutrient_variables(state_id, district_id, block_id, cycle, village_id)
+                    )["getNutrientDashboardForPortal"]
+            except Exception as e:
+                # saving the block without this village would replace an earlier complete file, the block fails instead
+                logging.error(f"Village loop failed for {village_name} in {cycle}/{state_name}/{district_name}/{block_name}, failing the block: {e}")
+                raise
+            stream_rows(stream, flattener.add(nutrient_data))
+        stream_rows(stream, flattener.add(extra))
+        stream_rows(stream, flattener.flush())
+    except Exception:
+        stream.abort()
+        raise
+    saved = stream.finish()
+    if stream.records == 0:
+        logging.info(f"No data found for {cycle}/{state_name}/{district_name}/{block_name}. Skipping.....")
+    return saved
+
+# Cheap probe before the crawl: the village count of every pending block without an earlier result,
+# from the hierarchy cache when possible. The crawl asks for the same list, so it is mostly cached later
+def probe_villages(cache, ledger, retry_only=False):
+    tasks = ledger.unprobed_tasks(retry_only)
+    print(f"Probing village counts of {len(tasks)} blocks.")
+    for task in tasks:
+        try:
+            villages = run_hierarchy_query(
+                cache,
+                "GetVillageBydistrict",
+                village_query,
+                {"state": task["state_id"], "district": task["district_id"], "block": task["block_id"]}
+            )["getVillageBydistrict"]
+            ledger.set_villages(task, len(villages))
+        except Exception as e:
+            logging.error(f"Village probe failed for {task['cycle']}/{task['state_name']}/{task['district_name']}/{task['block_name']}: {e}", exc_info=True)
+
+# orders the pending blocks by expected records and skips the ones that were empty skip_empty_after times
+def prioritise(ledger, skip_empty_after=0):
+    ledger.update_priorities()
+    if skip_empty_after:
+        logging.info(f"Skipped {ledger.skip_known_empty(skip_empty_after)} blocks that were empty {skip_empty_after} or more times.")
+
+# command line options for the crawl order, shared by the crawlers
+def add_priority_args(parser):
+    parser.add_argument("--probe-villages", action="store_true", help="count the villages of new blocks first, to crawl the biggest ones first and empty ones last")
+    parser.add_argument("--skip-empty-after", type=int, default=0, help="do not fetch blocks again that were empty this many times (0 only postpones them)")
+
+# command line options for incremental runs, shared by the crawlers
+def add_incremental_args(parser):
+    parser.add_argument("--incremental", action="store_true", help="fetch new, stale and active-cycle blocks again and only rewrite files that changed")
+    parser.add_argument("--max-age-days", type=float, default=MAX_AGE_DAYS, help="in incremental mode, blocks fetched longer ago than this are fetched again")
+    parser.add_argument("--active-cycle", default=ACTIVE_CYCLE, help="in incremental mode, every block of this cycle is fetched again")
+
+# Command line options of a crawl, shared by final_code.py, async_crawler.py, hybrid.py, sharding.py and cli.py,
+# each adds its own next to them. shard=False leaves out --shard (sharding.py picks the shards itself)
+def add_crawl_args(parser, shard=True):
+    add_hierarchy_args(parser)
+    parser.add_argument("--fetch-mode", choices=FETCH_MODES, default="village", help="request nutrient data per village or once per block")
+    parser.add_argument("--retry-failed", action="store_true", help="only retry the blocks that failed in earlier runs")
+    if shard:
+        parser.add_argument("--shard", type=parse_shard, help="only crawl shard i of N (i/N), e.g. one per machine")
+    parser.add_argument("--log-file", default=LOG_FILE, help="file the crawl logs to")
+    add_transport_args(parser)
+    add_incremental_args(parser)
+    add_output_args(parser)
+    add_metrics_args(parser)
+    add_cache_args(parser)
+    add_priority_args(parser)
+    add_validation_args(parser)
+    add_scope_args(parser)
+
+# the keyword arguments of main (and async_crawler.main, hybrid.main) from the options of add_crawl_args
+def crawl_options(args):
+    return {
+        "refresh_hierarchy": args.refresh_hierarchy,
+        "hierarchy_ttl_days": args.hierarchy_ttl_days,
+        "fetch_mode": args.fetch_mode,
+        "retry_failed": args.retry_failed,
+        "shard": getattr(args, "shard", None),
+        "transport_options": transport_options(args),
+        "incremental": args.incremental,
+        "max_age_days": args.max_age_days,
+        "active_cycle": args.active_cycle,
+        "output_format": args.output_format,
+        "metrics_interval": args.metrics_interval,
+        "response_cache": cache_options(args),
+        "probe": args.probe_villages,
+        "skip_empty_after": args.skip_empty_after,
+        "validation": not args.no_validation,
+        "scope": scope_options(args),
+        "log_file": args.log_file,
+    }
+
+def main(refresh_hierarchy=False, hierarchy_ttl_days=HIERARCHY_TTL_DAYS, fetch_mode="village", retry_failed=False, shard=None, transport_options=None,
+         incremental=False, max_age_days=MAX_AGE_DAYS, active_cycle=ACTIVE_CYCLE, output_format="csv", session_headers=None, api_url=None,
+         metrics_interval=METRICS_INTERVAL, response_cache=None, probe=False, skip_empty_after=0, validation=True,
+         scope=None, seed=True, log_file=LOG_FILE):
+    global transport
+    # a shard works on its own part of the blocks, with its own ledger and log
+    setup_logging(shard_file(log_file, shard))
+    if shard is not None:
+        logging.info(f"Running shard {shard[0]}/{shard[1]}")
+
+    set_transport(transport_options or {}, session_headers, api_url)
+    # response_cache holds the ResponseCache options, e.g. {"replay_only": True}
+    if response_cache is not None:
+        transport = CachingTransport(getattr(transport, "transport", transport), ResponseCache(**response_cache))
 
     # creates the data directory
     data_dir = Path.cwd()/"data"/"raw"
     os.makedirs(data_dir, exist_ok=True)
-
-    for cycle in CYCLES:
+    schema = NutrientSchema(NUTRIENT_SCHEMA_FILE)
+    # rows are checked for duplicate village keys and out of range values before they are written
+    writer = make_writer(output_format, data_dir, schema, VillageValidator() if validation else None)
+    cache = HierarchyCache(HIERARCHY_CACHE_FILE, ttl_days=hierarchy_ttl_days, refresh=refresh_hierarchy)
+    ledger = TaskLedger(shard_file(LEDGER_FILE, shard), scope)
+    ledger.release_dead_workers()
+
+    # The blocks are listed once into the ledger, resuming (seed=False) just pulls the pending tasks from it
+    for cycle in (scope or {}).get("cycles") or CYCLES:
         try:
-            print(f"Processing Cycle: {cycle}")
-            states = run_query("GetState", state_query, {})["getState"]
-
-            for state in states:
-                try:
-                    state_id = state["_id"]
-                    state_name = state.get("name", "Unknown").strip().replace("/", "_")
-
-                    districts = run_query(
-                        "GetdistrictAndSubdistrictBystate",
-                        district_query,
-                        {"state": state_id}
-                    )["getdistrictAndSubdistrictBystate"]
-
-                    for district in districts:
-                        try:
-                            district_id = district["_id"]
-                            district_name = district.get("name", "Unknown").strip().replace("/", "_")
-
-                            blocks = run_query(
-                                "GetBlocks",
-                                block_query,
-                                {"state": state_id, "district": district_id}
-                            )["getBlocks"]
-
-                            for block in blocks:
-                                try:
-                                    block_id = block["_id"]
-                                    block_name = block.get("name", "Unknown").strip().replace("/", "_")
-
-                                    # Checks if are ahead of the checkpoint
-                                    if skip_until:
-                                        if (checkpoint['last_cycle'] == cycle and
-                                            checkpoint['last_state']['id'] == state_id and
-                                            checkpoint['last_district']['id'] == district_id and
-                                            checkpoint['last_block']['id'] == block_id):
-
-                                            # If error in scraping same block for 3 times(MAX_TRIES) in a row, we skip this and continue to next block.
-                                            if checkpoint.get('fail_count', 0) >= MAX_TRIES:
-                                                logging.info(f"Skipping {cycle}/{state_name}/{district_name}/{block_name} after 3 failed attempts.")
-                                                skip_until = True
-                                                continue
-                                            else:
-                                                skip_until = False
-                                        else:
-                                            print(f'Skipping {cycle}/{state_name}/{district_name}/{block_name} (checkpoint not reached).')
-                                            continue
-
-                                    folder_path = os.path.join(data_dir, cycle, state_name, district_name)
-                                    os.makedirs(folder_path, exist_ok=True)
-                                    filename = block_name.split('-')[0].strip().replace(" ", "_") + ".csv"
-                                    filepath = os.path.join(folder_path, filename)
-
-                                    # If the block already exists, we skip and continue to next one
-                                    if os.path.exists(filepath):
-                                        logging.info(f"Skipping {cycle}/{state_name}/{district_name}/{block_name} - file already exists.")
-                                        print(f"skipping {cycle}/{state_name}/{district_name}/{block_name} (already saved).")
-                                        continue
-                                    
-                                    # Save checkpoint before processing
-                                    save_checkpoint(cycle, state_id, state_name, district_id, district_name, block_id, block_name)
-
-                                    print(f"Processing Block: {cycle} / {state_name} / {district_name} / {block_name}")
-                                    flattened_data = []
-                                    existing_villages = set()
-
-                                    villages = run_query(
-                                        "GetVillageBydistrict",
-                                        village_query,
-                                        {"state": state_id, "district": district_id, "block": block_id}
-                                    )["getVillageBydistrict"]
-
-                                    for village in villages:
-                                        try:
-                                            village_id = village["_id"]
-                                            village_name = village.get("name", "Unknown")
-
-                                            nutrient_data = run_query(
-                                                "GetNutrientDashboardForPortal",
-                                                nutrient_query,
-                                                {
-                                                    "state": state_id,
-                                                    "district": district_id,
-                                                    "block": block_id,
-                                                    "village": village_id,
-                                                    "cycle": cycle
-                                                }
-                                            )["getNutrientDashboardForPortal"]
-
-                                            for item in nutrient_data:
-                                                v_name = item['village']['name']
-
-                                                if v_name in existing_villages:
-                                                    continue
-
-                                                flat_dict = {
-                                                    'cycle': cycle,
-                                                    'state': state_name, 
-                                                    'district': district_name,
-                                                    'block': block_name,
-                                                    'village': v_name
-                                                }
-
-                                                if item.get('results'):
-                                                    for key, val in item.items():
-                                                        if key == 'results':
-                                                            for sub_key, sub_val in val.items():
-                                                                for sub_key2, sub_val2 in sub_val.items():
-                                                                    col_name = f"{sub_key}_{sub_key2}"
-                                                                    flat_dict[col_name] = sub_val2
-                                                
-                                                flattened_data.append(flat_dict)
-                                                existing_villages.add(v_name)
-                                        except Exception as e:
-                                            logging.error(f"Village loop failed for {village_name} in {cycle}/{state_name}/{district_name}/{block_name}: {e}", exc_info=True)
-
-                                    # Saves the data to csv
-                                    df = pd.DataFrame(flattened_data)
-                                    if not df.empty:
-                                        df.to_csv(filepath, index=False)
-                                        print(f"{cycle}/{state_name}/{district_name}/{filename} saved with {len(flattened_data)} records.")
-                                        save_checkpoint(cycle, state_id, state_name, district_id, district_name, block_id, block_name, 0)
-                                    else:
-                                        logging.info(f"No data found for {cycle}/{state_name}/{district_name}/{block_name}. Skipping.....")
-                                except Exception as e:
-                                    checkpoint = load_checkpoint()
-                                    fail_count = checkpoint.get('fail_count', 0) + 1
-                                    save_checkpoint(cycle, state_id, state_name, district_id, district_name, block_id, block_name, fail_count)
-                                    if fail_count >= MAX_TRIES:
-                                        logging.error(f"Block failed 3 times, skipping {cycle}/{state_name}/{district_name}/{block_name}.")
-                                        continue
-                                    logging.error(f"Block loop failed for {cycle}/{state_name}/{district_name}/{block_name}: {e}", exc_info=True)
-                        except Exception as e:
-                            logging.error(f"District loop failed for {cycle}/{state_name}/{district_name}: {e}", exc_info=True)
-                except Exception as e:
-                    logging.error(f"State loop failed for {cycle}/{state_name}: {e}", exc_info=True)
+            # incremental runs always list again (from the cache until it expires) to pick up new blocks
+            if seed and (refresh_hierarchy or incremental or not ledger.is_seeded(cycle)):
+                seed_tasks(cache, ledger, cycle, shard, scope)
         except Exception as e:
             logging.error(f"Cycle loop failed for {cycle}: {e}", exc_info=True)
 
+    if incremental:
+        logging.info(f"Refetching {ledger.requeue_stale(max_age_days, active_cycle)} stale or active-cycle blocks.")
+    if retry_failed:
+        logging.info(f"Retrying {ledger.requeue_failed()} failed blocks.")
+    # blocks expected to have the most records are crawled first, known empty ones last
+    if probe:
+        probe_villages(cache, ledger, retry_failed)
+    prioritise(ledger, skip_empty_after)
+    label = f"Shard {shard[0]}/{shard[1]} tasks" if shard is not None else "Tasks"
+    summary = ledger.summary()
+    print(f"{label}: {summary}")
+    if scope and not any(summary.values()):
+        print(f"No blocks in the ledger match {scope}, check the names (or run a crawl first when resuming).")
+    progress = CrawlProgress(METRICS, ledger.remaining_by_state(retry_only=retry_failed))
+    reporter = MetricsReporter(shard_file(METRICS_FILE, shard), metrics_interval, METRICS, progress).start()
+
+    while True:
+        task = ledger.claim(retry_only=retry_failed)
+        if task is None:
+            break
+        block_path = f"{task['cycle']}/{task['state_name']}/{task['district_name']}/{task['block_name']}"
+        start = time.monotonic()
+        try:
+            # blocks count as done once the writer has them on disk, which for parquet can be later
+            for done_task, records, content_hash in scrape_block(cache, writer, schema, task, fetch_mode, incremental):
+                progress.block_finished(done_task, ledger.mark_done(done_task, records, content_hash), records)
+            progress.block_timed(task, time.monotonic() - start)
+        except Exception as e:
+            # If error in scraping same block for 3 times(MAX_TRIES), we skip this and continue to next block.
+            # A block with every row rejected by validation would be rejected again, it fails on the first try
+            rejected = isinstance(e, ValidationError)
+            status = ledger.mark_failed(task, e, 1 if rejected else MAX_TRIES)
+            progress.block_finished(task, status)
+            if rejected:
+                logging.error(f"Block rejected, skipping {block_path}: {e}")
+            elif status == "failed":
+                logging.error(f"Block failed {MAX_TRIES} times, skipping {block_path}.")
+            else:
+                logging.error(f"Block loop failed for {block_path}: {e}", exc_info=True)
+
+    for done_task, records, content_hash in writer.close():
+        progress.block_finished(done_task, ledger.mark_done(done_task, records, content_hash), records)
+    reporter.stop()
+    print(f"{label}: {ledger.summary()}")
+    ledger.close()
+    cache.close()
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Crawl the Soil Health GraphQL API")
+    add_crawl_args(parser)
+    args = parser.parse_args()
+
     try:
-        main()
+        main(**crawl_options(args))
     except Exception as e:
-        checkpoint = load_checkpoint()
-        fail_count = checkpoint.get('fail_count', 0) + 1
-        save_checkpoint(
-            checkpoint['last_cycle'],
-            checkpoint['last_state']['id'], checkpoint['last_state']['name'],
-            checkpoint['last_district']['id'], checkpoint['last_district']['name'],
-            checkpoint['last_block']['id'], checkpoint['last_block']['name'],
-            fail_count
-        )
         logging.error(f"An error occurred: {e}", exc_info=True)
-        print(f"An error occurred: {e}")
\ No newline at end of file
+        print(f"An error occurred: {e}")
@@ -0,0 +1,96 @@
+import os
+import json
+import logging
+import threading
+
+NUTRIENT_SCHEMA_FILE = "nutrient_schema.json"
+ID_COLUMNS = ["cycle", "state", "district", "block", "village", "village_id"]
+# villages flattened (and written) at a time while a block streams in
+FLATTEN_BATCH_ROWS = 500
+
+
+# The nutrient columns (e.g. N_High) in a fixed order. Declared in nutrient_schema.json, or learned from
+# the first response if the file does not exist yet. Columns seen later are appended, never reordered
+# or dropped, so every block gets the same columns
+class NutrientSchema:
+    def __init__(self, path=NUTRIENT_SCHEMA_FILE):
+        self.path = path
+        self.columns = []
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            self.columns = self.read()
+
+    def read(self):
+        with open(self.path) as f:
+            return json.load(f)["nutrient_columns"]
+
+    # adds columns that are not in the schema yet, returns True if the schema changed
+    def learn(self, columns):
+        with self.lock:
+            new_columns = [col for col in columns if col not in self.columns]
+            if not new_columns:
+                return False
+            # another process (shard) may have added columns meanwhile, keep its order first
+            if os.path.exists(self.path):
+                for col in self.read():
+                    if col not in self.columns:
+                        self.columns.append(col)
+            new_columns = [col for col in new_columns if col not in self.columns]
+            if self.columns and new_columns:
+                logging.warning(f"New nutrient columns added to the schema: {new_columns}")
+            self.columns.extend(new_columns)
+            with open(self.path + ".tmp", "w") as f:
+                json.dump({"nutrient_columns": self.columns}, f, indent=2)
+            os.replace(self.path + ".tmp", self.path)
+            return True
+
+
+# Flattens the nutrient responses of a block as they come in. add() collects the items of one
+# response and returns a DataFrame once batch_rows villages are waiting, flush() returns the rest.
+# Villages already seen earlier in the block (same village id, or same name when there is no id) are
+# skipped, villages that only share a name are kept
+class BlockFlattener:
+    def __init__(self, cycle, state_name, district_name, block_name, schema, batch_rows=FLATTEN_BATCH_ROWS):
+        self.cycle = cycle
+        self.state_name = state_name
+        self.district_name = district_name
+        self.block_name = block_name
+        self.schema = schema
+        self.batch_rows = batch_rows
+        self.seen = set()
+        self.items = []
+
+    def add(self, nutrient_data):
+        for item in nutrient_data:
+            village = item.get('village') or {}
+            key = village.get('_id') or village.get('name')
+            if key is None:
+                logging.warning(f"Nutrient item without village id or name in {self.cycle}/{self.state_name}/{self.district_name}/{self.block_name}, skipped.")
+                continue
+            if key in self.seen:
+                continue
+            self.seen.add(key)
+            self.items.append(item)
+        if len(self.items) >= self.batch_rows:
+            return self.flush()
+        return None
+
+    # one row per village, the id columns and then every schema column as float64 (NaN where a village has no value)
+    def flush(self):
+        # pandas is only loaded once there is something to flatten, the crawlers start without it
+        import pandas as pd
+
+        items, self.items = self.items, []
+        # results look like {"N": {"High": 1, ...}, ...} and become N_High, ...
+        results = pd.json_normalize([item.get('results') or {} for item in items], sep="_")
+        results.index = range(len(items))
+        self.schema.learn(list(results.columns))
+        df = results.reindex(columns=self.schema.columns).apply(pd.to_numeric, errors="coerce").astype("float64")
+
+        df.insert(0, "cycle", self.cycle)
+        df.insert(1, "state", self.state_name)
+        df.insert(2, "district", self.district_name)
+        df.insert(3, "block", self.block_name)
+        df.insert(4, "village", [item['village'].get('name') for item in items])
+        df.insert(5, "village_id", [item['village'].get('_id') for item in items])
+        return df
@@ -0,0 +1,72 @@
+import json
+import time
+import sqlite3
+import logging
+
+HIERARCHY_CACHE_FILE = "hierarchy_cache.db"
+HIERARCHY_TTL_DAYS = 7
+
+# The state/district/block/village lookups do not depend on the cycle, so their responses can be reused
+HIERARCHY_OPERATIONS = (
+    "GetState",
+    "GetdistrictAndSubdistrictBystate",
+    "GetBlocks",
+    "GetVillageBydistrict",
+)
+
+
+class HierarchyCache:
+    def __init__(self, path=HIERARCHY_CACHE_FILE, ttl_days=HIERARCHY_TTL_DAYS, refresh=False):
+        self.ttl = ttl_days * 24 * 3600
+        # With refresh, anything fetched before this run counts as stale but entries
+        # fetched during the run are still reused (e.g. by the second cycle)
+        self.opened_at = time.time() if refresh else 0
+        self.hits = 0
+        self.misses = 0
+        # shard workers share the cache file, so wait for locks instead of failing
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS hierarchy (
+                operation TEXT NOT NULL,
+                variables TEXT NOT NULL,
+                response TEXT NOT NULL,
+                fetched_at REAL NOT NULL,
+                PRIMARY KEY (operation, variables)
+            )
+        """)
+        self.conn.commit()
+
+    # variables are stored as sorted json so the same lookup always gets the same key
+    @staticmethod
+    def cache_key(variables):
+        return json.dumps(variables, sort_keys=True)
+
+    # returns the cached response or None if it is missing or expired
+    def get(self, operation_name, variables):
+        row = self.conn.execute(
+            "SELECT response, fetched_at FROM hierarchy WHERE operation = ? AND variables = ?",
+            (operation_name, self.cache_key(variables))
+        ).fetchone()
+        if row is None or row[1] < self.opened_at or time.time() - row[1] > self.ttl:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, operation_name, variables, response):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO hierarchy (operation, variables, response, fetched_at) VALUES (?, ?, ?, ?)",
+            (operation_name, self.cache_key(variables), json.dumps(response), time.time())
+        )
+        self.conn.commit()
+
+    def close(self):
+        logging.info(f"Hierarchy cache: {self.hits} hits, {self.misses} misses.")
+        self.conn.close()
+
+
+# command line options shared by the crawlers
+def add_hierarchy_args(parser):
+    parser.add_argument("--refresh-hierarchy", action="store_true", help="ignore the cached state/district/block/village lists and fetch them again")
+    parser.add_argument("--hierarchy-ttl-days", type=float, default=HIERARCHY_TTL_DAYS, help="age after which cached hierarchy lookups are fetched again")
@@ -0,0 +1,109 @@
+import json
+import shutil
+import logging
+import argparse
+import tempfile
+
+import final_code
+from final_code import add_crawl_args, crawl_options
+from hierarchy_cache import HierarchyCache, HIERARCHY_CACHE_FILE, HIERARCHY_TTL_DAYS, HIERARCHY_OPERATIONS
+
+# headers of the captured request that belong to that one request or are set by requests itself
+SKIPPED_HEADERS = {"host", "content-length", "content-type", "connection", "accept-encoding", "accept"}
+
+
+# GraphQL POSTs the dashboard sent, from the performance log: {request_id: {"url", "headers", "body"}}.
+# The headers include the ones Chrome adds itself (cookies) from requestWillBeSentExtraInfo
+def graphql_requests(driver):
+    captured = {}
+    extra_headers = {}
+    for entry in driver.get_log("performance"):
+        message = json.loads(entry["message"])["message"]
+        method, params = message.get("method"), message.get("params", {})
+        if method == "Network.requestWillBeSent":
+            request = params["request"]
+            if request.get("method") != "POST" or "operationName" not in (request.get("postData") or ""):
+                continue
+            try:
+                body = json.loads(request["postData"])
+            except ValueError:
+                continue
+            captured[params["requestId"]] = {"url": request["url"], "headers": request.get("headers", {}), "body": body}
+        elif method == "Network.requestWillBeSentExtraInfo":
+            extra_headers[params["requestId"]] = params.get("headers", {})
+    for request_id, request in captured.items():
+        request["headers"] = {**request["headers"], **extra_headers.get(request_id, {})}
+    return captured
+
+
+# the headers worth replaying on direct API calls (cookies, tokens, origin), without HTTP/2 pseudo headers
+def session_headers(headers):
+    return {name: value for name, value in headers.items() if not name.startswith(":") and name.lower() not in SKIPPED_HEADERS}
+
+
+# stores the state/district/block/village lookups the page already fetched, so the crawl does not ask again
+def seed_hierarchy_cache(driver, cache, captured):
+    stored = 0
+    for request_id, request in captured.items():
+        operation_name = request["body"].get("operationName")
+        if operation_name not in HIERARCHY_OPERATIONS:
+            continue
+        try:
+            response = driver.execute_cdp_cmd("Network.getResponseBody", {"requestId": request_id})
+            data = json.loads(response["body"]).get("data")
+        except Exception as e:
+            logging.warning(f"Could not read the captured {operation_name} response: {e}")
+            continue
+        if data:
+            cache.put(operation_name, request["body"].get("variables") or {}, data)
+            stored += 1
+    logging.info(f"Stored {stored} captured hierarchy responses in the cache.")
+
+
+# opens the dashboard once and returns the GraphQL url and session headers its own requests used
+def capture_session(headless=True, cache=None):
+    from practice import SoilHealthScraper
+
+    download_dir = tempfile.mkdtemp(prefix="hybrid_")
+    scraper = SoilHealthScraper(download_dir, headless=headless)
+    try:
+        scraper.open_dashboard()
+        captured = graphql_requests(scraper.driver)
+        if not captured:
+            raise RuntimeError("The dashboard sent no GraphQL request, there is no session to reuse")
+        if cache is not None:
+            seed_hierarchy_cache(scraper.driver, cache, captured)
+    finally:
+        scraper.quit()
+        shutil.rmtree(download_dir, ignore_errors=True)
+
+    request = list(captured.values())[-1]
+    headers = session_headers(request["headers"])
+    logging.info(f"Captured {len(captured)} GraphQL requests to {request['url']}, reusing headers: {sorted(headers)}")
+    print(f"Captured the dashboard session ({len(captured)} GraphQL requests), crawling through the API.")
+    return request["url"], headers
+
+
+# Hybrid mode: the browser only opens the dashboard to get a session (and the lookups it already made),
+# all nutrient data then comes from direct API calls by final_code.main
+def main(headless=True, hierarchy_ttl_days=HIERARCHY_TTL_DAYS, **crawl_options):
+    final_code.setup_logging(crawl_options.get("log_file", final_code.LOG_FILE))
+    cache = HierarchyCache(HIERARCHY_CACHE_FILE, ttl_days=hierarchy_ttl_days)
+    try:
+        api_url, headers = capture_session(headless=headless, cache=cache)
+    finally:
+        cache.close()
+    final_code.main(hierarchy_ttl_days=hierarchy_ttl_days, session_headers=headers, api_url=api_url, **crawl_options)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Get a session from the dashboard in a browser, then crawl the GraphQL API directly")
+    parser.add_argument("--show-browser", action="store_true", help="run Chrome with a window instead of headless")
+    add_crawl_args(parser)
+    args = parser.parse_args()
+
+    try:
+        main(headless=not args.show_browser, **crawl_options(args))
+    except Exception as e:
+        logging.error(f"An error occurred: {e}", exc_info=True)
+        print(f"An error occurred: {e}")
@@ -0,0 +1,224 @@
+import os
+import json
+import time
+import bisect
+import logging
+import threading
+from collections import deque
+
+METRICS_FILE = "crawl_metrics.json"
+METRICS_INTERVAL = 30
+# latency buckets in seconds for the Prometheus histograms
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+RECORD_BUCKETS = (0, 1, 10, 50, 100, 250, 500, 1000, 5000)
+# percentiles are computed over the most recent samples of each histogram
+RECENT_SAMPLES = 10_000
+# the ETA uses the blocks finished in this many seconds
+ETA_WINDOW = 600
+
+
+def label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def format_labels(key):
+    return "{" + ",".join(f'{name}="{value}"' for name, value in key) + "}" if key else ""
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.recent = deque(maxlen=RECENT_SAMPLES)
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.recent.append(value)
+
+    def percentile(self, q):
+        if not self.recent:
+            return None
+        values = sorted(self.recent)
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 3),
+            "p50": self.percentile(0.5),
+            "p90": self.percentile(0.9),
+            "p99": self.percentile(0.99),
+        }
+
+
+# Counters, gauges and histograms with labels, e.g. inc("requests_total", operation="GetBlocks").
+# Thread safe, shared by the transport and the crawl loop of a process
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.started = time.time()
+
+    def inc(self, name, value=1, **labels):
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            key = label_key(labels)
+            series[key] = series.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges.setdefault(name, {})[label_key(labels)] = value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            key = label_key(labels)
+            if key not in series:
+                series[key] = Histogram(buckets)
+            series[key].observe(value)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "time": time.time(),
+                "uptime_seconds": round(time.time() - self.started, 1),
+                "counters": {name: [dict(key, value=value) for key, value in series.items()] for name, series in self.counters.items()},
+                "gauges": {name: [dict(key, value=value) for key, value in series.items()] for name, series in self.gauges.items()},
+                "histograms": {name: [dict(key, **hist.summary()) for key, hist in series.items()] for name, series in self.histograms.items()},
+            }
+
+    def prometheus_text(self):
+        lines = []
+        with self.lock:
+            for name, series in self.counters.items():
+                lines.append(f"# TYPE soil_{name} counter")
+                lines += [f"soil_{name}{format_labels(key)} {value}" for key, value in series.items()]
+            for name, series in self.gauges.items():
+                lines.append(f"# TYPE soil_{name} gauge")
+                lines += [f"soil_{name}{format_labels(key)} {value}" for key, value in series.items()]
+            for name, series in self.histograms.items():
+                lines.append(f"# TYPE soil_{name} histogram")
+                for key, hist in series.items():
+                    cumulative = 0
+                    for bound, count in zip(list(hist.buckets) + ["+Inf"], hist.counts):
+                        cumulative += count
+                        lines.append(f"soil_{name}_bucket{format_labels(key + (('le', bound),))} {cumulative}")
+                    lines.append(f"soil_{name}_sum{format_labels(key)} {hist.sum}")
+                    lines.append(f"soil_{name}_count{format_labels(key)} {hist.count}")
+        return "\n".join(lines) + "\n"
+
+
+# process wide metrics, like the shared transport in final_code
+METRICS = Metrics()
+
+
+# Blocks left per state and an ETA from the recent finishing rate. Fed by the crawl loop,
+# read by the reporter thread
+class CrawlProgress:
+    def __init__(self, metrics=METRICS, remaining_by_state=None):
+        self.metrics = metrics
+        self.lock = threading.Lock()
+        self.finished = deque()
+        self.remaining = dict(remaining_by_state or {})
+        for state, count in self.remaining.items():
+            metrics.set("blocks_remaining", count, state=state)
+
+    # status as recorded in the ledger: done, empty, failed, or pending when the block will be retried
+    def block_finished(self, task, status, records=None):
+        self.metrics.inc("blocks_total", status=status)
+        if records is not None:
+            self.metrics.observe("records_per_block", records, buckets=RECORD_BUCKETS)
+        # a block that goes back to pending is still remaining
+        if status == "pending":
+            return
+        with self.lock:
+            state = task["state_name"]
+            if self.remaining.get(state):
+                self.remaining[state] -= 1
+                self.metrics.set("blocks_remaining", self.remaining[state], state=state)
+            self.finished.append(time.monotonic())
+
+    # time spent fetching a block, per state and in total per district to find the slow ones
+    def block_timed(self, task, seconds):
+        self.metrics.observe("block_seconds", seconds, state=task["state_name"])
+        self.metrics.inc("district_seconds_total", seconds, state=task["state_name"], district=task["district_name"])
+
+    # (blocks per minute, seconds left) over the last ETA_WINDOW seconds, None while unknown
+    def eta(self):
+        with self.lock:
+            now = time.monotonic()
+            while self.finished and now - self.finished[0] > ETA_WINDOW:
+                self.finished.popleft()
+            remaining = sum(self.remaining.values())
+            if len(self.finished) < 2:
+                return None, None
+            rate = (len(self.finished) - 1) / max(now - self.finished[0], 1e-6)
+        return rate * 60, remaining / rate if rate else None
+
+
+# Writes the metrics every `interval` seconds from a background thread: json to path and
+# Prometheus text next to it (.prom), both replaced atomically, plus a progress line with the ETA
+class MetricsReporter:
+    def __init__(self, path=METRICS_FILE, interval=METRICS_INTERVAL, metrics=METRICS, progress=None):
+        self.path = path
+        self.interval = interval
+        self.metrics = metrics
+        self.progress = progress
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.interval and self.interval > 0:
+            self.thread = threading.Thread(target=self.run, daemon=True, name="metrics-reporter")
+            self.thread.start()
+        return self
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logging.error(f"Could not write metrics: {e}", exc_info=True)
+
+    def flush(self):
+        snapshot = self.metrics.snapshot()
+        if self.progress is not None:
+            blocks_per_min, eta_seconds = self.progress.eta()
+            remaining = sum(self.progress.remaining.values())
+            snapshot["progress"] = {"blocks_remaining": remaining, "blocks_per_min": blocks_per_min, "eta_seconds": eta_seconds}
+            if blocks_per_min is not None:
+                message = f"Progress: {remaining} blocks left, {blocks_per_min:.1f} blocks/min, ETA {format_duration(eta_seconds)}"
+                logging.info(message)
+                print(message)
+        write_atomic(self.path, json.dumps(snapshot, indent=2, default=str))
+        write_atomic(os.path.splitext(self.path)[0] + ".prom", self.metrics.prometheus_text())
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join(timeout=5)
+        self.flush()
+
+
+def format_duration(seconds):
+    if seconds is None:
+        return "unknown"
+    hours, rest = divmod(int(seconds), 3600)
+    return f"{hours}h{rest // 60:02d}m"
+
+
+def write_atomic(path, text):
+    with open(path + ".tmp", "w") as f:
+        f.write(text)
+    os.replace(path + ".tmp", path)
+
+
+# command line option shared by the crawlers
+def add_metrics_args(parser):
+    parser.add_argument("--metrics-interval", type=float, default=METRICS_INTERVAL, help=f"seconds between writes of {METRICS_FILE} (and .prom), 0 writes it only at the end")
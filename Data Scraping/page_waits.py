@@ -0,0 +1,149 @@
+import os
+import time
+import logging
+
+from selenium.common.exceptions import StaleElementReferenceException, TimeoutException
+from selenium.webdriver.common.by import By
+from selenium.webdriver.support.ui import WebDriverWait
+from selenium.webdriver.support import expected_conditions as EC
+
+WAIT_TIMEOUT = 15
+POLL_INTERVAL = 0.1
+# how long the network or an element has to stay unchanged before it counts as settled
+IDLE_TIME = 0.3
+SETTLE_TIME = 0.3
+
+LISTBOX_OPTIONS = "//ul[@role='listbox']//li"
+LOADING_INDICATORS = "//*[contains(@class, 'MuiCircularProgress-root') or contains(@class, 'MuiLinearProgress-root') or contains(@class, 'MuiBackdrop-root') and not(contains(@class, 'MuiBackdrop-invisible'))]"
+
+# counts the fetch/XHR requests the dashboard has in flight, installed before the page's own scripts run
+NETWORK_TRACKER_JS = """
+(() => {
+    if (window.__pendingRequests !== undefined) return;
+    window.__pendingRequests = 0;
+    window.__lastRequestChange = Date.now();
+    const change = (n) => { window.__pendingRequests += n; window.__lastRequestChange = Date.now(); };
+    const fetch = window.fetch;
+    window.fetch = function () {
+        change(1);
+        return fetch.apply(this, arguments).finally(() => change(-1));
+    };
+    const send = XMLHttpRequest.prototype.send;
+    XMLHttpRequest.prototype.send = function () {
+        change(1);
+        this.addEventListener('loadend', () => change(-1), { once: true });
+        return send.apply(this, arguments);
+    };
+})();
+"""
+
+
+# Waits on page conditions instead of fixed sleeps and records how long every kind of wait took,
+# so that the slow UI steps show up in the log
+class PageWaiter:
+    def __init__(self, driver, timeout=WAIT_TIMEOUT):
+        self.driver = driver
+        self.timeout = timeout
+        self.timings = {}
+        try:
+            driver.execute_cdp_cmd("Page.addScriptToEvaluateOnNewDocument", {"source": NETWORK_TRACKER_JS})
+        except Exception as e:
+            logging.warning(f"Could not install the network tracker, network idle waits fall back to document.readyState: {e}")
+
+    # waits until condition(driver) returns something truthy and records the time under step
+    def until(self, step, condition, timeout=None):
+        start = time.monotonic()
+        try:
+            return WebDriverWait(self.driver, timeout or self.timeout, poll_frequency=POLL_INTERVAL,
+                                 ignored_exceptions=(StaleElementReferenceException,)).until(condition)
+        except TimeoutException:
+            raise TimeoutException(f"Timed out after {timeout or self.timeout}s waiting for {step}")
+        finally:
+            self.timings.setdefault(step, []).append(time.monotonic() - start)
+
+    def clickable(self, xpath, step=None):
+        return self.until(step or f"clickable {xpath}", EC.element_to_be_clickable((By.XPATH, xpath)))
+
+    def click(self, xpath, step=None):
+        self.clickable(xpath, step).click()
+
+    # the page has loaded and no fetch/XHR has been in flight for IDLE_TIME
+    def network_idle(self, step="network idle"):
+        def idle(driver):
+            state = driver.execute_script(
+                "return [document.readyState, window.__pendingRequests, Date.now() - (window.__lastRequestChange || 0)];"
+            )
+            ready, pending, quiet_ms = state
+            if ready != "complete":
+                return False
+            return pending is None or (pending == 0 and quiet_ms >= IDLE_TIME * 1000)
+        return self.until(step, idle)
+
+    # the MUI listbox is open and its options stopped changing, returns their texts
+    def listbox_options(self, step="listbox rendered"):
+        last = {"texts": None, "since": 0.0}
+
+        def rendered(driver):
+            texts = [el.text.strip() for el in driver.find_elements(By.XPATH, LISTBOX_OPTIONS)]
+            texts = [text for text in texts if text]
+            now = time.monotonic()
+            if texts != last["texts"]:
+                last["texts"], last["since"] = texts, now
+                return False
+            return texts if texts and now - last["since"] >= SETTLE_TIME else False
+        return self.until(step, rendered)
+
+    def listbox_closed(self, step="listbox closed"):
+        return self.until(step, EC.invisibility_of_element_located((By.XPATH, "//ul[@role='listbox']")))
+
+    # no spinner or backdrop is shown, e.g. after a filter changed the table
+    def loading_done(self, step="loading done"):
+        return self.until(step, lambda driver: not any(el.is_displayed() for el in driver.find_elements(By.XPATH, LOADING_INDICATORS)))
+
+    # waits until the button's enabled/disabled state has not changed for SETTLE_TIME and the page is idle,
+    # returns (button, is_disabled)
+    def button_settled(self, xpath, step="export button settled"):
+        last = {"disabled": None, "since": 0.0}
+
+        def settled(driver):
+            buttons = driver.find_elements(By.XPATH, xpath)
+            if not buttons:
+                return False
+            button = buttons[0]
+            disabled = "Mui-disabled" in (button.get_attribute("class") or "") or bool(button.get_attribute("disabled"))
+            now = time.monotonic()
+            if disabled != last["disabled"]:
+                last["disabled"], last["since"] = disabled, now
+                return False
+            if now - last["since"] < SETTLE_TIME or driver.execute_script("return window.__pendingRequests || 0;"):
+                return False
+            return button, disabled
+        return self.until(step, settled)
+
+    # a new csv (not in `before`) is in directory, no partial .crdownload is left and its size is stable.
+    # returns its path
+    def download_finished(self, directory, before, step="download finished"):
+        last = {"size": None}
+
+        def finished(driver):
+            names = os.listdir(directory)
+            if any(name.endswith((".crdownload", ".tmp")) for name in names):
+                return False
+            new = [os.path.join(directory, name) for name in names if name.endswith(".csv") and name not in before]
+            if not new:
+                return False
+            path = max(new, key=os.path.getmtime)
+            size = os.path.getsize(path)
+            if size != last["size"]:
+                last["size"] = size
+                return False
+            return path
+        return self.until(step, finished)
+
+    # (count, mean, max) seconds for every step
+    def summary(self):
+        return {step: (len(times), sum(times) / len(times), max(times)) for step, times in self.timings.items()}
+
+    def log_summary(self):
+        for step, (count, mean, longest) in sorted(self.summary().items(), key=lambda item: -item[1][0] * item[1][1]):
+            logging.info(f"Wait {step}: {count}x, mean {mean:.2f}s, max {longest:.2f}s, total {count * mean:.1f}s")
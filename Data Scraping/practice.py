@@ -2,27 +2,42 @@ import os
 import shutil
 import time
 import logging
-import pandas as pd
+import argparse
 from selenium import webdriver
 from selenium.webdriver.common.by import By
 from selenium.webdriver.common.keys import Keys
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.common.action_chains import ActionChains
+from selenium.common.exceptions import TimeoutException
+from page_waits import PageWaiter, LISTBOX_OPTIONS
+from downloads import DownloadManager, DownloadError, displayed_row_count
+from task_ledger import in_scope, add_scope_args, scope_options
 
-logging.basicConfig(
-    filename='scraper.log',
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s'
-)
+LOG_FILE = 'scraper.log'
+
+# configures logging for the dashboard scraper, called from the command line rather than on import
+def setup_logging(log_file=LOG_FILE):
+    logging.basicConfig(
+        filename=log_file,
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s'
+    )
 
 DOWNLOAD_TEMP = os.path.abspath("downloads_temp")
 DATA_DIR = os.path.abspath("data/raw")
 BASE_URL = "https://soilhealth.dac.gov.in/nutrient-dashboard"
 CYCLES = ["2023-24", "2024-25"]
 
+FILTER_BUTTON = "//button[contains(text(), 'Filter')]"
+CLOSE_BUTTON = "//button[contains(text(), 'Close')]"
+EXPORT_BUTTON = "//button[contains(text(), 'Export')]"
+CSV_OPTION = "//li[contains(text(), 'CSV')]"
+
 class SoilHealthScraper:
-    def __init__(self, download_dir):
+    def __init__(self, download_dir, headless=False):
+        self.download_dir = download_dir
+        self.cycle = None
         options = webdriver.ChromeOptions()
         prefs = {
             "download.default_directory": download_dir,
@@ -32,37 +47,114 @@ class SoilHealthScraper:
             "profile.default_content_setting_values.automatic_downloads": 1,
         }
         options.add_experimental_option("prefs", prefs)
+        # the download events are read from the performance log
+        options.set_capability("goog:loggingPrefs", {"performance": "ALL"})
         options.add_argument("--start-maximized")
+        if headless:
+            options.add_argument("--headless=new")
+            options.add_argument("--window-size=1920,1080")
+            options.add_argument("--disable-dev-shm-usage")
         self.driver = webdriver.Chrome(options=options)
         self.wait = WebDriverWait(self.driver, 15)
+        self.waiter = PageWaiter(self.driver)
+        self.downloads = DownloadManager(self.driver, download_dir, self.waiter)
+
+    # False once the browser or its driver has crashed
+    def is_alive(self):
+        try:
+            self.driver.current_url
+            return True
+        except Exception:
+            return False
+
+    def quit(self):
+        try:
+            self.driver.quit()
+        except Exception:
+            pass
+
+    def open_dashboard(self):
+        self.driver.get(BASE_URL)
+        self.driver.maximize_window()
+        self.waiter.network_idle("page loaded")
+        self.cycle = None
+
+        logging.info("Clicking Table View button")
+        self.waiter.click("//button[contains(text(), 'Table View')]", "table view button")
+        self.waiter.network_idle("table loaded")
+
+    def select_cycle(self, cycle):
+        if cycle != self.cycle:
+            logging.info(f"Selecting cycle: {cycle}")
+            self.click_dropdown_option("Cycle", cycle)
+            self.cycle = cycle
 
     def click_dropdown_option(self, drop_id, option_text):
         try:
             self.wait.until(EC.element_to_be_clickable((By.ID, drop_id))).click()
-            time.sleep(0.5)
-            options_xpath = "//ul[@role='listbox']//li"
-            options = self.wait.until(EC.presence_of_all_elements_located((By.XPATH, options_xpath)))
+            self.waiter.listbox_options(f"{drop_id} listbox rendered")
+            options = self.driver.find_elements(By.XPATH, LISTBOX_OPTIONS)
 
             for item in options:
                 if item.text.strip().upper() == option_text.strip().upper():
-                    # driver.execute_script("arguments[0].scrollIntoView(true);", item)
-                    # time.sleep(0.2)
                     item.click()
-                    time.sleep(0.5)
                     break
 
-            # Close dropdown overlay
-            # self.driver.find_element(By.TAG_NAME, 'body').send_keys(Keys.ESCAPE)
-            # time.sleep(0.5)
-            # WebDriverWait(self.driver, 5).until_not(
-            #     EC.presence_of_element_located((By.XPATH, "//ul[@role='listbox']"))
-            # )
+            # wait for the listbox to close and the table to load for the new selection
+            self.waiter.listbox_closed(f"{drop_id} listbox closed")
+            self.waiter.network_idle(f"{drop_id} selected")
 
         except Exception as e:
             logging.error(f"Dropdown click failed for {drop_id} -> {option_text}: {e}")
             raise
 
+    # lists the options of a dropdown inside the open filter without changing the selection
+    def dropdown_options(self, drop_id):
+        self.wait.until(EC.element_to_be_clickable((By.ID, drop_id))).click()
+        options = self.waiter.listbox_options(f"{drop_id} listbox rendered")
+        # click the dropdown again to close the listbox without selecting anything
+        self.wait.until(EC.element_to_be_clickable((By.ID, drop_id))).click()
+        self.waiter.listbox_closed(f"{drop_id} listbox closed")
+        return options
+
+    def open_filter(self):
+        self.waiter.click(FILTER_BUTTON, "filter button")
+        self.waiter.clickable("//*[@id='Block' or @id='State' or @id='District']", "filter open")
+
+    def close_filter(self):
+        self.waiter.click(CLOSE_BUTTON, "close button")
+        self.waiter.clickable(FILTER_BUTTON, "filter closed")
+        self.waiter.network_idle("table loaded")
+
+    # exports the open tab as csv to path. Returns False when the tab has no data
+    def export_tab(self, tab, path):
+        # clicking the Macro/Micro nutrition tab
+        self.waiter.click(f"//button[contains(text(), '{tab}')]", f"{tab} tab")
+        self.waiter.loading_done(f"{tab} loaded")
+
+        # Check if Export button is disabled or enabled, once it stopped changing
+        export_btn, is_disabled = self.waiter.button_settled(EXPORT_BUTTON)
+        if is_disabled:
+            return False
+
+        # Click Export > CSV
+        expected_rows = displayed_row_count(self.driver)
+        export_btn.click()
+        csv_option = self.waiter.clickable(CSV_OPTION, "csv option")
+        download = self.downloads.expect()
+        csv_option.click()
+
+        ActionChains(self.driver).move_by_offset(5, 5).click().perform() # or below we can use
+        # driver.find_element(By.TAG_NAME, "body").click()
+        self.waiter.until("export menu closed", EC.invisibility_of_element_located((By.XPATH, CSV_OPTION)))
+
+        rows = self.downloads.save(download, path, expected_rows)
+        logging.info(f"{tab} export has {rows} rows")
+        return True
+
+    # returns False if the block could not be exported, True otherwise (also when it has no data)
     def download_csv(self, cycle, state, district, block):
+        start = time.monotonic()
         try:
             logging.info(f"Scraping: {cycle} > {state} > {district} > {block}")
             block_dir = os.path.join(DATA_DIR, cycle, state, district)
@@ -71,100 +163,62 @@ class SoilHealthScraper:
             micro_path = os.path.join(block_dir, f'{cleaned_block}_micro.csv')
             logging.info(f'Downloading Macro for {cleaned_block}.....')
 
-            # Open Filter
-            self.wait.until(EC.element_to_be_clickable((By.XPATH, "//button[contains(text(), 'Filter')]"))).click()
-            time.sleep(0.5)
-
             # Select block
+            self.open_filter()
             self.click_dropdown_option("Block", block)
-            time.sleep(0.5)
-
-            # Close Filter
-            self.wait.until(EC.element_to_be_clickable((By.XPATH, "//button[contains(text(), 'Close')]"))).click()
-            time.sleep(0.5)
-
-            # clicking the Macro nutrition tab
-            self.wait.until(EC.presence_of_element_located((By.XPATH, f"//button[contains(text(), 'Macro-nutrients')]")))
-            self.wait.until(EC.element_to_be_clickable((By.XPATH, f"//button[contains(text(), 'Macro-nutrients')]"))).click()
-            time.sleep(0.5)
-
-            # Check if Export button is disabled or enabled
-            export_btn = self.driver.find_element(By.XPATH, "//button[contains(text(), 'Export')]")
-            is_disabled = "Mui-disabled" in export_btn.get_attribute("class") or export_btn.get_attribute("disabled")
-
-            if is_disabled:
-                logging.warning(f"SKipping (No Data): {cycle} | {state} | {district} | {block}")
-                return
-            
-            # Click Export > CSV
-            export_btn.click()
-            time.sleep(0.5)
-
-            self.wait.until(EC.element_to_be_clickable((By.XPATH, "//li[contains(text(), 'CSV')]"))).click()
-            time.sleep(1)
-            
-            ActionChains(self.driver).move_by_offset(5, 5).click().perform() # or below we can use
-            # driver.find_element(By.TAG_NAME, "body").click()
-            time.sleep(0.5)
-
-            timeout = 15
-            start = time.time()
-            downloaded = None
-            while time.time() - start < timeout:
-                files = [os.path.join(DOWNLOAD_TEMP, f) for f in os.listdir(DOWNLOAD_TEMP) if f.endswith('.csv')]
-                if files:
-                    downloaded = max(files, key=os.path.getctime)
-                    break
-                time.sleep(0.5)
-            if not downloaded:
-                logging.error(f"Download failed for {cleaned_block} Macro File")
-            
-            os.makedirs(os.path.dirname(macro_path), exist_ok=True)
-            shutil.move(downloaded, macro_path)
-            logging.info(f"Saved Macro CSV to {macro_path}")
-
-            # clicking the Micro nutrition tab
-            self.wait.until(EC.presence_of_element_located((By.XPATH, f"//button[contains(text(), 'Micro-nutrients')]")))
-            self.wait.until(EC.element_to_be_clickable((By.XPATH, f"//button[contains(text(), 'Micro-nutrients')]"))).click()
-            time.sleep(0.5)
-
-            # Check if Export button is disabled or enabled
-            export_btn = self.driver.find_element(By.XPATH, "//button[contains(text(), 'Export')]")
-            is_disabled = "Mui-disabled" in export_btn.get_attribute("class") or export_btn.get_attribute("disabled")
-
-            if is_disabled:
-                logging.warning(f"SKipping (No Data): {cycle} | {state} | {district} | {block}")
-                return
-            
-            # Click Export > CSV
-            export_btn.click()
-            time.sleep(0.5)
-
-            self.wait.until(EC.element_to_be_clickable((By.XPATH, "//li[contains(text(), 'CSV')]"))).click()
-            time.sleep(1)
-            
-            ActionChains(self.driver).move_by_offset(5, 5).click().perform() # or below we can use
-            # driver.find_element(By.TAG_NAME, "body").click()
-            time.sleep(0.5)
-
-            timeout = 15
-            start = time.time()
-            downloaded = None
-            while time.time() - start < timeout:
-                files = [os.path.join(DOWNLOAD_TEMP, f) for f in os.listdir(DOWNLOAD_TEMP) if f.endswith('.csv')]
-                if files:
-                    downloaded = max(files, key=os.path.getctime)
-                    break
-                time.sleep(0.5)
-            if not downloaded:
-                logging.error(f"Download failed for {cleaned_block} Micro File")
-            
-            os.makedirs(os.path.dirname(micro_path), exist_ok=True)
-            shutil.move(downloaded, micro_path)
-            logging.info(f"Saved Micro CSV to {micro_path}")
-        
+            self.close_filter()
+
+            for tab, path in (("Macro-nutrients", macro_path), ("Micro-nutrients", micro_path)):
+                try:
+                    if not self.export_tab(tab, path):
+                        logging.warning(f"SKipping (No Data): {cycle} | {state} | {district} | {block}")
+                        return True
+                except (TimeoutException, DownloadError) as e:
+                    logging.error(f"Download failed for {cleaned_block} {tab} File: {e}")
+                    return False
+                logging.info(f"Saved {tab} CSV to {path}")
+            return True
+
         except Exception as e:
             print(f"Error occured for block: {e}")
+            return False
+        finally:
+            logging.info(f"Block {cycle} | {state} | {district} | {block} took {time.monotonic() - start:.1f}s")
+
+    # The methods below select a whole path from the top, so a pool worker can be handed any
+    # state, district or block no matter what its page shows at the moment
+
+    def list_states(self, cycle):
+        self.select_cycle(cycle)
+        self.open_filter()
+        states = self.dropdown_options("State")
+        self.close_filter()
+        return states
+
+    def list_districts(self, cycle, state):
+        self.select_cycle(cycle)
+        self.open_filter()
+        self.click_dropdown_option("State", state)
+        districts = self.dropdown_options("District")
+        self.close_filter()
+        return districts
+
+    def list_blocks(self, cycle, state, district):
+        self.select_cycle(cycle)
+        self.open_filter()
+        self.click_dropdown_option("State", state)
+        self.click_dropdown_option("District", district)
+        blocks = self.dropdown_options("Block")
+        self.close_filter()
+        return blocks
+
+    def download_block(self, cycle, state, district, block):
+        self.select_cycle(cycle)
+        self.open_filter()
+        self.click_dropdown_option("State", state)
+        self.click_dropdown_option("District", district)
+        self.close_filter()
+        return self.download_csv(cycle, state, district, block)
 
     # def scrape_block(self, cycle, state, district, block):
     #     logging.info(f"Scraping: {cycle} > {state} > {district} > {block}")
@@ -179,83 +233,41 @@ class SoilHealthScraper:
     #     micro_success = self.download_csv(cycle, state, district, block, "Micro-nutrients", micro_path)
     #     logging.info(f"Micro result: {micro_success}")
 
-    def main(self):
-        os.makedirs(DOWNLOAD_TEMP, exist_ok=True)
+    # walks every state, district and block of the cycles, or only those in the scope (see task_ledger.in_scope)
+    def main(self, scope=None):
+        os.makedirs(self.download_dir, exist_ok=True)
         os.makedirs(DATA_DIR, exist_ok=True)
 
-        self.driver.get(BASE_URL)
-        self.driver.maximize_window()
-        time.sleep(1)
-
-        logging.info("Clicking Table View button")
-        self.wait.until(EC.element_to_be_clickable((By.XPATH, "//button[contains(text(), 'Table View')]"))).click()
-        time.sleep(1)
-
-        for cycle in CYCLES:
-            logging.info(f"Selecting cycle: {cycle}")
-            self.click_dropdown_option("Cycle", cycle)
-            time.sleep(0.5)
-
-            # Open Filter
-            self.wait.until(EC.element_to_be_clickable((By.XPATH, "//button[contains(text(), 'Filter')]"))).click()
-            time.sleep(0.5)
+        self.open_dashboard()
 
-            # Select state
-            self.wait.until(EC.element_to_be_clickable((By.ID, "State"))).click()
-            time.sleep(0.5)
+        for cycle in (scope or {}).get("cycles") or CYCLES:
+            self.select_cycle(cycle)
 
-            states = [el.text.strip() for el in self.driver.find_elements(By.XPATH, "//ul[@role='listbox']//li") if el.text.strip()]
+            # Open Filter and read the states
+            self.open_filter()
+            states = [state for state in self.dropdown_options("State") if in_scope(scope, "state", state, state)]
             logging.info(f"Found states: {states}")
-
-            # Select state again to avoid overlay issues
-            self.wait.until(EC.element_to_be_clickable((By.ID, "State"))).click()
-            time.sleep(0.5)
-
-            # Now finally close the filter
-            self.wait.until(EC.element_to_be_clickable((By.XPATH, "//button[contains(text(), 'Close')]"))).click()
-            time.sleep(1)
+            self.close_filter()
 
             for state in states:
                 try:
-                    self.wait.until(EC.element_to_be_clickable((By.XPATH, "//button[contains(text(), 'Filter')]"))).click()
-                    time.sleep(0.5)
-
+                    self.open_filter()
                     self.click_dropdown_option("State", state)
-                    time.sleep(0.5)
 
                     # Select District
-                    self.wait.until(EC.element_to_be_clickable((By.ID, 'District'))).click()
-                    time.sleep(0.5)
-
-                    districts = [el.text.strip() for el in self.driver.find_elements(By.XPATH, "//ul[@role='listbox']//li") if el.text.strip()]
+                    districts = [district for district in self.dropdown_options("District") if in_scope(scope, "district", district, district)]
                     logging.info(f"For State: {state}\nFound Districts: {districts}")
-
-                    self.wait.until(EC.element_to_be_clickable((By.ID, 'District'))).click()
-                    time.sleep(0.5)
-
-                    self.wait.until(EC.element_to_be_clickable((By.XPATH, "//button[contains(text(), 'Close')]"))).click()
-                    time.sleep(1)
+                    self.close_filter()
 
                     for district in districts:
                         try:
-                            self.wait.until(EC.element_to_be_clickable((By.XPATH, "//button[contains(text(), 'Filter')]"))).click()
-                            time.sleep(0.5)
-
+                            self.open_filter()
                             self.click_dropdown_option("District", district)
-                            time.sleep(0.5)
 
                             # Select Block
-                            self.wait.until(EC.element_to_be_clickable((By.ID, 'Block'))).click()
-                            time.sleep(0.5)
-
-                            blocks = [el.text.strip() for el in self.driver.find_elements(By.XPATH, "//ul[@role='listbox']//li") if el.text.strip()]
+                            blocks = [block for block in self.dropdown_options("Block") if in_scope(scope, "block", block, block)]
                             logging.info(f"For State: {state} and district: {district}\nFound Blocks: {blocks}")
-
-                            self.wait.until(EC.element_to_be_clickable((By.ID, 'Block'))).click()
-                            time.sleep(0.5)
-
-                            self.wait.until(EC.element_to_be_clickable((By.XPATH, "//button[contains(text(), 'Close')]"))).click()
-                            time.sleep(1)
+                            self.close_filter()
 
                             for block in blocks:
                                 self.download_csv(cycle, state, district, block)
@@ -264,12 +276,19 @@ class SoilHealthScraper:
                 except Exception as e:
                     logging.error(f"Failed State: {state} | {e}")
 
+        self.waiter.log_summary()
         self.driver.quit()
         try:
-            shutil.rmtree(DOWNLOAD_TEMP)
+            shutil.rmtree(self.download_dir)
         except Exception:
             pass
 
 if __name__ == "__main__":
-    scraper = SoilHealthScraper(download_dir=DOWNLOAD_TEMP)
-    scraper.main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Export the nutrient csvs from the Soil Health dashboard in Chrome")
+    parser.add_argument("--headless", action="store_true", help="run Chrome without a window")
+    add_scope_args(parser)
+    args = parser.parse_args()
+
+    setup_logging()
+    scraper = SoilHealthScraper(download_dir=DOWNLOAD_TEMP, headless=args.headless)
+    scraper.main(scope=scope_options(args))
\ No newline at end of file
@@ -0,0 +1,261 @@
+import os
+import time
+import sqlite3
+import logging
+import argparse
+
+import pandas as pd
+
+from consolidate import (
+    DATA_DIR, CONSOLIDATED_FILE, DEFAULT_WORKERS, ROW_COLUMNS, ConsolidatedStore, consolidate, normalise_name, normalise_column
+)
+
+# rollup tables, from the finest to the coarsest, with the columns they are grouped by
+LEVELS = {
+    "block": ["cycle", "state", "district", "block"],
+    "district": ["cycle", "state", "district"],
+    "state": ["cycle", "state"],
+}
+STATS = ["mean", "sum"]
+DEFAULT_TOP = 10
+# columns of soil_health that are not nutrient values
+NON_NUTRIENT_COLUMNS = set(ROW_COLUMNS) | {"consolidated_at"}
+
+
+def quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+# Query layer over the consolidated SQLite dataset (consolidate.py). Keeps rollup tables per block,
+# district and state holding, for every nutrient column, the sum and the number of villages with a
+# value, so averages and totals at any level are read from a few thousand rows instead of every village.
+# Rollups are refreshed for the blocks consolidated since the last refresh
+class SoilHealthQueries:
+    def __init__(self, path=CONSOLIDATED_FILE):
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"No consolidated data in {path}, run: python query.py build")
+        self.path = path
+        # creates the soil_health table and its key indexes if the file is new
+        ConsolidatedStore(path).close()
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS soil_health_consolidated ON soil_health (consolidated_at)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS soil_health_village ON soil_health (village)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS rollup_info (name TEXT PRIMARY KEY, value TEXT)")
+
+    def nutrient_columns(self):
+        return [row[1] for row in self.conn.execute("PRAGMA table_info(soil_health)") if row[1] not in NON_NUTRIENT_COLUMNS]
+
+    def info(self, name, default=None):
+        row = self.conn.execute("SELECT value FROM rollup_info WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else default
+
+    def set_info(self, name, value):
+        self.conn.execute("INSERT OR REPLACE INTO rollup_info (name, value) VALUES (?, ?)", (name, str(value)))
+
+    # (re)creates the rollup tables with a _sum and _count column per nutrient
+    def create_rollups(self, columns):
+        for level, keys in LEVELS.items():
+            self.conn.execute(f"DROP TABLE IF EXISTS rollup_{level}")
+            value_columns = "".join(f", {quote(col + '_sum')} REAL, {quote(col + '_count')} INTEGER" for col in columns)
+            self.conn.execute(f"""
+                CREATE TABLE rollup_{level} (
+                    {", ".join(f"{key} TEXT NOT NULL" for key in keys)},
+                    villages INTEGER NOT NULL,
+                    blocks INTEGER NOT NULL{value_columns},
+                    PRIMARY KEY ({", ".join(keys)})
+                )
+            """)
+
+    # Brings the rollups up to date with soil_health. Only blocks with rows consolidated since the last
+    # refresh are summed again, then the district and state rollups are rebuilt from the block rollup.
+    # A new nutrient column (or full=True) rebuilds everything. Returns the number of blocks summed
+    def refresh_rollups(self, full=False):
+        columns = self.nutrient_columns()
+        refreshed_at = float(self.info("refreshed_at", 0))
+        now = self.conn.execute("SELECT COALESCE(MAX(consolidated_at), 0) FROM soil_health").fetchone()[0]
+        block_keys = ", ".join(LEVELS["block"])
+        sums = "".join(f", SUM({quote(col)}), COUNT({quote(col)})" for col in columns)
+
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            if full or self.info("columns") != ",".join(columns):
+                self.create_rollups(columns)
+                refreshed_at = 0
+            changed = f"SELECT DISTINCT {block_keys} FROM soil_health WHERE consolidated_at > ?"
+            self.conn.execute(f"DELETE FROM rollup_block WHERE ({block_keys}) IN ({changed})", (refreshed_at,))
+            blocks = self.conn.execute(f"""
+                INSERT INTO rollup_block
+                SELECT {block_keys}, COUNT(*), 1{sums}
+                FROM soil_health
+                WHERE ({block_keys}) IN ({changed})
+                GROUP BY {block_keys}
+            """, (refreshed_at,)).rowcount
+
+            # the coarser levels are small, they are summed again from the finer one every time
+            for level, finer in (("district", "block"), ("state", "district")):
+                keys = ", ".join(LEVELS[level])
+                rolled = "".join(f", SUM({quote(col + '_sum')}), SUM({quote(col + '_count')})" for col in columns)
+                self.conn.execute(f"DELETE FROM rollup_{level}")
+                self.conn.execute(f"INSERT INTO rollup_{level} SELECT {keys}, SUM(villages), SUM(blocks){rolled} FROM rollup_{finer} GROUP BY {keys}")
+            self.set_info("refreshed_at", now)
+            self.set_info("columns", ",".join(columns))
+        logging.info(f"Rollups refreshed for {blocks} blocks.")
+        return blocks
+
+    # the given nutrient columns, all of them when none are given. Accepts names as in the raw files ("N High")
+    def resolve_columns(self, columns=None):
+        known = self.nutrient_columns()
+        if not columns:
+            return known
+        resolved = [normalise_column(col) for col in columns]
+        unknown = [col for col in resolved if col not in known]
+        if unknown:
+            raise ValueError(f"Unknown nutrient columns {unknown}, known: {', '.join(known)}")
+        return resolved
+
+    # WHERE clause and parameters for the cycle/state/district/block filters that are set
+    def where(self, filters):
+        conditions, params = [], []
+        for key in LEVELS["block"]:
+            value = (filters or {}).get(key)
+            if value is not None:
+                conditions.append(f"{key} = ?")
+                params.append(value if key == "cycle" else normalise_name(value))
+        return (" WHERE " + " AND ".join(conditions)) if conditions else "", params
+
+    # the finest rollup needed for the level and the filters, e.g. block rollups for a district total of one block
+    def source_level(self, level, filters):
+        for finer in LEVELS:
+            if finer == level or (filters or {}).get(finer) is not None:
+                return finer
+        return level
+
+    # One row per unit of `level` (block, district or state) matching the filters, with the number of
+    # villages and blocks and the mean (per village with a value) or the sum of each nutrient column
+    def aggregate(self, level="district", filters=None, columns=None, stat="mean"):
+        columns = self.resolve_columns(columns)
+        keys = ", ".join(LEVELS[level])
+        if stat == "sum":
+            values = "".join(f", SUM({quote(col + '_sum')}) AS {quote(col)}" for col in columns)
+        else:
+            values = "".join(f", SUM({quote(col + '_sum')}) / NULLIF(SUM({quote(col + '_count')}), 0) AS {quote(col)}" for col in columns)
+        where, params = self.where(filters)
+        sql = (f"SELECT {keys}, SUM(villages) AS villages, SUM(blocks) AS blocks{values} "
+               f"FROM rollup_{self.source_level(level, filters)}{where} GROUP BY {keys} ORDER BY {keys}")
+        return pd.read_sql_query(sql, self.conn, params=params)
+
+    # the n units of `level` with the highest (or lowest) mean or sum of one nutrient column
+    def top(self, column, level="district", n=DEFAULT_TOP, filters=None, stat="mean", ascending=False):
+        column = self.resolve_columns([column])[0]
+        keys = ", ".join(LEVELS[level])
+        if stat == "sum":
+            value = f"SUM({quote(column + '_sum')})"
+        else:
+            value = f"SUM({quote(column + '_sum')}) / NULLIF(SUM({quote(column + '_count')}), 0)"
+        where, params = self.where(filters)
+        sql = (f"SELECT {keys}, SUM(villages) AS villages, {value} AS {quote(column)} "
+               f"FROM rollup_{self.source_level(level, filters)}{where} GROUP BY {keys} "
+               f"HAVING {quote(column)} IS NOT NULL ORDER BY {quote(column)} {'ASC' if ascending else 'DESC'} LIMIT ?")
+        return pd.read_sql_query(sql, self.conn, params=params + [n])
+
+    # villages matching the filters, straight from soil_health
+    def villages(self, filters=None, columns=None, limit=None):
+        columns = self.resolve_columns(columns)
+        where, params = self.where(filters)
+        sql = f"SELECT {', '.join(ROW_COLUMNS)}{''.join(', ' + quote(col) for col in columns)} FROM soil_health{where} ORDER BY {', '.join(ROW_COLUMNS)}"
+        if limit:
+            sql += " LIMIT ?"
+            params.append(limit)
+        return pd.read_sql_query(sql, self.conn, params=params)
+
+    def close(self):
+        self.conn.close()
+
+
+# consolidates new or changed raw csvs and refreshes the rollups
+def build(data_dir=DATA_DIR, db=CONSOLIDATED_FILE, workers=DEFAULT_WORKERS, full=False):
+    consolidate(data_dir=data_dir, output=db, workers=workers, full=full)
+    queries = SoilHealthQueries(db)
+    try:
+        start = time.time()
+        blocks = queries.refresh_rollups(full=full)
+        print(f"Rollups refreshed for {blocks} blocks in {time.time() - start:.1f}s.")
+    finally:
+        queries.close()
+
+
+def add_filter_args(parser):
+    parser.add_argument("--cycle", help="e.g. 2024-25")
+    parser.add_argument("--state")
+    parser.add_argument("--district")
+    parser.add_argument("--block")
+    parser.add_argument("--db", default=CONSOLIDATED_FILE, help="consolidated SQLite file")
+    parser.add_argument("--csv", help="also save the result to this csv file")
+
+
+def filter_options(args):
+    return {"cycle": args.cycle, "state": args.state, "district": args.district, "block": args.block}
+
+
+def print_result(df, args, elapsed):
+    with pd.option_context("display.max_rows", None, "display.max_columns", None, "display.width", 200):
+        print(df.to_string(index=False) if not df.empty else "No matching rows.")
+    print(f"{len(df)} rows in {elapsed * 1000:.1f} ms")
+    if args.csv:
+        df.to_csv(args.csv, index=False)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S', filename='query.log', filemode='a')
+
+    parser = argparse.ArgumentParser(description="Query the consolidated Soil Health data")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = commands.add_parser("build", help="consolidate new raw csvs and refresh the rollups")
+    build_parser.add_argument("--data-dir", default=DATA_DIR, help="folder with the raw {cycle}/{state}/{district}/*.csv files")
+    build_parser.add_argument("--db", default=CONSOLIDATED_FILE, help="consolidated SQLite file")
+    build_parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="processes reading csv files")
+    build_parser.add_argument("--full", action="store_true", help="read every file and rebuild every rollup")
+
+    summary_parser = commands.add_parser("summary", help="mean or total nutrient values per block, district or state")
+    summary_parser.add_argument("--level", choices=list(LEVELS), default="district")
+    summary_parser.add_argument("--columns", nargs="+", help="nutrient columns, e.g. n_high p_low (default: all)")
+    summary_parser.add_argument("--stat", choices=STATS, default="mean", help="mean per village or total")
+    add_filter_args(summary_parser)
+
+    top_parser = commands.add_parser("top", help="blocks, districts or states with the highest value of one nutrient column")
+    top_parser.add_argument("column", help="nutrient column, e.g. n_low")
+    top_parser.add_argument("--level", choices=list(LEVELS), default="district")
+    top_parser.add_argument("-n", type=int, default=DEFAULT_TOP, help="number of rows")
+    top_parser.add_argument("--stat", choices=STATS, default="mean", help="rank by mean per village or total")
+    top_parser.add_argument("--lowest", action="store_true", help="the lowest values instead")
+    add_filter_args(top_parser)
+
+    villages_parser = commands.add_parser("villages", help="village rows matching the filters")
+    villages_parser.add_argument("--columns", nargs="+", help="nutrient columns (default: all)")
+    villages_parser.add_argument("--limit", type=int, help="at most this many rows")
+    add_filter_args(villages_parser)
+    args = parser.parse_args()
+
+    try:
+        if args.command == "build":
+            build(data_dir=args.data_dir, db=args.db, workers=args.workers, full=args.full)
+        else:
+            queries = SoilHealthQueries(args.db)
+            try:
+                # rollups follow the data consolidated since the last query
+                queries.refresh_rollups()
+                start = time.perf_counter()
+                if args.command == "summary":
+                    result = queries.aggregate(args.level, filter_options(args), args.columns, args.stat)
+                elif args.command == "top":
+                    result = queries.top(args.column, args.level, args.n, filter_options(args), args.stat, args.lowest)
+                else:
+                    result = queries.villages(filter_options(args), args.columns, args.limit)
+                print_result(result, args, time.perf_counter() - start)
+            finally:
+                queries.close()
+    except Exception as e:
+        logging.error(f"An error occurred: {e}", exc_info=True)
+        print(f"An error occurred: {e}")
@@ -0,0 +1,155 @@
+import json
+import time
+import zlib
+import hashlib
+import sqlite3
+import logging
+import threading
+
+from transport import TransportError
+from metrics import METRICS
+
+RESPONSE_CACHE_FILE = "response_cache.db"
+RESPONSE_CACHE_MAX_MB = 1024
+# seconds a response stays fresh per operation, the hierarchy changes far less often than the nutrient data
+DAY = 24 * 3600
+RESPONSE_TTLS = {
+    "GetState": 30 * DAY,
+    "GetdistrictAndSubdistrictBystate": 30 * DAY,
+    "GetBlocks": 7 * DAY,
+    "GetVillageBydistrict": 7 * DAY,
+    "GetNutrientDashboardForPortal": 1 * DAY,
+}
+DEFAULT_TTL = 1 * DAY
+
+
+class ReplayMiss(TransportError):
+    pass
+
+
+# sha256 of the operation and its variables as sorted json, the query text itself is left out
+def cache_key(payload):
+    canonical = json.dumps([payload.get("operationName"), payload.get("variables") or {}], sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+# Whole GraphQL responses stored zlib compressed in SQLite under cache_key. Entries expire per operation
+# (RESPONSE_TTLS), the least recently used ones are dropped once the file holds more than max_mb.
+# With replay_only every cached response counts as fresh and a miss raises ReplayMiss instead of going online
+class ResponseCache:
+    def __init__(self, path=RESPONSE_CACHE_FILE, max_mb=RESPONSE_CACHE_MAX_MB, ttls=None, replay_only=False):
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.ttls = dict(RESPONSE_TTLS, **(ttls or {}))
+        self.replay_only = replay_only
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                operation TEXT NOT NULL,
+                variables TEXT NOT NULL,
+                body BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                fetched_at REAL NOT NULL,
+                used_at REAL NOT NULL
+            )
+        """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_used ON responses (used_at)")
+        self.conn.commit()
+        self.total_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def get(self, payload):
+        operation_name = payload.get("operationName")
+        key = cache_key(payload)
+        with self.lock:
+            row = self.conn.execute("SELECT body, fetched_at FROM responses WHERE key = ?", (key,)).fetchone()
+            fresh = row is not None and (self.replay_only or time.time() - row[1] <= self.ttls.get(operation_name, DEFAULT_TTL))
+            if fresh:
+                self.conn.execute("UPDATE responses SET used_at = ? WHERE key = ?", (time.time(), key))
+                self.conn.commit()
+        METRICS.inc("response_cache_total", operation=operation_name, result="hit" if fresh else "miss")
+        if fresh:
+            return json.loads(zlib.decompress(row[0]))
+        if self.replay_only:
+            raise ReplayMiss(f"{operation_name} {json.dumps(payload.get('variables'), sort_keys=True)} is not in the response cache")
+        return None
+
+    # only complete answers are kept, a response with GraphQL errors is fetched again next time
+    def put(self, payload, response):
+        if not isinstance(response, dict) or response.get("data") is None or response.get("errors"):
+            return
+        body = zlib.compress(json.dumps(response).encode(), 6)
+        now = time.time()
+        with self.lock:
+            old = self.conn.execute("SELECT size FROM responses WHERE key = ?", (cache_key(payload),)).fetchone()
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses (key, operation, variables, body, size, fetched_at, used_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (cache_key(payload), payload.get("operationName"), json.dumps(payload.get("variables") or {}, sort_keys=True), body, len(body), now, now)
+            )
+            self.total_bytes += len(body) - (old[0] if old else 0)
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+            self.conn.commit()
+
+    # drops least recently used entries until the cache is at 90% of max_bytes
+    def evict(self):
+        target = self.max_bytes * 0.9
+        removed = 0
+        while self.total_bytes > target:
+            rows = self.conn.execute("SELECT key, size FROM responses ORDER BY used_at LIMIT 1000").fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                if self.total_bytes <= target:
+                    break
+                self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.total_bytes -= size
+                removed += 1
+        logging.info(f"Response cache: evicted {removed} least recently used responses.")
+
+    def close(self):
+        self.conn.close()
+
+
+# wraps a Transport: answers from the cache and stores what the API returns
+class CachingTransport:
+    def __init__(self, transport, cache):
+        self.transport = transport
+        self.cache = cache
+
+    def post(self, payload):
+        response = self.cache.get(payload)
+        if response is None:
+            response = self.transport.post(payload)
+            self.cache.put(payload, response)
+        return response
+
+
+# same for an AsyncTransport
+class AsyncCachingTransport:
+    def __init__(self, transport, cache):
+        self.transport = transport
+        self.cache = cache
+
+    async def post(self, session, payload):
+        response = self.cache.get(payload)
+        if response is None:
+            response = await self.transport.post(session, payload)
+            self.cache.put(payload, response)
+        return response
+
+
+# command line options shared by the crawlers
+def add_cache_args(parser):
+    parser.add_argument("--response-cache", action="store_true", help=f"answer repeated API requests from {RESPONSE_CACHE_FILE}")
+    parser.add_argument("--replay-only", action="store_true", help="only use the response cache, never the network (implies --response-cache)")
+    parser.add_argument("--cache-max-mb", type=float, default=RESPONSE_CACHE_MAX_MB, help="size of the response cache before old responses are dropped")
+
+
+# the ResponseCache arguments from the command line, None when the cache is off
+def cache_options(args):
+    if not (args.response_cache or args.replay_only):
+        return None
+    return {"max_mb": args.cache_max_mb, "replay_only": args.replay_only}
@@ -0,0 +1,144 @@
+import os
+import logging
+import argparse
+import multiprocessing
+
+import final_code
+from final_code import CYCLES, add_crawl_args, crawl_options
+from hierarchy_cache import HierarchyCache, HIERARCHY_CACHE_FILE, HIERARCHY_TTL_DAYS
+from task_ledger import TaskLedger, LEDGER_FILE, shard_file, shard_of, is_partial
+
+# statuses that count as finished when checking coverage
+FINISHED_STATUSES = ("done", "empty")
+
+
+def task_key(task):
+    return (task["cycle"], task["state_id"], task["district_id"], task["block_id"])
+
+
+# lists the blocks (in the scope) once and splits them over the shard ledgers, so the workers do not each walk the hierarchy
+def seed_shards(workers, refresh_hierarchy=False, hierarchy_ttl_days=HIERARCHY_TTL_DAYS, scope=None):
+    cache = HierarchyCache(HIERARCHY_CACHE_FILE, ttl_days=hierarchy_ttl_days, refresh=refresh_hierarchy)
+    ledgers = [TaskLedger(shard_file(LEDGER_FILE, (index, workers))) for index in range(workers)]
+    for cycle in (scope or {}).get("cycles") or CYCLES:
+        if not refresh_hierarchy and all(ledger.is_seeded(cycle) for ledger in ledgers):
+            continue
+        print(f"Listing blocks for Cycle: {cycle}")
+        tasks, complete = final_code.list_tasks(cache, cycle, scope)
+        parts = [[] for _ in range(workers)]
+        for task in tasks:
+            parts[shard_of(task, workers)].append(task)
+        for ledger, part in zip(ledgers, parts):
+            ledger.add_tasks(part)
+            if complete and not is_partial(scope):
+                ledger.mark_seeded(cycle)
+        logging.info(f"Split {len(tasks)} blocks for {cycle} over {workers} shards: {[len(part) for part in parts]}")
+    for ledger in ledgers:
+        ledger.close()
+    cache.close()
+
+
+# runs one process per shard and waits for all of them, returns the shards that did not exit cleanly
+def run_workers(target, workers, **kwargs):
+    processes = []
+    for index in range(workers):
+        process = multiprocessing.Process(
+            target=target,
+            kwargs=dict(kwargs, shard=(index, workers)),
+            name=f"shard{index}of{workers}",
+        )
+        process.start()
+        processes.append(process)
+
+    for process in processes:
+        process.join()
+    failed = [process.name for process in processes if process.exitcode != 0]
+    for name in failed:
+        logging.error(f"Worker {name} stopped with an error, rerun it with --shard to finish its blocks.")
+    return failed
+
+
+# checks that the shard ledgers together cover every block exactly once and that every block is finished,
+# then merges them into the main ledger. Returns True when coverage is complete. With a scope only the blocks
+# inside it are checked and merged
+def merge_shards(workers, hierarchy_ttl_days=HIERARCHY_TTL_DAYS, scope=None):
+    cycles = (scope or {}).get("cycles") or CYCLES
+    cache = HierarchyCache(HIERARCHY_CACHE_FILE, ttl_days=hierarchy_ttl_days)
+    expected = set()
+    listing_complete = True
+    for cycle in cycles:
+        tasks, complete = final_code.list_tasks(cache, cycle, scope)
+        expected.update(task_key(task) for task in tasks)
+        listing_complete = listing_complete and complete
+    cache.close()
+
+    merged = TaskLedger(LEDGER_FILE)
+    seen = set()
+    overlapping = []
+    unfinished = []
+    missing_ledgers = []
+    for index in range(workers):
+        path = shard_file(LEDGER_FILE, (index, workers))
+        if not os.path.exists(path):
+            missing_ledgers.append(path)
+            continue
+        ledger = TaskLedger(path, scope)
+        rows = ledger.all_tasks()
+        ledger.close()
+        for row in rows:
+            key = task_key(row)
+            if key in seen:
+                overlapping.append(key)
+            seen.add(key)
+            if row["status"] not in FINISHED_STATUSES:
+                unfinished.append(key)
+        merged.import_tasks(rows)
+
+    missing = expected - seen
+    covered = listing_complete and not (missing_ledgers or missing or overlapping or unfinished)
+    if covered and not is_partial(scope):
+        for cycle in cycles:
+            merged.mark_seeded(cycle)
+    summary = merged.summary()
+    merged.close()
+
+    print(f"Merged {workers} shards: {len(seen)} of {len(expected)} blocks, {summary}")
+    for path in missing_ledgers:
+        print(f"Missing shard ledger: {path}")
+    if missing:
+        print(f"{len(missing)} blocks are in no shard, e.g. {sorted(missing)[:5]}")
+    if overlapping:
+        print(f"{len(overlapping)} blocks are in more than one shard, e.g. {overlapping[:5]}")
+    if unfinished:
+        print(f"{len(unfinished)} blocks are not finished yet, e.g. {unfinished[:5]}")
+    if not listing_complete:
+        print("Listing the blocks failed in part, coverage could not be fully checked.")
+    print("Coverage complete." if covered else "Coverage NOT complete.")
+    logging.info(f"Shard merge: expected={len(expected)} seen={len(seen)} missing={len(missing)} overlapping={len(overlapping)} unfinished={len(unfinished)} covered={covered}")
+    return covered
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a sharded crawl over local worker processes, or merge shard ledgers")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--workers", type=int, help="run N shard processes on this machine, then merge")
+    group.add_argument("--merge", type=int, metavar="N", help="only merge and check the ledgers of N shards (e.g. copied from several machines)")
+    parser.add_argument("--async", dest="use_async", action="store_true", help="use the async crawler in each worker")
+    add_crawl_args(parser, shard=False)
+    args = parser.parse_args()
+
+    options = crawl_options(args)
+    final_code.setup_logging(args.log_file)
+    if args.merge:
+        merge_shards(args.merge, hierarchy_ttl_days=args.hierarchy_ttl_days, scope=options["scope"])
+    else:
+        if args.use_async:
+            import async_crawler
+            target = async_crawler.main
+        else:
+            target = final_code.main
+
+        # the blocks are listed (and the hierarchy refreshed) once here, not again by every worker
+        seed_shards(args.workers, refresh_hierarchy=options.pop("refresh_hierarchy"), hierarchy_ttl_days=args.hierarchy_ttl_days, scope=options["scope"])
+        run_workers(target, args.workers, **options)
+        merge_shards(args.workers, hierarchy_ttl_days=args.hierarchy_ttl_days, scope=options["scope"])
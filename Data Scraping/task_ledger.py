@@ -0,0 +1,318 @@
+import os
+import time
+import socket
+import hashlib
+import argparse
+import sqlite3
+import logging
+
+LEDGER_FILE = "crawl_ledger.db"
+
+# pending -> running -> done / empty, or back to pending (failed once) / failed (MAX_TRIES reached)
+TASK_STATUSES = ["pending", "running", "done", "empty", "failed"]
+TASK_COLUMNS = ["cycle", "state_id", "state_name", "district_id", "district_name", "block_id", "block_name"]
+
+
+# parses "i/N" from the command line into (i, N)
+def parse_shard(text):
+    try:
+        index, count = (int(part) for part in text.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"shard must look like i/N, got {text!r}")
+    if count < 1 or not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"shard index must be between 0 and N-1, got {text!r}")
+    return index, count
+
+
+# deterministic shard of a block, the same on every machine and every run
+def shard_of(task, count):
+    key = f"{task['cycle']}|{task['state_id']}|{task['district_id']}|{task['block_id']}"
+    return int(hashlib.md5(key.encode()).hexdigest()[:8], 16) % count
+
+
+def in_shard(task, shard):
+    return shard is None or shard_of(task, shard[1]) == shard[0]
+
+
+# each shard has its own ledger and log, e.g. crawl_ledger.shard0of4.db
+def shard_file(path, shard):
+    if shard is None:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.shard{shard[0]}of{shard[1]}{ext}"
+
+
+# Scope of a run: {"cycles": [...], "state": ..., "district": ..., "block": ...}, anything left out (None)
+# is not limited. A place matches on its id or its name, ignoring case
+SCOPE_LEVELS = ["state", "district", "block"]
+
+
+def name_matches(value, item_id, name):
+    value = value.strip().lower()
+    return value == str(item_id).lower() or value == (name or "").strip().lower()
+
+
+# True if the state/district/block (level) with this id and name is inside the scope
+def in_scope(scope, level, item_id, name):
+    value = (scope or {}).get(level)
+    return value is None or name_matches(value, item_id, name)
+
+
+# True if the scope covers only part of a cycle, so its listing does not count as the complete cycle
+def is_partial(scope):
+    return any((scope or {}).get(level) is not None for level in SCOPE_LEVELS)
+
+
+# the scope as extra conditions on the tasks table: (" AND ...", params)
+def scope_filter(scope):
+    conditions, params = [], []
+    if (scope or {}).get("cycles"):
+        conditions.append(f"cycle IN ({', '.join('?' * len(scope['cycles']))})")
+        params += scope["cycles"]
+    for level in SCOPE_LEVELS:
+        value = (scope or {}).get(level)
+        if value is not None:
+            # the same comparison as name_matches, so listing and claiming agree on what is in scope
+            conditions.append(f"(LOWER({level}_id) = LOWER(?) OR LOWER(TRIM({level}_name)) = LOWER(?))")
+            params += [value.strip(), value.strip()]
+    return "".join(" AND " + condition for condition in conditions), params
+
+
+# command line options shared by the crawlers
+def add_scope_args(parser):
+    parser.add_argument("--cycle", action="append", dest="cycles", help="only this cycle, e.g. 2024-25 (can be given more than once)")
+    parser.add_argument("--state", help="only this state (name or id)")
+    parser.add_argument("--district", help="only this district (name or id)")
+    parser.add_argument("--block", help="only this block (name or id)")
+
+
+def scope_options(args):
+    scope = {"cycles": args.cycles, "state": args.state, "district": args.district, "block": args.block}
+    return scope if any(scope.values()) else None
+
+
+# name of this process in the ledger, so a restart can tell its own dead tasks from other workers' live ones
+def worker_name():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+# One row per (cycle, block) with its status, attempts, last error and timings. With a scope, claiming,
+# requeueing, ranking and counting only touch the tasks inside it
+class TaskLedger:
+    def __init__(self, path=LEDGER_FILE, scope=None):
+        self.path = path
+        self.scope_sql, self.scope_params = scope_filter(scope)
+        self.worker = worker_name()
+        # autocommit mode, claims use an explicit BEGIN IMMEDIATE so that parallel workers never get the same task
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS tasks (
+                cycle TEXT NOT NULL,
+                state_id TEXT NOT NULL,
+                state_name TEXT,
+                district_id TEXT NOT NULL,
+                district_name TEXT,
+                block_id TEXT NOT NULL,
+                block_name TEXT,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                retry INTEGER NOT NULL DEFAULT 0,
+                last_error TEXT,
+                records INTEGER,
+                worker TEXT,
+                queued_at REAL,
+                started_at REAL,
+                finished_at REAL,
+                content_hash TEXT,
+                fetched_at REAL,
+                villages INTEGER,
+                priority REAL NOT NULL DEFAULT 0,
+                PRIMARY KEY (cycle, state_id, district_id, block_id)
+            )
+        """)
+        self.add_missing_columns({"content_hash": "TEXT", "fetched_at": "REAL", "villages": "INTEGER", "priority": "REAL NOT NULL DEFAULT 0"})
+        self.conn.execute("CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status, retry)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS tasks_queue ON tasks (status, priority DESC)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS tasks_block ON tasks (state_id, district_id, block_id)")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS seeded_cycles (
+                cycle TEXT PRIMARY KEY,
+                seeded_at REAL NOT NULL
+            )
+        """)
+
+    # ledgers made by an older version get the newer columns added
+    def add_missing_columns(self, columns):
+        existing = {row["name"] for row in self.conn.execute("PRAGMA table_info(tasks)")}
+        for name, column_type in columns.items():
+            if name not in existing:
+                self.conn.execute(f"ALTER TABLE tasks ADD COLUMN {name} {column_type}")
+
+    def is_seeded(self, cycle):
+        return self.conn.execute("SELECT 1 FROM seeded_cycles WHERE cycle = ?", (cycle,)).fetchone() is not None
+
+    def mark_seeded(self, cycle):
+        self.conn.execute("INSERT OR REPLACE INTO seeded_cycles (cycle, seeded_at) VALUES (?, ?)", (cycle, time.time()))
+
+    # adds new blocks as pending, blocks that are already in the ledger keep their status
+    def add_tasks(self, tasks):
+        now = time.time()
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            before = self.conn.total_changes
+            self.conn.executemany(
+                f"INSERT OR IGNORE INTO tasks ({', '.join(TASK_COLUMNS)}, queued_at) VALUES ({', '.join('?' * len(TASK_COLUMNS))}, ?)",
+                [[task[col] for col in TASK_COLUMNS] + [now] for task in tasks]
+            )
+            return self.conn.total_changes - before
+
+    # picks the pending task with the highest priority (in listing order among equals) and marks it running,
+    # returns None when nothing is left
+    def claim(self, retry_only=False):
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            row = self.conn.execute(
+                "SELECT rowid, * FROM tasks WHERE status = 'pending'" + (" AND retry = 1" if retry_only else "") + self.scope_sql + " ORDER BY priority DESC, rowid LIMIT 1",
+                self.scope_params
+            ).fetchone()
+            if row is None:
+                return None
+            self.conn.execute(
+                "UPDATE tasks SET status = 'running', attempts = attempts + 1, worker = ?, started_at = ?, finished_at = NULL WHERE rowid = ?",
+                (self.worker, time.time(), row["rowid"])
+            )
+        task = dict(row)
+        task["attempts"] += 1
+        return task
+
+    # records the result of a block, content_hash is the sha256 of its csv (None when there was no data)
+    def mark_done(self, task, records, content_hash=None):
+        status = "empty" if records == 0 else "done"
+        now = time.time()
+        self.conn.execute(
+            "UPDATE tasks SET status = ?, records = ?, content_hash = ?, last_error = NULL, retry = 0, finished_at = ?, fetched_at = ? WHERE rowid = ?",
+            (status, records, content_hash, now, now, task["rowid"])
+        )
+        return status
+
+    # a failed task goes back to pending until it has failed max_tries times
+    def mark_failed(self, task, error, max_tries):
+        status = "failed" if task["attempts"] >= max_tries else "pending"
+        self.conn.execute(
+            "UPDATE tasks SET status = ?, last_error = ?, finished_at = ? WHERE rowid = ?",
+            (status, str(error), time.time(), task["rowid"])
+        )
+        return status
+
+    # puts failed tasks back in the queue with a fresh set of attempts
+    def requeue_failed(self):
+        cur = self.conn.execute("UPDATE tasks SET status = 'pending', attempts = 0, retry = 1 WHERE status = 'failed'" + self.scope_sql, self.scope_params)
+        return cur.rowcount
+
+    # finished blocks that were fetched more than max_age_days ago, or belong to the active cycle, go back to pending
+    def requeue_stale(self, max_age_days, active_cycle=None):
+        cur = self.conn.execute(
+            "UPDATE tasks SET status = 'pending', attempts = 0 WHERE status IN ('done', 'empty') AND (fetched_at IS NULL OR fetched_at < ? OR cycle = ?)" + self.scope_sql,
+            [time.time() - max_age_days * 24 * 3600, active_cycle] + self.scope_params
+        )
+        return cur.rowcount
+
+    # pending blocks whose village count is not known yet and that have no earlier result (in any cycle)
+    def unprobed_tasks(self, retry_only=False):
+        return [dict(row) for row in self.conn.execute(
+            "SELECT rowid, * FROM tasks t WHERE status = 'pending' AND villages IS NULL" + (" AND retry = 1" if retry_only else "") +
+            " AND NOT EXISTS (SELECT 1 FROM tasks h WHERE h.state_id = t.state_id AND h.district_id = t.district_id"
+            " AND h.block_id = t.block_id AND h.records IS NOT NULL)" + self.scope_sql + " ORDER BY rowid",
+            self.scope_params
+        )]
+
+    def set_villages(self, task, villages):
+        self.conn.execute("UPDATE tasks SET villages = ? WHERE rowid = ?", (villages, task["rowid"]))
+
+    # Ranks the pending blocks by the records they are expected to yield. A block that was fetched before
+    # (in this or another cycle) expects as many as its best earlier result; one that only ever came back
+    # empty gets minus the number of empty results, so it goes last and later the more often it was empty.
+    # Otherwise the probed village count is used (no villages counts as empty once). Unknown blocks get 0
+    # and keep the listing order between the expected yields and the empty ones
+    def update_priorities(self):
+        cur = self.conn.execute("""
+            UPDATE tasks SET priority = COALESCE(
+                (SELECT CASE WHEN COUNT(*) = 0 THEN NULL WHEN MAX(h.records) > 0 THEN MAX(h.records) ELSE -COUNT(*) END
+                 FROM tasks h
+                 WHERE h.state_id = tasks.state_id AND h.district_id = tasks.district_id AND h.block_id = tasks.block_id
+                   AND h.records IS NOT NULL),
+                CASE WHEN villages = 0 THEN -1 ELSE villages END,
+                0
+            )
+            WHERE status = 'pending'
+        """ + self.scope_sql, self.scope_params)
+        return cur.rowcount
+
+    # pending blocks that came back empty at least min_empty times (and never with data) are recorded as
+    # empty again without being fetched
+    def skip_known_empty(self, min_empty):
+        cur = self.conn.execute(
+            "UPDATE tasks SET status = 'empty', records = 0, last_error = NULL, finished_at = ? WHERE status = 'pending' AND priority <= ?" + self.scope_sql,
+            [time.time(), -min_empty] + self.scope_params
+        )
+        return cur.rowcount
+
+    # tasks left running by a process on this host that no longer exists (crash, kill) go back to pending
+    def release_dead_workers(self):
+        host = socket.gethostname()
+        released = 0
+        for row in self.conn.execute("SELECT DISTINCT worker FROM tasks WHERE status = 'running'").fetchall():
+            worker = row["worker"] or ""
+            worker_host, _, pid = worker.rpartition(":")
+            if worker_host == host and pid.isdigit() and not pid_alive(int(pid)):
+                cur = self.conn.execute("UPDATE tasks SET status = 'pending' WHERE status = 'running' AND worker = ?", (worker,))
+                released += cur.rowcount
+        if released:
+            logging.info(f"Released {released} tasks left running by stopped workers.")
+        return released
+
+    # every task row, used to merge shard ledgers
+    def all_tasks(self):
+        return [dict(row) for row in self.conn.execute("SELECT * FROM tasks WHERE 1" + self.scope_sql + " ORDER BY rowid", self.scope_params)]
+
+    # copies task rows from another ledger, keeping their status, attempts and timings
+    def import_tasks(self, rows):
+        if not rows:
+            return
+        columns = list(rows[0].keys())
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            self.conn.executemany(
+                f"INSERT OR REPLACE INTO tasks ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+                [[row[col] for col in columns] for row in rows]
+            )
+
+    # pending and running blocks per state name
+    def remaining_by_state(self, retry_only=False):
+        return {row["state_name"]: row["n"] for row in self.conn.execute(
+            "SELECT state_name, COUNT(*) AS n FROM tasks WHERE status IN ('pending', 'running')" + (" AND retry = 1" if retry_only else "") + self.scope_sql + " GROUP BY state_name",
+            self.scope_params
+        )}
+
+    # tasks per status, inside the scope
+    def summary(self):
+        counts = dict.fromkeys(TASK_STATUSES, 0)
+        for row in self.conn.execute("SELECT status, COUNT(*) AS n FROM tasks WHERE 1 = 1" + self.scope_sql + " GROUP BY status", self.scope_params):
+            counts[row["status"]] = row["n"]
+        return counts
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,329 @@
+import os
+import json
+import time
+import random
+import asyncio
+import logging
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import METRICS
+
+DEFAULT_TIMEOUT = 30
+MAX_RETRIES = 5
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30
+
+# Starting request rate (requests per second) and the range the limiter may move it in
+DEFAULT_RATE = 5.0
+MIN_RATE = 0.2
+MAX_RATE = 50.0
+# Responses slower than this count as a sign that the server is overloaded
+TARGET_LATENCY = 5.0
+
+# Status codes worth retrying, everything else in 4xx fails straight away
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Consecutive failures that open the circuit, and how long it stays open before a trial request
+BREAKER_THRESHOLD = 5
+BREAKER_RESET = 15
+BREAKER_RESET_MAX = 300
+
+
+class TransportError(Exception):
+    pass
+
+
+# token bucket whose rate follows AIMD: a small additive increase per success and a
+# multiplicative decrease on 429/5xx or slow responses (at most once per second)
+class RateLimiter:
+    def __init__(self, rate=DEFAULT_RATE, min_rate=MIN_RATE, max_rate=MAX_RATE, target_latency=TARGET_LATENCY,
+                 increase=1.0, decrease=0.5):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.target_latency = target_latency
+        self.increase = increase
+        self.decrease = decrease
+        self.tokens = 1.0
+        self.updated = time.monotonic()
+        self.last_decrease = 0.0
+        self.lock = threading.Lock()
+
+    # takes a token and returns how long the caller has to wait before using it
+    def reserve(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(max(self.rate, 1.0), self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def acquire(self):
+        delay = self.reserve()
+        if delay:
+            time.sleep(delay)
+
+    async def acquire_async(self):
+        delay = self.reserve()
+        if delay:
+            await asyncio.sleep(delay)
+
+    def on_success(self, latency):
+        if latency > self.target_latency:
+            self.on_throttle(f"slow response ({latency:.1f}s)")
+            return
+        with self.lock:
+            # roughly +increase requests/sec for every `rate` successes
+            self.rate = min(self.max_rate, self.rate + self.increase / self.rate)
+
+    def on_throttle(self, reason):
+        with self.lock:
+            now = time.monotonic()
+            if now - self.last_decrease < 1.0:
+                return
+            self.last_decrease = now
+            old_rate = self.rate
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+        logging.warning(f"Rate limit lowered from {old_rate:.2f} to {self.rate:.2f} req/s: {reason}")
+
+
+# closed -> open after BREAKER_THRESHOLD failures in a row. While open every request waits;
+# after the reset time one trial request goes through (half-open) and closes it again on success.
+# Each failed trial doubles the reset time up to BREAKER_RESET_MAX, a trial that never got an answer
+# (cancelled or interrupted) opens it again so that the next request becomes the trial
+class CircuitBreaker:
+    def __init__(self, threshold=BREAKER_THRESHOLD, reset_timeout=BREAKER_RESET, max_reset_timeout=BREAKER_RESET_MAX):
+        self.threshold = threshold
+        self.base_reset_timeout = reset_timeout
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.lock = threading.Lock()
+
+    # how long the caller has to wait before it may send (0 means go ahead) and whether it sends the trial request
+    def wait_time(self):
+        with self.lock:
+            if self.state == "closed":
+                return 0.0, False
+            now = time.monotonic()
+            if self.state == "open":
+                remaining = self.opened_at + self.reset_timeout - now
+                if remaining > 0:
+                    return remaining, False
+                self.state = "half-open"
+                logging.info("Circuit half-open, sending a trial request.")
+                return 0.0, True
+            # half-open, the trial request is still in flight
+            return 1.0, False
+
+    def record_success(self):
+        with self.lock:
+            if self.state != "closed":
+                logging.info("Circuit closed, requests resume.")
+            self.state = "closed"
+            self.failures = 0
+            self.reset_timeout = self.base_reset_timeout
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == "half-open":
+                self.reset_timeout = min(self.max_reset_timeout, self.reset_timeout * 2)
+            elif self.state == "open" or self.failures < self.threshold:
+                return
+            self.state = "open"
+            self.opened_at = time.monotonic()
+        logging.warning(f"Circuit open after {self.failures} failures, pausing requests for {self.reset_timeout}s.")
+
+    # the trial request ended without an answer, it counts as neither success nor failure
+    def abandon_trial(self):
+        with self.lock:
+            if self.state == "half-open":
+                self.state = "open"
+                self.opened_at = time.monotonic() - self.reset_timeout
+                logging.info("Circuit trial request abandoned, the next request is the trial.")
+
+    # waits until the caller may send, returns True if it sends the trial request
+    def wait(self):
+        while True:
+            delay, trial = self.wait_time()
+            if delay <= 0:
+                return trial
+            time.sleep(delay)
+
+    async def wait_async(self):
+        while True:
+            delay, trial = self.wait_time()
+            if delay <= 0:
+                return trial
+            await asyncio.sleep(delay)
+
+
+# exponential backoff with full jitter, a Retry-After header wins if the server sent one
+def backoff_delay(attempt, retry_after=None):
+    if retry_after:
+        try:
+            return min(BACKOFF_MAX, float(retry_after))
+        except ValueError:
+            pass
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+def record_success(metrics, operation_name, latency, size):
+    metrics.inc("requests_total", operation=operation_name, result="ok")
+    metrics.observe("request_seconds", latency, operation=operation_name)
+    metrics.inc("response_bytes_total", size, operation=operation_name)
+
+
+# posts GraphQL payloads with rate limiting, timeouts, retries and a circuit breaker
+class Transport:
+    def __init__(self, url, headers, rate_limiter=None, breaker=None, timeout=DEFAULT_TIMEOUT, max_retries=MAX_RETRIES, pool_size=10, metrics=None):
+        self.url = url
+        self.metrics = metrics or METRICS
+        self.headers = headers
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.breaker = breaker or CircuitBreaker()
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.pool_size = pool_size
+        self.session = None
+        self.pid = None
+
+    # a forked worker must not reuse the parent's pooled connections
+    def get_session(self):
+        if self.session is None or self.pid != os.getpid():
+            self.session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+            self.session.mount("http://", adapter)
+            self.session.mount("https://", adapter)
+            self.pid = os.getpid()
+        return self.session
+
+    def post(self, payload):
+        operation_name = payload.get("operationName")
+        for attempt in range(self.max_retries + 1):
+            trial = self.breaker.wait()
+            retry_after = None
+            try:
+                self.rate_limiter.acquire()
+                start = time.monotonic()
+                r = self.get_session().post(self.url, headers=self.headers, json=payload, timeout=self.timeout)
+                if r.status_code in RETRY_STATUSES:
+                    retry_after = r.headers.get("Retry-After")
+                    raise TransportError(f"{operation_name} returned HTTP {r.status_code}")
+                r.raise_for_status()
+                data = r.json()
+            except (TransportError, requests.ConnectionError, requests.Timeout) as e:
+                self.breaker.record_failure()
+                self.rate_limiter.on_throttle(str(e))
+                self.metrics.inc("requests_total", operation=operation_name, result="retryable_error")
+                if attempt == self.max_retries:
+                    self.metrics.inc("request_failures_total", operation=operation_name)
+                    raise TransportError(f"{operation_name} failed after {attempt + 1} attempts: {e}") from e
+                self.metrics.inc("retries_total", operation=operation_name)
+                delay = backoff_delay(attempt, retry_after)
+                logging.warning(f"{operation_name} attempt {attempt + 1} failed ({e}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+                continue
+            except Exception:
+                # a request that got an answer (e.g. 400) still means the server is up
+                self.breaker.record_success()
+                self.metrics.inc("requests_total", operation=operation_name, result="error")
+                self.metrics.inc("request_failures_total", operation=operation_name)
+                raise
+            except BaseException:
+                # cancelled (e.g. the async crawler dropping outstanding fetches) or interrupted
+                if trial:
+                    self.breaker.abandon_trial()
+                raise
+            latency = time.monotonic() - start
+            self.breaker.record_success()
+            self.rate_limiter.on_success(latency)
+            record_success(self.metrics, operation_name, latency, len(r.content))
+            return data
+
+
+# same as Transport for an aiohttp session, can share the limiter and breaker with it
+class AsyncTransport:
+    def __init__(self, url, headers, rate_limiter=None, breaker=None, timeout=DEFAULT_TIMEOUT, max_retries=MAX_RETRIES, metrics=None):
+        self.url = url
+        self.metrics = metrics or METRICS
+        self.headers = headers
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.breaker = breaker or CircuitBreaker()
+        self.timeout = timeout
+        self.max_retries = max_retries
+
+    async def post(self, session, payload):
+        import aiohttp
+
+        operation_name = payload.get("operationName")
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        for attempt in range(self.max_retries + 1):
+            trial = await self.breaker.wait_async()
+            retry_after = None
+            try:
+                await self.rate_limiter.acquire_async()
+                start = time.monotonic()
+                async with session.post(self.url, headers=self.headers, json=payload, timeout=timeout) as r:
+                    if r.status in RETRY_STATUSES:
+                        retry_after = r.headers.get("Retry-After")
+                        raise TransportError(f"{operation_name} returned HTTP {r.status}")
+                    r.raise_for_status()
+                    body = await r.read()
+                    data = json.loads(body)
+            except (TransportError, aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError) as e:
+                self.breaker.record_failure()
+                self.rate_limiter.on_throttle(str(e) or type(e).__name__)
+                self.metrics.inc("requests_total", operation=operation_name, result="retryable_error")
+                if attempt == self.max_retries:
+                    self.metrics.inc("request_failures_total", operation=operation_name)
+                    raise TransportError(f"{operation_name} failed after {attempt + 1} attempts: {e!r}") from e
+                self.metrics.inc("retries_total", operation=operation_name)
+                delay = backoff_delay(attempt, retry_after)
+                logging.warning(f"{operation_name} attempt {attempt + 1} failed ({e!r}), retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+                continue
+            except Exception:
+                self.breaker.record_success()
+                self.metrics.inc("requests_total", operation=operation_name, result="error")
+                self.metrics.inc("request_failures_total", operation=operation_name)
+                raise
+            except BaseException:
+                # cancelled (e.g. the async crawler dropping outstanding fetches) or interrupted
+                if trial:
+                    self.breaker.abandon_trial()
+                raise
+            latency = time.monotonic() - start
+            self.breaker.record_success()
+            self.rate_limiter.on_success(latency)
+            record_success(self.metrics, operation_name, latency, len(body))
+            return data
+
+
+# builds a Transport or AsyncTransport from the command line options
+def build_transport(transport_class, url, headers, rate=DEFAULT_RATE, max_rate=MAX_RATE, timeout=DEFAULT_TIMEOUT, max_retries=MAX_RETRIES):
+    rate_limiter = RateLimiter(rate=min(rate, max_rate), max_rate=max_rate)
+    return transport_class(url, headers, rate_limiter=rate_limiter, timeout=timeout, max_retries=max_retries)
+
+
+# command line options shared by the crawlers
+def add_transport_args(parser):
+    parser.add_argument("--rate", type=float, default=DEFAULT_RATE, help="starting request rate per second, adapts to the server")
+    parser.add_argument("--max-rate", type=float, default=MAX_RATE, help="highest request rate per second")
+    parser.add_argument("--timeout", type=float, default=DEFAULT_TIMEOUT, help="seconds to wait for a response")
+    parser.add_argument("--max-retries", type=int, default=MAX_RETRIES, help="retries per request on timeouts, 429 and 5xx")
+
+
+def transport_options(args):
+    return {
+        "rate": args.rate,
+        "max_rate": args.max_rate,
+        "timeout": args.timeout,
+        "max_retries": args.max_retries,
+    }
@@ -0,0 +1,296 @@
+import os
+import csv
+import json
+import math
+import sqlite3
+import hashlib
+import logging
+import argparse
+import threading
+
+from flatten import ID_COLUMNS
+from metrics import METRICS
+
+VILLAGE_INDEX_FILE = "village_index.db"
+REJECTS_FILE = os.path.join("data", "rejects.csv")
+# nutrient values are sample counts: whole numbers from 0 up to this
+MAX_VALUE = 1_000_000
+# keys looked up in one query
+LOOKUP_BATCH = 500
+REJECT_COLUMNS = ["reason", "cycle", "state_id", "district_id", "block_id", "village_id", "state", "district", "block", "village", "values"]
+
+
+# 16 byte digest, the index stores these instead of the key and row text
+def digest(text):
+    return hashlib.blake2b(text.encode(), digest_size=16).digest()
+
+
+def village_key(task, village_id):
+    return f"{task['cycle']}|{task['state_id']}|{task['district_id']}|{task['block_id']}|{village_id}"
+
+
+# the block a validated batch belongs to, by id so that renaming a block does not change it
+def block_key(task):
+    return f"{task['cycle']}/{task['state_id']}/{task['district_id']}/{task['block_id']}"
+
+
+def block_path(task):
+    return f"{task['cycle']}/{task['state_name']}/{task['district_name']}/{task['block_name']}"
+
+
+# reasons a row fails the range checks, empty when it passes. NaN means no value and is fine
+def range_errors(values, columns, max_value=MAX_VALUE):
+    errors = []
+    for col, value in zip(columns, values):
+        if math.isnan(value):
+            continue
+        if value < 0:
+            errors.append(f"{col} is negative ({value:g})")
+        elif value > max_value:
+            errors.append(f"{col} is above {max_value} ({value:g})")
+    return errors
+
+
+# the values are sample counts, fractions are kept but counted: many of them point to a change in the API
+def is_fractional(values):
+    return any(not math.isnan(value) and value != int(value) for value in values)
+
+
+# every row of a block that has data was rejected. Another try gets the same rows, so the block fails at once
+class ValidationError(Exception):
+    pass
+
+
+# Checks every flattened row before it is written. Each village is keyed on
+# (cycle, state_id, district_id, block_id, village_id) in an on-disk index (SQLite, 16 byte key digests and
+# an 8 byte hash of the values), so new, changed and unchanged villages are told apart with one indexed lookup
+# per row across every run. The index only learns a block's villages once the block is saved (commit), an
+# aborted block leaves nothing behind. Rows that repeat a key within a block or fail the range checks go to
+# the rejects csv instead of the output
+class VillageValidator:
+    def __init__(self, index_path=VILLAGE_INDEX_FILE, rejects_path=REJECTS_FILE, max_value=MAX_VALUE):
+        self.rejects_path = rejects_path
+        self.max_value = max_value
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(index_path, timeout=60, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS villages (
+                key BLOB PRIMARY KEY,
+                row_hash BLOB NOT NULL
+            ) WITHOUT ROWID
+        """)
+        self.drop_owners()
+        self.conn.commit()
+
+    # indexes from before kept the owning block of every village, the key already holds the block id
+    def drop_owners(self):
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(villages)")]
+        if "owner" not in columns:
+            return
+        logging.info("Dropping the owner column of the village index.")
+        self.conn.execute("CREATE TABLE villages_new (key BLOB PRIMARY KEY, row_hash BLOB NOT NULL) WITHOUT ROWID")
+        self.conn.execute("INSERT INTO villages_new (key, row_hash) SELECT key, row_hash FROM villages")
+        self.conn.execute("DROP TABLE villages")
+        self.conn.execute("ALTER TABLE villages_new RENAME TO villages")
+        self.conn.execute("DROP TABLE IF EXISTS owners")
+
+    def lookup(self, keys):
+        found = {}
+        for start in range(0, len(keys), LOOKUP_BATCH):
+            chunk = keys[start:start + LOOKUP_BATCH]
+            found.update(self.conn.execute(
+                f"SELECT key, row_hash FROM villages WHERE key IN ({', '.join('?' * len(chunk))})", chunk
+            ))
+        return found
+
+    # Returns the rows of df that pass and writes the others to the rejects file. pending holds the keys of the
+    # block accepted so far (key -> hash of the values, None when the index already has them), which catches
+    # duplicates across the batches of a block and is written to the index by commit() once the block is saved
+    def check(self, task, df, pending):
+        if df.empty:
+            return df
+        nutrient_columns = [col for col in df.columns if col not in ID_COLUMNS]
+        values = df[nutrient_columns].to_numpy(dtype="float64")
+        village_ids = df["village_id"].where(df["village_id"].notna(), df["village"]).astype(str).tolist()
+        keys = [digest(village_key(task, village_id)) for village_id in village_ids]
+
+        with self.lock:
+            indexed = self.lookup(keys)
+        keep, rejects, changed = [], [], []
+        counts = {"new": 0, "unchanged": 0, "changed": 0, "rejected": 0}
+        fractional = 0
+        for i, key in enumerate(keys):
+            reasons = range_errors(values[i], nutrient_columns, self.max_value)
+            if key in pending:
+                reasons.append("duplicate village id in the block")
+            if reasons:
+                rejects.append((i, "; ".join(reasons)))
+                counts["rejected"] += 1
+                continue
+            keep.append(i)
+            fractional += is_fractional(values[i])
+            row_hash = hashlib.blake2b(values[i].tobytes(), digest_size=8).digest()
+            if key not in indexed:
+                counts["new"] += 1
+            elif indexed[key] == row_hash:
+                counts["unchanged"] += 1
+                row_hash = None
+            else:
+                counts["changed"] += 1
+                changed.append(village_ids[i])
+            pending[key] = row_hash
+
+        for result, count in counts.items():
+            if count:
+                METRICS.inc("validated_rows_total", count, result=result)
+        if fractional:
+            METRICS.inc("fractional_rows_total", fractional)
+            logging.warning(f"{fractional} rows of {block_path(task)} have values that are not whole numbers, kept as they are.")
+        if changed:
+            logging.info(f"{len(changed)} villages of {block_path(task)} have other values than when they were last saved: {', '.join(changed[:10])}{', ...' if len(changed) > 10 else ''}")
+        if rejects:
+            logging.warning(f"Rejected {len(rejects)} of {len(df)} rows of {block_path(task)}, see {self.rejects_path}")
+            self.write_rejects(task, df, nutrient_columns, values, village_ids, rejects)
+        return df.iloc[keep].reset_index(drop=True) if rejects else df
+
+    def write_rejects(self, task, df, nutrient_columns, values, village_ids, rejects):
+        os.makedirs(os.path.dirname(self.rejects_path) or ".", exist_ok=True)
+        rows = []
+        for i, reason in rejects:
+            row_values = {col: value for col, value in zip(nutrient_columns, values[i].tolist()) if not math.isnan(value)}
+            rows.append([
+                reason, task["cycle"], task["state_id"], task["district_id"], task["block_id"], village_ids[i],
+                task["state_name"], task["district_name"], task["block_name"], df["village"].iat[i], json.dumps(row_values),
+            ])
+        with self.lock, open(self.rejects_path, "a", newline="") as f:
+            writer = csv.writer(f)
+            if f.tell() == 0:
+                writer.writerow(REJECT_COLUMNS)
+            writer.writerows(rows)
+
+    # records the accepted villages of a saved block (the pending dict of check) in the index
+    def commit(self, pending):
+        updates = [(key, row_hash) for key, row_hash in pending.items() if row_hash is not None]
+        with self.lock, self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO villages (key, row_hash) VALUES (?, ?)", updates)
+
+    # number of villages in the index
+    def stats(self):
+        return {"villages": self.conn.execute("SELECT COUNT(*) FROM villages").fetchone()[0]}
+
+    def close(self):
+        self.conn.close()
+
+
+# a block stream of another writer that only passes on the rows the validator accepts. finish() raises
+# ValidationError for a block whose rows were all rejected, instead of recording it as empty
+class ValidatingBlockStream:
+    def __init__(self, stream, writer, task):
+        self.stream = stream
+        self.writer = writer
+        self.validator = writer.validator
+        self.task = task
+        self.rejected = 0
+        self.pending = {}
+
+    @property
+    def records(self):
+        return self.stream.records
+
+    def append(self, df):
+        checked = self.validator.check(self.task, df, self.pending)
+        self.rejected += len(df) - len(checked)
+        if not checked.empty:
+            self.stream.append(checked)
+
+    def finish(self):
+        if self.stream.records == 0 and self.rejected:
+            self.stream.abort()
+            raise ValidationError(f"All {self.rejected} rows of {block_path(self.task)} were rejected, see {self.validator.rejects_path}")
+        return self.writer.saved(self.task, self.pending, self.stream.finish)
+
+    def abort(self):
+        self.stream.abort()
+
+
+# Validation stage in front of a writer (CsvWriter or ParquetWriter), same interface. The villages of a
+# block go into the index when the writer returns the block as saved, for parquet that can be a later flush
+class ValidatingWriter:
+    def __init__(self, writer, validator):
+        self.writer = writer
+        self.validator = validator
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def existing_hash(self, task):
+        return self.writer.existing_hash(task)
+
+    def open_block(self, task):
+        return ValidatingBlockStream(self.writer.open_block(task), self, task)
+
+    def write_block(self, task, df):
+        pending = {}
+        checked = self.validator.check(task, df, pending)
+        if checked.empty:
+            if not df.empty:
+                raise ValidationError(f"All {len(df)} rows of {block_path(task)} were rejected, see {self.validator.rejects_path}")
+            return [(task, 0, None)]
+        return self.saved(task, pending, lambda: self.writer.write_block(task, checked))
+
+    # runs write (which hands the block to the writer) and commits the pending villages of every block it
+    # returns as saved. The pending villages of a block that fails to write are dropped
+    def saved(self, task, pending, write):
+        with self.lock:
+            self.pending[block_key(task)] = pending
+        try:
+            done = write()
+        except BaseException:
+            with self.lock:
+                self.pending.pop(block_key(task), None)
+            raise
+        return self.commit(done)
+
+    def commit(self, done):
+        for saved_task, records, content_hash in done:
+            with self.lock:
+                pending = self.pending.pop(block_key(saved_task), None)
+            if pending:
+                self.validator.commit(pending)
+        return done
+
+    def close(self):
+        try:
+            return self.commit(self.writer.close())
+        finally:
+            self.validator.close()
+
+
+# command line option shared by the crawlers
+def add_validation_args(parser):
+    parser.add_argument("--no-validation", action="store_true", help=f"write rows without the duplicate and range checks ({VILLAGE_INDEX_FILE}, {REJECTS_FILE})")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    parser = argparse.ArgumentParser(description="Inspect the village index of the validation stage")
+    parser.add_argument("--index", default=VILLAGE_INDEX_FILE, help="village index file")
+    parser.add_argument("--rejects", default=REJECTS_FILE, help="rejects csv")
+    args = parser.parse_args()
+
+    try:
+        validator = VillageValidator(args.index, args.rejects)
+        print(f"Index: {validator.stats()}")
+        if os.path.exists(args.rejects):
+            with open(args.rejects, newline="") as f:
+                reasons = {}
+                for row in csv.DictReader(f):
+                    reason = row["reason"].split(" (")[0].split(" of ")[0]
+                    reasons[reason] = reasons.get(reason, 0) + 1
+            print(f"Rejected rows in {args.rejects}: {reasons}")
+        validator.close()
+    except Exception as e:
+        logging.error(f"An error occurred: {e}", exc_info=True)
+        print(f"An error occurred: {e}")
@@ -0,0 +1,298 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+
+OUTPUT_FORMATS = ["csv", "parquet"]
+
+# Parquet dataset settings: partitioned by cycle/state/district, many blocks per file
+PARQUET_COMPRESSION = "zstd"
+MAX_BUFFERED_ROWS = 200_000
+SCHEMA_FILE = "_schema.json"
+PARTITION_COLUMNS = ["cycle", "state", "district"]
+
+
+# builds the {cycle}/{state}/{district}/{block}.csv path for a block
+def block_filepath(data_dir, cycle, state_name, district_name, block_name):
+    folder_path = os.path.join(data_dir, cycle, state_name, district_name)
+    filename = block_name.split('-')[0].strip().replace(" ", "_") + ".csv"
+    return folder_path, filename, os.path.join(folder_path, filename)
+
+
+def file_hash(filepath):
+    sha = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+# flushes a file (or directory entry) to disk
+def fsync_path(path, flags=os.O_RDONLY):
+    fd = os.open(path, flags)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def block_path(task):
+    return f"{task['cycle']}/{task['state_name']}/{task['district_name']}/{task['block_name']}"
+
+
+# Writers take the rows of a block, either all at once (write_block) or streamed in batches through
+# open_block(task) -> append(df) ... finish(), and return the blocks that are now safely on disk as
+# (task, records, content_hash), which is when the crawler marks them done in the ledger. A block
+# without rows is not saved, finish() drops it and returns it with 0 records and no hash.
+
+# A block streamed to csv: batches are appended to {file}.{pid}.part next to the final file as they
+# come in, so only one batch is in memory. finish() fsyncs the part file and renames it to the real
+# name, a file under the block's name is therefore always complete. abort() drops the part file.
+# The file is utf-8 whatever the locale, so the hash of the streamed content matches file_hash
+class CsvBlockStream:
+    def __init__(self, writer, task):
+        self.writer = writer
+        self.task = task
+        self.folder_path, self.filename, self.filepath = writer.filepath(task)
+        os.makedirs(self.folder_path, exist_ok=True)
+        # part files left behind by a crashed run of this block
+        for name in os.listdir(self.folder_path):
+            if name.startswith(self.filename + ".") and name.endswith(".part"):
+                os.remove(os.path.join(self.folder_path, name))
+        self.part_path = f"{self.filepath}.{os.getpid()}.part"
+        self.file = open(self.part_path, 'w', newline='', encoding='utf-8')
+        self.columns = None
+        self.records = 0
+        self.sha = hashlib.sha256()
+
+    def append(self, df):
+        if df.empty:
+            return
+        if self.columns is not None and list(df.columns) != self.columns:
+            self.widen(df.columns)
+        df = df.reindex(columns=self.columns) if self.columns is not None else df
+        content = df.to_csv(index=False, header=self.columns is None)
+        self.columns = list(df.columns)
+        self.file.write(content)
+        self.sha.update(content.encode())
+        self.records += len(df)
+
+    # the schema learned new columns after the first batch: rewrites what is written so far with them
+    # (empty, like NaN) so the header stays valid. Rare, nutrient columns are known after the first block
+    def widen(self, columns):
+        new_columns = self.columns + [col for col in columns if col not in self.columns]
+        import pandas as pd
+
+        self.file.close()
+        written = pd.read_csv(self.part_path, dtype=str, keep_default_na=False, encoding="utf-8").reindex(columns=new_columns, fill_value="")
+        content = written.to_csv(index=False)
+        self.file = open(self.part_path, 'w', newline='', encoding='utf-8')
+        self.file.write(content)
+        self.sha = hashlib.sha256(content.encode())
+        self.columns = new_columns
+
+    # moves the complete block into place unless the file already holds exactly this content.
+    # returns the completed blocks like write_block
+    def finish(self):
+        if self.records == 0:
+            self.abort()
+            return [(self.task, 0, None)]
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        content_hash = self.sha.hexdigest()
+        if content_hash == self.task.get("content_hash") and os.path.exists(self.filepath):
+            os.remove(self.part_path)
+            logging.info(f"Unchanged {block_path(self.task)}, file kept.")
+        else:
+            os.replace(self.part_path, self.filepath)
+            fsync_path(self.folder_path)
+            print(f"{self.task['cycle']}/{self.task['state_name']}/{self.task['district_name']}/{self.filename} saved with {self.records} records.")
+        return [(self.task, self.records, content_hash)]
+
+    def abort(self):
+        self.file.close()
+        if os.path.exists(self.part_path):
+            os.remove(self.part_path)
+
+
+# streaming for writers that buffer anyway (parquet): collects the batches and hands the block over on finish()
+class BufferedBlockStream:
+    def __init__(self, writer, task):
+        self.writer = writer
+        self.task = task
+        self.frames = []
+        self.records = 0
+
+    def append(self, df):
+        if not df.empty:
+            self.frames.append(df)
+            self.records += len(df)
+
+    def finish(self):
+        import pandas as pd
+
+        frames, self.frames = self.frames, []
+        if not frames:
+            return [(self.task, 0, None)]
+        return self.writer.write_block(self.task, pd.concat(frames, ignore_index=True))
+
+    def abort(self):
+        self.frames = []
+
+
+# one csv per block, streamed to disk while the block is crawled
+class CsvWriter:
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+
+    def filepath(self, task):
+        return block_filepath(self.data_dir, task["cycle"], task["state_name"], task["district_name"], task["block_name"])
+
+    # hash of the block's file if it was saved before, None otherwise
+    def existing_hash(self, task):
+        filepath = self.filepath(task)[2]
+        return file_hash(filepath) if os.path.exists(filepath) else None
+
+    def open_block(self, task):
+        return CsvBlockStream(self, task)
+
+    def write_block(self, task, df):
+        stream = self.open_block(task)
+        try:
+            stream.append(df)
+        except Exception:
+            stream.abort()
+            raise
+        return stream.finish()
+
+    def close(self):
+        return []
+
+
+# Hive partitioned parquet dataset (cycle=/state=/district=/part-*.parquet). Blocks are buffered and
+# written MAX_BUFFERED_ROWS rows at a time, so a file holds many blocks. A re-fetched block replaces its old rows. Every file has the columns of the
+# nutrient schema (also copied to _schema.json in the dataset) as float64
+class ParquetWriter:
+    def __init__(self, dataset_dir, schema, max_buffered_rows=MAX_BUFFERED_ROWS, compression=PARQUET_COMPRESSION):
+        try:
+            import pyarrow
+        except ImportError:
+            raise ImportError("Parquet output needs pyarrow, install it with: pip install pyarrow")
+        self.dataset_dir = dataset_dir
+        self.schema = schema
+        self.max_buffered_rows = max_buffered_rows
+        self.compression = compression
+        self.buffers = {}
+        self.buffered_rows = 0
+        self.pending = []
+        self.lock = threading.Lock()
+
+    # blocks already in the dataset are known from the ledger, so nothing is skipped here
+    def existing_hash(self, task):
+        return None
+
+    def open_block(self, task):
+        return BufferedBlockStream(self, task)
+
+    def write_block(self, task, df):
+        import pandas as pd
+
+        content_hash = hashlib.sha256(pd.util.hash_pandas_object(df, index=False).values.tobytes()).hexdigest()
+        if content_hash == task.get("content_hash"):
+            logging.info(f"Unchanged {block_path(task)}, rows not written again.")
+            return [(task, len(df), content_hash)]
+
+        df = df.assign(fetched_at=pd.Timestamp.now().floor("s"))
+        with self.lock:
+            partition = tuple(df[col].iat[0] for col in PARTITION_COLUMNS)
+            self.buffers.setdefault(partition, []).append(df)
+            self.buffered_rows += len(df)
+            self.pending.append((task, len(df), content_hash))
+            if self.buffered_rows >= self.max_buffered_rows:
+                return self.flush()
+        return []
+
+    def arrow_schema(self):
+        import pyarrow as pa
+
+        fields = [pa.field("block", pa.string()), pa.field("village", pa.string()), pa.field("village_id", pa.string()), pa.field("fetched_at", pa.timestamp("s"))]
+        fields += [pa.field(col, pa.float64()) for col in self.schema.columns]
+        return pa.schema(fields)
+
+    # writes every buffered partition to a new file (temp file + rename) and returns the blocks it covered
+    def flush(self):
+        import pandas as pd
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        if not self.pending:
+            return []
+        os.makedirs(self.dataset_dir, exist_ok=True)
+        with open(os.path.join(self.dataset_dir, SCHEMA_FILE), "w") as f:
+            json.dump({"nutrient_columns": self.schema.columns}, f, indent=2)
+
+        schema = self.arrow_schema()
+        for partition, frames in self.buffers.items():
+            folder = os.path.join(self.dataset_dir, *(f"{col}={value}" for col, value in zip(PARTITION_COLUMNS, partition)))
+            os.makedirs(folder, exist_ok=True)
+            # blocks buffered before the schema grew get the new columns as NaN
+            df = pd.concat(frames, ignore_index=True).reindex(columns=schema.names)
+            table = pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+            filepath = os.path.join(folder, f"part-{time.time_ns()}-{os.getpid()}.parquet")
+            pq.write_table(table, filepath + ".tmp", compression=self.compression)
+            os.replace(filepath + ".tmp", filepath)
+            logging.info(f"Wrote {len(df)} rows to {filepath}")
+            self.drop_superseded(folder, set(df["block"]), filepath)
+        print(f"Parquet: wrote {self.buffered_rows} rows of {len(self.pending)} blocks.")
+        done = self.pending
+        self.buffers = {}
+        self.buffered_rows = 0
+        self.pending = []
+        return done
+
+    # A re-fetched block replaces its rows: after its new rows are on disk, they are removed from the files
+    # written before (a file left with no rows is deleted), so every block is in the dataset once.
+    # A crash in between leaves the old rows too, they go the next time the block is written
+    def drop_superseded(self, folder, blocks, keep):
+        import pyarrow as pa
+        import pyarrow.compute as pc
+        import pyarrow.parquet as pq
+
+        for name in sorted(os.listdir(folder)):
+            filepath = os.path.join(folder, name)
+            if not name.endswith(".parquet") or filepath == keep:
+                continue
+            if blocks.isdisjoint(pq.read_table(filepath, columns=["block"]).column("block").to_pylist()):
+                continue
+            table = pq.read_table(filepath)
+            kept = table.filter(pc.invert(pc.is_in(table["block"], value_set=pa.array(sorted(blocks), pa.string()))))
+            if kept.num_rows:
+                pq.write_table(kept, f"{filepath}.{os.getpid()}.tmp", compression=self.compression)
+                os.replace(f"{filepath}.{os.getpid()}.tmp", filepath)
+            else:
+                os.remove(filepath)
+            logging.info(f"Removed {table.num_rows - kept.num_rows} superseded rows from {filepath}")
+
+    def close(self):
+        with self.lock:
+            return self.flush()
+
+
+# validator (a validate.VillageValidator) puts the duplicate and range checks in front of the writer
+def make_writer(output_format, data_dir, schema, validator=None):
+    if output_format == "parquet":
+        writer = ParquetWriter(os.path.join(os.path.dirname(data_dir), "parquet"), schema)
+    else:
+        writer = CsvWriter(data_dir)
+    if validator is not None:
+        from validate import ValidatingWriter
+        writer = ValidatingWriter(writer, validator)
+    return writer
+
+
+# command line option shared by the crawlers
+def add_output_args(parser):
+    parser.add_argument("--output-format", choices=OUTPUT_FORMATS, default="csv", help="one csv per block, or a partitioned parquet dataset in data/parquet")